@@ -2,15 +2,15 @@ import logging
 
 from neotools.applet.constants import *
 from neotools.message import Message, MessageConst, send_message
-from neotools.util import calculate_data_checksum, NeotoolsError, data_from_buf
+from neotools.util import calculate_data_checksum, NeotoolsError
 
 logger = logging.getLogger(__name__)
 
 
 class Applet:
     @staticmethod
-    def from_raw_header(buf):
-        applet = data_from_buf(APPLET_HEADER_FORMAT, buf)
+    def from_raw_header(buf, offset=0):
+        applet = APPLET_HEADER.unpack_from(buf, offset)
         if applet['signature'] != SIGNATURE_START:
             raise NeotoolsError('Invalid applet signature %s', applet['signature'])
 
@@ -18,6 +18,11 @@ class Applet:
 
 
 def read_applet_list(device):
+    """
+    The list is cached for the session. Installing and removing applets invalidates it.
+    """
+    if device.applets is not None:
+        return list(device.applets.values())
     applets = []
     logger.info('Retrieving list of applets')
     device.dialogue_start()
@@ -26,15 +31,26 @@ def read_applet_list(device):
         buf = raw_read_applet_headers(device, len(applets))
         header_count = int(len(buf) / header_size)
         for index in range(0, header_count):
-            applet_raw = buf[index * header_size:(index + 1) * header_size]
-            applet = Applet.from_raw_header(applet_raw)
+            applet = Applet.from_raw_header(buf, index * header_size)
             applets.append(applet)
         if header_count < LIST_APPLETS_REQUEST_COUNT:
             break
     device.dialogue_end()
+    device.applets = {applet['applet_id']: applet for applet in applets}
     return applets
 
 
+def get_applet(device, applet_id):
+    """Return the header of an installed applet, or None."""
+    if device.applets is None:
+        read_applet_list(device)
+    return device.applets.get(applet_id)
+
+
+def invalidate_applet_list(device):
+    device.applets = None
+
+
 # returns a list of installed applets
 def raw_read_applet_headers(device, index):
     header_size = APPLET_HEADER_FORMAT['size']
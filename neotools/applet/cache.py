@@ -0,0 +1,72 @@
+"""
+Cache of the applets fetched from devices, so that an applet that was fetched from one
+device is not transferred again from the others.
+
+The files are stored by the SHA-256 of their content, and a reference by the identity
+of the header (applet id, version and ROM size) points to the content. Identical
+applets of many devices share one file.
+"""
+import hashlib
+import logging
+import os
+
+from neotools.applet.constants import APPLET_HEADER
+from neotools.util import user_cache_dir
+
+logger = logging.getLogger(__name__)
+
+
+def header_key(header):
+    return (f'{header["applet_id"]:04x}-{header["version_major"]}.{header["version_minor"]}'
+            f'-{header["version_revision"]:02x}-{header["rom_size"]}')
+
+
+def _write_atomic(path, data):
+    temp_path = path.with_name(path.name + '.tmp')
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+class AppletCache:
+    def __init__(self, path=None):
+        if path is None:
+            path = user_cache_dir() / 'applet_cache'
+        self.blobs_path = path / 'blobs'
+        self.refs_path = path / 'refs'
+        self.blobs_path.mkdir(parents=True, exist_ok=True)
+        self.refs_path.mkdir(parents=True, exist_ok=True)
+
+    def blob_path(self, digest):
+        return self.blobs_path / f'{digest}.OS3KApp'
+
+    def get(self, header):
+        """
+        Return the cached content for the header of an installed applet, or None.
+        The content must match its hash, and its header must match the installed one.
+        """
+        ref_path = self.refs_path / header_key(header)
+        try:
+            digest = ref_path.read_text().strip()
+            content = self.blob_path(digest).read_bytes()
+        except OSError:
+            return None
+        if hashlib.sha256(content).hexdigest() != digest:
+            logger.warning('The cached copy of applet %s is corrupted', header_key(header))
+            return None
+        if len(content) < APPLET_HEADER.size or APPLET_HEADER.unpack_from(content) != header:
+            logger.warning('The cached copy of applet %s has a different header', header_key(header))
+            return None
+        return content
+
+    def put(self, header, content):
+        """Store the content for the header. Return the hash, or None if the content has another header."""
+        if len(content) < APPLET_HEADER.size or APPLET_HEADER.unpack_from(content) != header:
+            logger.debug('Not caching applet %s, the content has a different header', header_key(header))
+            return None
+        digest = hashlib.sha256(content).hexdigest()
+        blob_path = self.blob_path(digest)
+        if not blob_path.exists():
+            _write_atomic(blob_path, content)
+        _write_atomic(self.refs_path / header_key(header), digest.encode())
+        return digest
@@ -0,0 +1,205 @@
+"""
+Index of the applet files on this computer, for finding the file that provides
+an applet by its id or name and version without inspecting every candidate.
+
+The index is an SQLite database in the user cache directory. It is refreshed
+incrementally: only the files with a changed modification time or size are read again.
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+
+from neotools.applet.constants import AppletType
+from neotools.applet.inspect import applet_type_to_str, format_version, inspect_applet_file, iter_applet_paths
+from neotools.util import NeotoolsError, user_cache_dir
+
+logger = logging.getLogger(__name__)
+
+# The header fields stored in the index, in the order of the columns.
+INDEXED_FIELDS = ['applet_id', 'name', 'version_major', 'version_minor', 'version_revision',
+                  'rom_size', 'ram_size', 'file_space', 'language_id']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS applets (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    applet_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    version_major INTEGER NOT NULL,
+    version_minor INTEGER NOT NULL,
+    version_revision INTEGER NOT NULL,
+    rom_size INTEGER NOT NULL,
+    ram_size INTEGER NOT NULL,
+    file_space INTEGER NOT NULL,
+    language_id INTEGER NOT NULL
+);
+-- The files that are not applets, so that they are not inspected again until they change.
+CREATE TABLE IF NOT EXISTS skipped (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS applets_by_id ON applets (applet_id, version_major, version_minor);
+CREATE INDEX IF NOT EXISTS applets_by_name ON applets (name COLLATE NOCASE);
+'''
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class AppletCatalog:
+    def __init__(self, path=None):
+        if path is None:
+            path = user_cache_dir() / 'applets.sqlite'
+        self.connection = sqlite3.connect(str(path))
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def directories(self):
+        return [row['path'] for row in self.connection.execute('SELECT path FROM directories ORDER BY path')]
+
+    def add_directories(self, paths):
+        with self.connection:
+            self.connection.executemany('INSERT OR IGNORE INTO directories (path) VALUES (?)',
+                                        [(os.path.abspath(path),) for path in paths])
+
+    def remove_directories(self, paths):
+        with self.connection:
+            self.connection.executemany('DELETE FROM directories WHERE path = ?',
+                                        [(os.path.abspath(path),) for path in paths])
+
+    def refresh(self):
+        """
+        Index the new and changed applet files in the directories and drop the missing ones.
+        The files that are not applets are recorded too, and inspected again only when they change.
+        Returns the number of files in each outcome.
+        """
+        stats = {'added': 0, 'updated': 0, 'unchanged': 0, 'removed': 0, 'skipped': 0}
+        known = {row['path']: (row['mtime_ns'], row['size'])
+                 for row in self.connection.execute('SELECT path, mtime_ns, size FROM applets')}
+        known_skipped = {row['path']: (row['mtime_ns'], row['size'])
+                         for row in self.connection.execute('SELECT path, mtime_ns, size FROM skipped')}
+        seen = set()
+        with self.connection:
+            for path in iter_applet_paths(self.directories()):
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                seen.add(path)
+                file_key = (stat.st_mtime_ns, stat.st_size)
+                if known.get(path) == file_key:
+                    stats['unchanged'] += 1
+                    continue
+                if known_skipped.get(path) == file_key:
+                    stats['skipped'] += 1
+                    continue
+                header = self._read_applet_header(path)
+                if header is None:
+                    stats['skipped'] += 1
+                    self.connection.execute('INSERT OR REPLACE INTO skipped (path, mtime_ns, size) VALUES (?, ?, ?)',
+                                            [path, stat.st_mtime_ns, stat.st_size])
+                    if path in known:
+                        self.connection.execute('DELETE FROM applets WHERE path = ?', (path,))
+                    continue
+                if path in known_skipped:
+                    self.connection.execute('DELETE FROM skipped WHERE path = ?', (path,))
+                self.connection.execute(
+                    f'INSERT OR REPLACE INTO applets (path, mtime_ns, size, sha256, {", ".join(INDEXED_FIELDS)}) '
+                    f'VALUES (?, ?, ?, ?, {", ".join("?" * len(INDEXED_FIELDS))})',
+                    [path, stat.st_mtime_ns, stat.st_size, file_sha256(path)] + [header[f] for f in INDEXED_FIELDS])
+                stats['updated' if path in known else 'added'] += 1
+            for path in known.keys() - seen:
+                self.connection.execute('DELETE FROM applets WHERE path = ?', (path,))
+                stats['removed'] += 1
+            for path in known_skipped.keys() - seen:
+                self.connection.execute('DELETE FROM skipped WHERE path = ?', (path,))
+        return stats
+
+    @staticmethod
+    def _read_applet_header(path):
+        try:
+            info = inspect_applet_file(path)
+        except (NeotoolsError, OSError, ValueError) as e:
+            logger.debug('Not indexing %s: %s', path, e)
+            return None
+        if info['applet_type'] != applet_type_to_str(AppletType.REGULAR):
+            return None  # ROM images have no applet header
+        return info['header']
+
+    def find(self, applet_id=None, name=None, version=None):
+        """Return the matching entries, the newest version first."""
+        conditions = []
+        params = []
+        if applet_id is not None:
+            conditions.append('applet_id = ?')
+            params.append(applet_id)
+        if name is not None:
+            conditions.append('name = ? COLLATE NOCASE')
+            params.append(name)
+        where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+        rows = self.connection.execute(
+            'SELECT * FROM applets' + where +
+            ' ORDER BY applet_id, version_major DESC, version_minor DESC, version_revision DESC, path', params)
+        entries = [dict(row) for row in rows]
+        for entry in entries:
+            entry['version'] = format_version(entry)
+        if version is not None:
+            entries = [e for e in entries if e['version'] == version]
+        return entries
+
+    def find_applet(self, applet, version=None):
+        """Find entries by an applet id (decimal or 0x-prefixed hex) or name."""
+        try:
+            return self.find(applet_id=int(applet, 0), version=version)
+        except ValueError:
+            return self.find(name=applet, version=version)
+
+    def resolve(self, applet, version=None):
+        """
+        Return the path of the newest file for an applet id or name.
+        """
+        entries = self.find_applet(applet, version)
+        if len(entries) == 0:
+            suffix = f' version {version}' if version else ''
+            raise NeotoolsError(f'Applet {applet}{suffix} is not found in the index. '
+                                f'Indexed directories: {", ".join(self.directories()) or "none"}')
+        if len({entry['applet_id'] for entry in entries}) > 1:
+            raise NeotoolsError(f'Name {applet} matches several applet ids. Use the applet id instead.')
+        return entries[0]['path']
+
+
+def index_directories(directories, remove=False):
+    with AppletCatalog() as catalog:
+        if remove:
+            catalog.remove_directories(directories)
+        else:
+            catalog.add_directories(directories)
+        stats = catalog.refresh()
+        return {'directories': catalog.directories(), **stats}
+
+
+def find_applets(applet, version=None):
+    with AppletCatalog() as catalog:
+        catalog.refresh()
+        return catalog.find_applet(applet, version)
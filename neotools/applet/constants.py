@@ -1,6 +1,8 @@
 from collections import OrderedDict
 from enum import Enum
 
+from neotools.util import BinaryFormat
+
 
 # Applet fields with offset and width in to the applet header data
 # (usually located at the start of the applet).
@@ -42,6 +44,14 @@ APPLET_SETTINGS_RANGE32_FORMAT = {
     }
 }
 
+# The layouts compiled once, and the record types that they decode into.
+APPLET_HEADER = BinaryFormat('AppletHeader', APPLET_HEADER_FORMAT, __name__)
+AppletHeader = APPLET_HEADER.record
+APPLET_SETTINGS_HEADER = BinaryFormat('AppletSettingsHeader', APPLET_SETTINGS_FORMAT, __name__)
+AppletSettingsHeader = APPLET_SETTINGS_HEADER.record
+APPLET_SETTINGS_RANGE32 = BinaryFormat('AppletSettingsRange32', APPLET_SETTINGS_RANGE32_FORMAT, __name__)
+AppletSettingsRange32 = APPLET_SETTINGS_RANGE32.record
+
 SIGNATURE_START = 0xc0ffeead  # The expected value of the signature word.#
 SIGNATURE_END = 0xcafefeed
 
@@ -0,0 +1,160 @@
+import mmap
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+from neotools.applet.constants import *
+from neotools.util import NeotoolsError, int_from_buf
+
+
+class ROMSignature:
+    SYSTEM_3 = b'System 3          '
+    OS3000_SMALL_ROM = b'OS 3000 Small ROM '
+    ALPHASMART_UPDATER = b'AlphaSmart Updater'
+    SYSTEM_3_NEO = b'System 3 Neo      '
+    OS3KNEO_SMALL_ROM = b'OS 3KNeo Small ROM'
+
+
+def inspect_applet(content: bytes):
+    applet_type = classify_applet(content)
+    header = APPLET_HEADER.unpack_from(content)
+    return {
+        'applet_type': applet_type_to_str(applet_type),
+        'header': header
+    }
+
+
+def inspect_applet_file(applet_path):
+    """
+    The file is memory-mapped, so only the pages with the header, the trailer
+    and the ROM signature are read, even for large ROM images.
+    """
+    with open(applet_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise NeotoolsError('Empty file')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as content:
+            return inspect_applet(content)
+
+
+def inspect_applet_path(applet_path):
+    """Like inspect_applet_file, but reports the errors in the result."""
+    try:
+        return {'path': applet_path, **inspect_applet_file(applet_path)}
+    except (NeotoolsError, OSError, ValueError) as e:
+        return {'path': applet_path, 'error': str(e)}
+
+
+def iter_applet_paths(paths):
+    """Yield the files, walking the directories recursively."""
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def inspect_applet_files(paths, jobs=None):
+    """
+    Inspect the files and directories in parallel, yielding the results
+    of inspect_applet_path in the order of the paths.
+    """
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield from executor.map(inspect_applet_path, iter_applet_paths(paths), chunksize=32)
+
+
+def iter_embedded_applets(content):
+    """
+    Yield (offset, header) for the applets embedded in a ROM image. The candidates
+    are found with a bulk search for the start signature, and accepted if the header
+    is complete and the end signature is at the end of the declared ROM size.
+    """
+    start_signature = SIGNATURE_START.to_bytes(4, 'big')
+    end_signature = SIGNATURE_END.to_bytes(4, 'big')
+    header_size = APPLET_HEADER.size
+    offset = content.find(start_signature)
+    while offset != -1:
+        next_offset = offset + 1
+        rom_size = int_from_buf(content, offset + 4, 4)
+        end = offset + rom_size
+        if rom_size >= header_size + 4 and end <= len(content) and content[end - 4:end] == end_signature:
+            try:
+                header = APPLET_HEADER.unpack_from(content, offset)
+            except UnicodeDecodeError:
+                header = None
+            if header is not None:
+                yield offset, header
+                next_offset = end
+        offset = content.find(start_signature, next_offset)
+
+
+def embedded_applet_file_name(header):
+    name = re.sub(r'[^\w.-]+', '_', header.name).strip('_') or 'applet'
+    return f'{header.applet_id:04x}-{name}.OS3KApp'
+
+
+def format_version(header):
+    """The version of an applet header or a catalog entry, for example 3.4. The revision is a separate field."""
+    return f'{header["version_major"]}.{header["version_minor"]}'
+
+
+def extract_applets(rom_path, output_dir):
+    """Write the applets embedded in a ROM image to the directory, returning their details."""
+    os.makedirs(output_dir, exist_ok=True)
+    result = []
+    with open(rom_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise NeotoolsError('Empty file')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as content:
+            for offset, header in iter_embedded_applets(content):
+                path = os.path.join(output_dir, embedded_applet_file_name(header))
+                with open(path, 'wb') as applet_file:
+                    applet_file.write(content[offset:offset + header.rom_size])
+                result.append({
+                    'offset': offset,
+                    'applet_id': header.applet_id,
+                    'name': header.name,
+                    'version': format_version(header),
+                    'rom_size': header.rom_size,
+                    'path': path
+                })
+    return result
+
+
+def applet_type_to_str(applet_type):
+    mapping = {
+        AppletType.REGULAR: 'Applet program',
+        AppletType.SYSTEM_3: 'System 3',
+        AppletType.OS3000_SMALL_ROM: 'OS3000 Small ROM',
+        AppletType.ALPHASMART_UPDATER: 'Alphasmart Updater',
+        AppletType.SYSTEM_3_NEO: 'System 3 Neo',
+        AppletType.OS3KNEO_SMALL_ROM: 'OS3KNeo Small ROM'
+    }
+    if applet_type in mapping:
+        return mapping[applet_type]
+    else:
+        raise NeotoolsError(f'Invalid applet type {applet_type}')
+
+
+def classify_applet(content: bytes):
+    if int_from_buf(content, 0, 4) == SIGNATURE_START:
+        if int_from_buf(content, len(content) - 4, 4) != SIGNATURE_END:
+            raise NeotoolsError('Invalid applet')
+        else:
+            return AppletType.REGULAR
+    else:
+        sig_string = content[0x400:0x412]
+        if sig_string == ROMSignature.SYSTEM_3:
+            return AppletType.SYSTEM_3
+        elif sig_string == ROMSignature.OS3000_SMALL_ROM:
+            return AppletType.OS3000_SMALL_ROM
+        elif sig_string == ROMSignature.ALPHASMART_UPDATER:
+            return AppletType.ALPHASMART_UPDATER
+        elif sig_string == ROMSignature.SYSTEM_3_NEO:
+            return AppletType.SYSTEM_3_NEO
+        elif sig_string == ROMSignature.OS3KNEO_SMALL_ROM:
+            return AppletType.OS3KNEO_SMALL_ROM
+        else:
+            raise NeotoolsError('Unknown type of applet: ' + str(sig_string))
@@ -1,180 +1,269 @@
+import json
 import logging
+from datetime import datetime
+from time import time
+
 from usb.core import USBError
 
-from neotools.applet.applet import read_applet_list
+from neotools.applet.applet import get_applet, invalidate_applet_list
+from neotools.applet.cache import AppletCache
 from neotools.file import read_extended_data
 
 from neotools.device import get_available_space
 
 from neotools.applet.constants import *
-from neotools.message import Message, MessageConst, send_message, receive_message
-from neotools.util import calculate_data_checksum, NeotoolsError, data_from_buf, int_from_buf
+from neotools.applet.inspect import applet_type_to_str, classify_applet
+from neotools.message import Message, MessageConst, send_message, receive_message, write_message
+from neotools.util import calculate_data_checksum, NeotoolsError, user_cache_dir
 
 logger = logging.getLogger(__name__)
 
 
-def inspect_applet(content: bytes):
-    applet_type = classify_applet(content)
-    header = data_from_buf(APPLET_HEADER_FORMAT, content[0: APPLET_HEADER_FORMAT['size']])
-    return {
-        'applet_type': applet_type_to_str(applet_type),
-        'header': header
-    }
-
 # This function can also install ROM. I haven't tried it though.
 # For proper ROM installation it may be necessary to clean segments.
 def install_applet(device, content: bytes, force=False):
-    applet_type = classify_applet(content)
-
-    if applet_type != AppletType.REGULAR:
-        raise NeotoolsError(
-            f'This is a ROM file for {applet_type_to_str(applet_type)}. ' +
-            f'Installing ROM has never been tried and can brick your device.')
-
-    logger.debug(f'Type of applet {applet_type_to_str(applet_type)}')
+    install_applets(device, [content], force)
 
-    if applet_type == AppletType.REGULAR:
-        header = data_from_buf(APPLET_HEADER_FORMAT, content[0: APPLET_HEADER_FORMAT['size']])
 
-        applet_list = read_applet_list(device)
-        if any(header['applet_id'] == applet['applet_id'] for applet in applet_list):
-            if not force:
-                raise NeotoolsError(f'Applet {header["name"]} is already installed')
+def install_applets(device, contents, force=False):
+    """
+    Install several applets in one session. The whole set is checked against the
+    installed applets and the available space before anything is written.
+    """
+    plan = plan_applet_installs(device, contents, force)
+    for header, content, installed in plan:
+        if installed:
             remove_applet(device, header['applet_id'])
-
-        required_size = header['ram_size'] + header['file_space']
-        required_rom_size = header['rom_size']
-
-        available_space = get_available_space(device)
+        write_applet(device, header, content)
+
+
+def plan_applet_installs(device, contents, force=False):
+    """
+    Validate the applets and return the (header, content, installed) triples in the order of installation,
+    where installed tells whether the applet replaces an installed one. The applet list is read once here,
+    as writing an applet invalidates it. Raises NeotoolsError if any applet cannot be installed or the set does not fit.
+    """
+    plan = []
+    for content in contents:
+        applet_type = classify_applet(content)
+        if applet_type != AppletType.REGULAR:
+            raise NeotoolsError(
+                f'This is a ROM file for {applet_type_to_str(applet_type)}. ' +
+                f'Installing ROM has never been tried and can brick your device.')
+        logger.debug(f'Type of applet {applet_type_to_str(applet_type)}')
+        header = APPLET_HEADER.unpack_from(content)
         logger.info(f'Applet details\n{header}')
-        logger.info(f'available_space={available_space}')
+        if any(header['applet_id'] == other['applet_id'] for other, _, _ in plan):
+            raise NeotoolsError(f'Applet {header["name"]} is passed more than once')
+        installed = get_applet(device, header['applet_id']) is not None
+        if installed and not force:
+            raise NeotoolsError(f'Applet {header["name"]} is already installed')
+        plan.append((header, content, installed))
 
-        # NEO Manager uses 0xff000000
-        if required_rom_size > 0xff000000 or required_rom_size > available_space['free_rom']:
-            raise NeotoolsError('Required ROM size too big.')
+    # Removing an applet does not free up its space, so the replaced applets are not subtracted.
+    required_size = sum(header['ram_size'] + header['file_space'] for header, _, _ in plan)
+    required_rom_size = sum(header['rom_size'] for header, _, _ in plan)
 
-        if required_size > 0xff000000 or required_size > available_space['free_ram']:
-            raise NeotoolsError('Required RAM size too big.')
+    available_space = get_available_space(device)
+    logger.info(f'available_space={available_space}')
 
-        print(f'Installing applet {header["name"]}')
+    # NEO Manager uses 0xff000000
+    if required_rom_size > 0xff000000 or required_rom_size > available_space['free_rom']:
+        raise NeotoolsError('Required ROM size too big.')
 
-        device.dialogue_start()
+    if required_size > 0xff000000 or required_size > available_space['free_ram']:
+        raise NeotoolsError('Required RAM size too big.')
 
-        print('Initialization for writing the applet')
-        some_size_requirement = required_rom_size | (required_size & 0xffff0000) << 8
-        message = Message(MessageConst.REQUEST_WRITE_APPLET, [
-            (some_size_requirement, 1, 4), (required_size, 5, 2)])
+    # Install in the order of applet ids, which is also the order the device lists them in.
+    return sorted(plan, key=lambda item: item[0]['applet_id'])
 
-        send_message(device, message, MessageConst.RESPONSE_WRITE_APPLET, timeout=5000)
-        print('Initialized writing the applet')
 
-        _write_applet_content(device, content)
+def write_applet(device, header, content):
+    required_size = header['ram_size'] + header['file_space']
+    required_rom_size = header['rom_size']
 
-        print('Finalizing writing the applet. This may take a minute')
-        message = Message(MessageConst.REQUEST_FINALIZE_WRITING_APPLET, [])
-        device.write(message.m_data, timeout=24000)
+    print(f'Installing applet {header["name"]}')
 
-        # NeoManager has a loop receiving a message with condition on ENOMEM.
-        # Perhaps that only matters for updating ROM.
-        retry_count = 10
-        while retry_count > 0:
-            try:
-                receive_message(device, MessageConst.RESPONSE_FINALIZE_WRITING_APPLET, timeout=5000)
-            except USBError as e:
-                logger.info(f'Waiting for finalization, {e}')
-                pass  # likely this is a timeout
-            retry_count -= 1
+    device.dialogue_start()
 
-        print('Finalized writing the applet')
+    invalidate_applet_list(device)
+    print('Initialization for writing the applet')
+    some_size_requirement = required_rom_size | (required_size & 0xffff0000) << 8
+    message = Message(MessageConst.REQUEST_WRITE_APPLET, [
+        (some_size_requirement, 1, 4), (required_size, 5, 2)])
+
+    send_message(device, message, MessageConst.RESPONSE_WRITE_APPLET, timeout=5000)
+    print('Initialized writing the applet')
+
+    _write_applet_content(device, content)
+
+    print('Finalizing writing the applet. This may take a minute')
+    message = Message(MessageConst.REQUEST_FINALIZE_WRITING_APPLET, [])
+    write_message(device, message.m_data, timeout=24000)
+    with device.track_transfer('Finalizing the applet', None, cancellable=False):
+        seconds = wait_for_finalization(device)
+    record_finalization_time(header, seconds)
+
+    print(f'Finalized writing the applet in {seconds:.1f} s')
+    return seconds
+
+
+FINALIZE_TIMEOUT = 120  # seconds
+FINALIZE_MIN_POLL = 250  # milliseconds
+FINALIZE_MAX_POLL = 5000  # milliseconds
+
+
+def wait_for_finalization(device, timeout=FINALIZE_TIMEOUT):
+    """
+    Wait for RESPONSE_FINALIZE_WRITING_APPLET and return how many seconds it took.
+    NeoManager has a loop receiving a message with condition on ENOMEM.
+    Perhaps that only matters for updating ROM.
+    """
+    return wait_for_response(device, MessageConst.RESPONSE_FINALIZE_WRITING_APPLET, timeout, 'finalize writing the applet')
+
+
+def wait_for_response(device, success_code, timeout, action):
+    """
+    Wait for a response of a long operation and return how many seconds it took.
+
+    The device does not answer while it is busy, so the reads time out. The read
+    timeout starts short and doubles on every timeout, which ends the wait soon
+    after the response arrives without polling a busy device too often.
+    The progress listeners get the elapsed time after every poll.
+    """
+    start_time = time()
+    poll = FINALIZE_MIN_POLL
+    while True:
+        try:
+            receive_message(device, success_code, timeout=poll)
+            return time() - start_time
+        except USBError as e:
+            elapsed = time() - start_time
+            if elapsed >= timeout:
+                raise NeotoolsError(f'The device did not {action} in {elapsed:.0f} s')
+            logger.info(f'Waiting to {action} for {elapsed:.1f} s, {e}')
+            device.report_progress(0, None)
+            poll = min(poll * 2, FINALIZE_MAX_POLL)
+
+
+def record_finalization_time(header, seconds):
+    """Append the finalization time to a log in the cache directory, to see how it depends on the applet size."""
+    logger.info(f'Finalized applet_id={header["applet_id"]} rom_size={header["rom_size"]} in {seconds:.2f} s')
+    record = {'applet_id': header['applet_id'], 'name': header['name'], 'rom_size': header['rom_size'],
+              'seconds': round(seconds, 3), 'date': datetime.now().isoformat(timespec='seconds')}
+    try:
+        with open(user_cache_dir() / 'finalization_times.jsonl', 'a') as f:
+            f.write(json.dumps(record) + '\n')
+    except OSError as e:
+        logger.warning(f'Failed to record the finalization time: {e}')
+
+
+APPLET_BLOCK_SIZE = 0x400
+# NEO Manager sends the applet data in 64 byte packets rather than 8 byte ones,
+# see install_thesaurus.pcapng. That is eight times fewer USB transfers per block.
+APPLET_DATA_PACKET_SIZE = 64
+
+
+def _applet_block_frames(content):
+    """
+    Precompute the BLOCK_WRITE request for every block, so that the upload loop only does I/O.
+    The blocks are memoryview slices of the content, not copies.
+    """
+    view = memoryview(content)
+    frames = []
+    for offset in range(0, len(content), APPLET_BLOCK_SIZE):
+        block = view[offset:offset + APPLET_BLOCK_SIZE]
+        message = Message(MessageConst.REQUEST_BLOCK_WRITE,
+                          [(len(block), 1, 4), (calculate_data_checksum(block), 5, 2)])
+        frames.append((bytes(message.m_data), block))
+    return frames
 
 
 def _write_applet_content(device, content):
+    """
+    Every block is written with the exchanges:
+
+        OUT:    0x02    REQUEST_BLOCK_WRITE
+        IN:     0x42    RESPONSE_BLOCK_WRITE
+        OUT:    data
+        IN:     0x43    RESPONSE_BLOCK_WRITE_DONE
+        OUT:    0x0b    REQUEST_PROGRAMMING_APPLET_BLOCK
+        IN:     0x47    RESPONSE_PROGRAMMING_APPLET_BLOCK
+
+    In the captures each response arrives within 0.1s. Programming the flash gets a longer timeout.
+    A cancelled upload ends the dialogue before the applet is finalized.
+    """
     print('Started writing applet content')
 
-    remaining = len(content)
+    frames = _applet_block_frames(content)
+    programming_request = bytes(Message(MessageConst.REQUEST_PROGRAMMING_APPLET_BLOCK, []).m_data)
+    start_time = time()
     offset = 0
-    while remaining > 0:
-        block_size = min(0x400, remaining)
-        block = content[offset:offset + block_size]
-        checksum = calculate_data_checksum(block)
-
-        message = Message(MessageConst.REQUEST_BLOCK_WRITE, [(block_size, 1, 4), (checksum, 5, 2)])
-        send_message(device, message, MessageConst.RESPONSE_BLOCK_WRITE, timeout=600)
+    with device.track_transfer('Writing applet', len(content)):
+        for block_request, block in frames:
+            write_message(device, block_request, timeout=600)
+            receive_message(device, MessageConst.RESPONSE_BLOCK_WRITE, timeout=600)
 
-        device.write(block, timeout=600)
-        receive_message(device, MessageConst.RESPONSE_BLOCK_WRITE_DONE, timeout=300)
+            device.write(block, timeout=600, packet_size=APPLET_DATA_PACKET_SIZE)
+            receive_message(device, MessageConst.RESPONSE_BLOCK_WRITE_DONE, timeout=600)
 
-        message = Message(MessageConst.REQUEST_PROGRAMMING_APPLET_BLOCK, [])
-        send_message(device, message, MessageConst.RESPONSE_PROGRAMMING_APPLET_BLOCK, timeout=5000)
+            write_message(device, programming_request, timeout=600)
+            receive_message(device, MessageConst.RESPONSE_PROGRAMMING_APPLET_BLOCK, timeout=5000)
 
-        offset = offset + block_size
-        remaining = remaining - block_size
+            offset = offset + len(block)
+            device.report_progress(offset, len(content))
 
+    elapsed = time() - start_time
+    logger.info(f'Applet content written in {elapsed:.1f} s, {len(content) / elapsed / 1024:.1f} KB/s')
     print('Completed writing applet content')
 
 
-class ROMSignature:
-    SYSTEM_3 = b'System 3          '
-    OS3000_SMALL_ROM = b'OS 3000 Small ROM '
-    ALPHASMART_UPDATER = b'AlphaSmart Updater'
-    SYSTEM_3_NEO = b'System 3 Neo      '
-    OS3KNEO_SMALL_ROM = b'OS 3KNeo Small ROM'
-
-
-def applet_type_to_str(applet_type):
-    mapping = {
-        AppletType.REGULAR: 'Applet program',
-        AppletType.SYSTEM_3: 'System 3',
-        AppletType.OS3000_SMALL_ROM: 'OS3000 Small ROM',
-        AppletType.ALPHASMART_UPDATER: 'Alphasmart Updater',
-        AppletType.SYSTEM_3_NEO: 'System 3 Neo',
-        AppletType.OS3KNEO_SMALL_ROM: 'OS3KNeo Small ROM'
-    }
-    if applet_type in mapping:
-        return mapping[applet_type]
-    else:
-        raise NeotoolsError(f'Invalid applet type {applet_type}')
-
-
-def classify_applet(content: bytes):
-    if int_from_buf(content, 0, 4) == SIGNATURE_START:
-        if int_from_buf(content, len(content) - 4, 4) != SIGNATURE_END:
-            raise NeotoolsError('Invalid applet')
-        else:
-            return AppletType.REGULAR
-    else:
-        sig_string = content[0x400:0x412]
-        if sig_string == ROMSignature.SYSTEM_3:
-            return AppletType.SYSTEM_3
-        elif sig_string == ROMSignature.OS3000_SMALL_ROM:
-            return AppletType.OS3000_SMALL_ROM
-        elif sig_string == ROMSignature.ALPHASMART_UPDATER:
-            return AppletType.ALPHASMART_UPDATER
-        elif sig_string == ROMSignature.SYSTEM_3_NEO:
-            return AppletType.SYSTEM_3_NEO
-        elif sig_string == ROMSignature.OS3KNEO_SMALL_ROM:
-            return AppletType.OS3KNEO_SMALL_ROM
-        else:
-            raise NeotoolsError('Unknown type of applet: ' + str(sig_string))
-
-
 def remove_applet(device, applet_id):
     logger.info(f'Removing applet {applet_id}.')
+    invalidate_applet_list(device)
     device.dialogue_start()
     message = Message(MessageConst.REQUEST_REMOVE_APPLET, [(5, 1, 4), (applet_id, 5, 2)])
     send_message(device, message, success_code=MessageConst.RESPONSE_REMOVE_APPLET)
     device.dialogue_end()
 
 
+REMOVE_APPLETS_TIMEOUT = 90  # seconds
+
+
 def remove_applets(device):
     logger.info(f'Removing applets. This may take a minute.')
+    invalidate_applet_list(device)
     device.dialogue_start()
     message = Message(MessageConst.REQUEST_ERASE_APPLETS, [])
-    send_message(device, message, success_code=MessageConst.RESPONSE_RESPONSE_ERASE_APPLETS, timeout=90000)
+    write_message(device, message.m_data)
+    with device.track_transfer('Removing applets', None, cancellable=False):
+        wait_for_response(device, MessageConst.RESPONSE_RESPONSE_ERASE_APPLETS, REMOVE_APPLETS_TIMEOUT, 'remove the applets')
     device.dialogue_end()
 
 
-def fetch_applet(device, applet_id):
+def fetch_applet(device, applet_id, verify=False, cache=None):
+    """
+    Return the content of an installed applet. A copy that was fetched before, from this
+    or another device, is returned without the transfer if its header matches the installed one.
+    With verify, the applet is read from the device anyway and replaces the cached copy.
+    """
+    header = get_applet(device, applet_id)
+    if header is None:
+        return read_applet_content(device, applet_id)
+    if cache is None:
+        cache = AppletCache()
+    cached = cache.get(header)
+    if cached is not None and not verify:
+        logger.info(f'Using the cached copy of applet {applet_id}')
+        return cached
+    content = read_applet_content(device, applet_id)
+    if cached is not None and cached != content:
+        logger.warning(f'Applet {applet_id} differs from the cached copy with the same header, replacing the copy')
+    cache.put(header, content)
+    return content
+
+
+def read_applet_content(device, applet_id):
     logger.info(f'Retrieving applet {applet_id}')
     device.dialogue_start()
 
@@ -184,7 +273,8 @@ def fetch_applet(device, applet_id):
     response = send_message(device, message, MessageConst.RESPONSE_READ_FILE)
     size = response.argument(1, 4)
 
-    content = read_extended_data(device, size)
+    with device.track_transfer('Reading applet', size):
+        content = read_extended_data(device, size)
 
     device.dialogue_end()
     return content
@@ -1,11 +1,11 @@
+import json
 import logging
-from functools import partial
+import struct
 from typing import List
 
 from neotools.applet.constants import *
 from neotools.message import Message, MessageConst, send_message, receive_message
-from neotools.util import calculate_data_checksum, NeotoolsError, data_from_buf, data_to_buf, int_from_buf, \
-    int_to_buf, string_to_buf, string_from_buf
+from neotools.util import calculate_data_checksum, ChecksumError, NeotoolsError, int_from_buf, user_cache_dir
 
 logger = logging.getLogger(__name__)
 
@@ -63,74 +63,65 @@ class AppletSettingsItem:
         self.data = data
 
     def to_raw(self):
-        data_len = 0
-        buf = []
-
-        write_data = None
+        return AppletSettingsItem.list_to_raw([self])
 
+    def data_to_raw(self):
         if self.type in [AppletSettingsType.LABEL, AppletSettingsType.DESCRIPTION]:
             # Can we update the labels???
-            data_len = len(self.data) + 1
-            write_data = partial(string_to_buf, buf, 6, len(self.data), self.data)
+            return self.data.encode() + b'\0'
         elif self.type == AppletSettingsType.OPTION:
-            data_len = len(self.data) * 2
-
-            def write_option():
-                for (i, val) in enumerate(self.data):
-                    int_to_buf(buf, 6 + i * 2, 2, val)
-
-            write_data = write_option
+            return struct.pack(f'>{len(self.data)}H', *self.data)
         elif self.type == AppletSettingsType.RANGE_32:
-            data_len = APPLET_SETTINGS_RANGE32_FORMAT['size']
-            write_data = partial(data_to_buf, APPLET_SETTINGS_RANGE32_FORMAT, buf, self.data, buf_offset=6)
+            return APPLET_SETTINGS_RANGE32.pack(self.data)
         elif self.type in [AppletSettingsType.FILE_PASSWORD, AppletSettingsType.PASSWORD_6]:
-            data_len = 6
-            write_data = partial(string_to_buf, buf, 6, 6, self.data)
+            data = self.data.encode()
+            if len(data) > 6:
+                raise ValueError('String is too long %s' % data)
+            return data.ljust(6, b'\0')
         elif self.type == AppletSettingsType.APPLET_ID:
-            data_len = 4
-            write_data = partial(int_to_buf, buf, 6, 4, self.data)
-        total_len = 6 + data_len + (data_len & 1)
-        buf = [0] * total_len
-
-        obj = self.__dict__
-        obj['length'] = data_len
-        obj['type'] = self.type.value
-        data_to_buf(APPLET_SETTINGS_FORMAT, buf, obj)
-        write_data()
+            return int.to_bytes(self.data, length=4, byteorder='big')
+        return b''
 
+    @staticmethod
+    def list_to_raw(items):
+        """Serialize the items into one contiguous buffer."""
+        header_size = APPLET_SETTINGS_HEADER.struct.size
+        buf = bytearray()
+        for item in items:
+            data = item.data_to_raw()
+            offset = len(buf)
+            data_len = len(data)
+            buf.extend(bytes(header_size))
+            APPLET_SETTINGS_HEADER.pack_into(buf, offset, AppletSettingsHeader(item.type.value, item.ident, data_len))
+            buf.extend(data)
+            if data_len & 1:
+                buf.append(0)  # Two byte alignment
         return buf
 
     @staticmethod
-    def item_from_raw(item_obj, buf):
+    def item_from_raw(header, buf, offset=0):
+        """Decode the item at the offset, where buf is usually a memoryview of all items."""
         data = None
-        item_type = AppletSettingsType(item_obj['type'])
-        del item_obj['type']
-        item_obj['item_type'] = item_type
+        item_type = AppletSettingsType(header.type)
+        data_offset = offset + APPLET_SETTINGS_HEADER.struct.size
 
         if item_type == AppletSettingsType.RANGE_32:
-            data = data_from_buf(APPLET_SETTINGS_RANGE32_FORMAT, buf[6:])
+            data = APPLET_SETTINGS_RANGE32.unpack_from(buf, data_offset)
         elif item_type == AppletSettingsType.OPTION:
-            data = []
-            offset = 0
-            while offset < item_obj['length']:
-                data.append(int_from_buf(buf, 6 + offset, 2))
-                offset = offset + 2
+            data = list(struct.unpack_from(f'>{header.length // 2}H', buf, data_offset))
         elif item_type in [AppletSettingsType.PASSWORD_6, AppletSettingsType.DESCRIPTION,
                            AppletSettingsType.FILE_PASSWORD, AppletSettingsType.LABEL]:
-            data = string_from_buf(buf, 6, item_obj['length'])
+            raw = bytes(buf[data_offset:data_offset + header.length])
+            null_index = raw.find(0)
+            data = (raw if null_index == -1 else raw[:null_index]).decode()
         elif item_type == AppletSettingsType.APPLET_ID:
-            data = int_from_buf(buf, 6, 4)
-        del item_obj['length']
-        return AppletSettingsItem(**item_obj, **{'data': data})
+            data = int_from_buf(buf, data_offset, 4)
+        return AppletSettingsItem(item_type, header.ident, data)
 
     def change_setting(self, values: List[str]):
         if self.type == AppletSettingsType.RANGE_32:
             assert len(values) == 3
-            self.data = {
-                'default': int(values[0]),
-                'min': int(values[1]),
-                'max': int(values[2])
-            }
+            self.data = AppletSettingsRange32(default=int(values[0]), min=int(values[1]), max=int(values[2]))
         if self.type == AppletSettingsType.OPTION:
             assert len(values) == 1
             ident = int(values[0])
@@ -149,27 +140,32 @@ class AppletSettingsItem:
             self.data = applet_id
 
     @staticmethod
-    def list_from_raw(buf):
+    def iter_from_raw(buf):
+        """
+        Yield the items in a single pass over the buffer, without copying it.
+        """
+        buf = memoryview(buf)
+        header_size = APPLET_SETTINGS_HEADER.struct.size
         offset = 0
-        items = []
-        while True:
-            if len(buf) < offset + 6:
-                # not even space for a single header
-                break
-            item_obj = data_from_buf(APPLET_SETTINGS_FORMAT, buf[offset:])
-            length = item_obj['length']
-            if item_obj['type'] == 0 and item_obj['ident'] == 0 and length == 0:
+        while len(buf) >= offset + header_size:
+            header = APPLET_SETTINGS_HEADER.unpack_from(buf, offset)
+            length = header.length
+            if header.type == 0 and header.ident == 0 and length == 0:
                 break
+            yield AppletSettingsItem.item_from_raw(header, buf, offset)
+            offset = offset + header_size + length + (length & 1)  # Two byte alignment
 
-            item_total_length = 6 + length + (length & 1)  # Two byte alignment
-
-            item = AppletSettingsItem.item_from_raw(item_obj, buf[offset:offset + item_total_length])
-            items.append(item)
-            offset = offset + item_total_length
-        return items
+    @staticmethod
+    def list_from_raw(buf):
+        return list(AppletSettingsItem.iter_from_raw(buf))
 
 
 def get_settings(device, applet_id, flags):
+    settings_list = AppletSettingsItem.list_from_raw(get_settings_raw(device, applet_id, flags))
+    return AppletSettings(settings_list)
+
+
+def get_settings_raw(device, applet_id, flags):
     device.dialogue_start()
     logger.info('Requesting settings for applet_id=%s, flags=%s', applet_id, flags)
     message = Message(MessageConst.REQUEST_GET_SETTINGS, [(flags, 1, 4), (applet_id, 5, 2)])
@@ -178,14 +174,100 @@ def get_settings(device, applet_id, flags):
     expected_checksum = response.argument(5, 2)
     logger.info('Retrieving settings data')
     result = device.read(response_size)
-    assert calculate_data_checksum(result) == expected_checksum
+    if calculate_data_checksum(result) != expected_checksum:
+        raise ChecksumError(f'Settings checksum error for applet_id={applet_id}')
     device.dialogue_end()
-    settings_list = AppletSettingsItem.list_from_raw(result)
-    return AppletSettings(settings_list)
+    return result
+
+
+def settings_from_raw(raw_by_flag):
+    settings = AppletSettings([])
+    for raw in raw_by_flag.values():
+        settings.merge_settings(AppletSettings(AppletSettingsItem.list_from_raw(raw)))
+    return settings
+
+
+# The system applet flags that return the labels and descriptions of the settings.
+SYSTEM_SETTINGS_FLAGS = [0, 7, 15]
+
+
+def os_version_key(version):
+    """Identify the OS by the revision and build date from get_version."""
+    return f'{version["revision_major"]}.{version["revision_minor"]} {version["build_date"]}'
+
+
+def _system_settings_cache_path():
+    return user_cache_dir() / 'system_settings.json'
+
+
+def _read_system_settings_cache():
+    try:
+        with open(_system_settings_cache_path()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def load_system_settings(os_version):
+    """Return the cached system settings for the OS version, or None."""
+    cached = _read_system_settings_cache().get(os_version)
+    if cached is None:
+        return None
+    return settings_from_raw({flag: bytes.fromhex(raw) for flag, raw in cached.items()})
+
+
+def get_system_settings(device, os_version):
+    """
+    The system settings have the labels and descriptions for all applets. They only
+    change with the OS, so they are cached on disk by the OS version.
+    """
+    settings = load_system_settings(os_version)
+    if settings is not None:
+        return settings
+    raw_by_flag = {flag: get_settings_raw(device, AppletIds.SYSTEM, flag) for flag in SYSTEM_SETTINGS_FLAGS}
+    cache = _read_system_settings_cache()
+    cache[os_version] = {str(flag): raw.hex() for flag, raw in raw_by_flag.items()}
+    try:
+        with open(_system_settings_cache_path(), 'w') as f:
+            json.dump(cache, f)
+    except OSError as e:
+        logger.warning(f'Failed to cache the system settings: {e}')
+    return settings_from_raw(raw_by_flag)
+
+
+def label_settings(settings, system_settings):
+    settings.labels.update(system_settings.labels)
+    settings.descriptions.update(system_settings.descriptions)
+    return settings
+
+
+def save_settings_dump(path, os_version, applet_id, raw_by_flag):
+    dump = {
+        'os_version': os_version,
+        'applet_id': applet_id,
+        'flags': {str(flag): raw.hex() for flag, raw in raw_by_flag.items()}
+    }
+    with open(path, 'w') as f:
+        json.dump(dump, f, indent=2)
+
+
+def settings_from_dump(path):
+    """Label the settings from a dump made by get-settings, using the cached system settings."""
+    with open(path) as f:
+        dump = json.load(f)
+    system_settings = load_system_settings(dump['os_version'])
+    if system_settings is None:
+        raise NeotoolsError(f'System settings for OS {dump["os_version"]} are not cached. '
+                            'Run get-settings on a device with this OS first.')
+    settings = settings_from_raw({flag: bytes.fromhex(raw) for flag, raw in dump['flags'].items()})
+    return label_settings(settings, system_settings)
 
 
 def set_settings(device, applet_id, settings):
-    settings_buf = settings.to_raw()
+    """Write a settings item, or a list of them."""
+    if isinstance(settings, AppletSettingsItem):
+        settings = [settings]
+    settings_buf = AppletSettingsItem.list_to_raw(settings)
     checksum = calculate_data_checksum(settings_buf)
     device.dialogue_start()
     logger.info('Requesting to write settings for applet_id=%s', applet_id)
@@ -0,0 +1,195 @@
+"""
+Run a sequence of operations over a single device connection.
+
+Each operation is a JSON object on its own line, for example:
+
+    {"op": "info"}
+    {"op": "write", "file": "1", "path": "notes.txt"}
+    {"op": "read", "file": "intro", "charmap": "ua-mac"}
+    {"op": "set-settings", "applet_id": 0, "ident": 16388, "value": [5, 4, 59]}
+
+The parameters match the options of the corresponding CLI commands.
+"""
+import inspect
+import json
+import logging
+
+from usb.core import USBError
+
+from neotools import commands
+from neotools.applet import manager as applet_manager
+from neotools.applet.applet import read_applet_list
+from neotools.applet.constants import AppletIds
+from neotools.device import Device
+from neotools.util import NeotoolsError, json_default
+
+logger = logging.getLogger(__name__)
+
+
+def parse_int(value):
+    if isinstance(value, int):
+        return value
+    try:
+        return int(value, 0)
+    except (TypeError, ValueError):
+        raise NeotoolsError(f'{value!r} is not a valid integer')
+
+
+def file_applet_id(applet_id):
+    return AppletIds.ALPHAWORD if applet_id is None else parse_int(applet_id)
+
+
+def read(device, file, applet_id=None, path=None, format=None, charmap=None, charmap_path=None):
+    applet_id = file_applet_id(applet_id)
+    file_attrs = commands.require_file(device, applet_id, str(file))
+    character_map = commands.get_character_map(applet_id, charmap, charmap_path)
+    text = commands.read_text(device, applet_id, file_attrs, character_map)
+    if path:
+        return {'path': str(commands.write_file_with_format(file_attrs, text, path, format))}
+    return {'text': text}
+
+
+def write(device, file, text=None, path=None, applet_id=None, charmap=None, charmap_path=None):
+    if (text is None) == (path is None):
+        raise NeotoolsError('Pass either text or path')
+    if path is not None:
+        with open(path) as f:
+            text = f.read()
+    applet_id = file_applet_id(applet_id)
+    character_map = commands.get_character_map(applet_id, charmap, charmap_path)
+    commands.write_text(device, applet_id, str(file), text, character_map)
+
+
+def clear(device, file, applet_id=None):
+    commands.clear_file_by_name_or_space(device, file_applet_id(applet_id), str(file))
+
+
+def write_many(device, files, applet_id=None, charmap=None, charmap_path=None):
+    if not isinstance(files, dict):
+        raise NeotoolsError('files must be an object of file -> {text|path}')
+    texts = []
+    for target, params in files.items():
+        if not isinstance(params, dict) or ('text' in params) == ('path' in params):
+            raise NeotoolsError(f'Pass either text or path for the file {target}')
+        if 'path' in params:
+            with open(params['path']) as f:
+                texts.append((str(target), f.read()))
+        else:
+            texts.append((str(target), params['text']))
+    applet_id = file_applet_id(applet_id)
+    character_map = commands.get_character_map(applet_id, charmap, charmap_path)
+    commands.write_texts(device, applet_id, texts, character_map)
+
+
+def clear_many(device, files, applet_id=None):
+    commands.clear_files_by_name_or_space(device, file_applet_id(applet_id), [str(f) for f in files])
+
+
+def list_files(device, applet_id=None, verbose=False, all_applets=False):
+    if all_applets:
+        return commands.list_all_file_attributes(device, verbose)
+    return commands.list_file_attributes(device, file_applet_id(applet_id), verbose)
+
+
+def get_settings(device, applet_id, flags=()):
+    return commands.read_settings(device, parse_int(applet_id), [parse_int(flag) for flag in flags])
+
+
+def set_settings(device, applet_id, ident, value):
+    values = value if isinstance(value, list) else [value]
+    commands.write_settings(device, parse_int(applet_id), parse_int(ident), [str(v) for v in values])
+
+
+def info(device):
+    return commands.get_system_info(device)
+
+
+def list_applets(device):
+    return read_applet_list(device)
+
+
+def fetch_applet(device, applet_id, path, verify=False):
+    content = applet_manager.fetch_applet(device, parse_int(applet_id), verify)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def install_applet(device, path, force=False):
+    with open(path, 'rb') as f:
+        content = f.read()
+    applet_manager.install_applet(device, content, force)
+
+
+OPERATIONS = {
+    'read': read,
+    'write': write,
+    'clear': clear,
+    'write-many': write_many,
+    'clear-many': clear_many,
+    'list': list_files,
+    'get-settings': get_settings,
+    'set-settings': set_settings,
+    'info': info,
+    'list-applets': list_applets,
+    'fetch-applet': fetch_applet,
+    'install-applet': install_applet,
+}
+
+# Errors that fail a single operation, but leave the session usable.
+OPERATION_ERRORS = (NeotoolsError, USBError, OSError)
+
+
+def run_operation(device, op, params):
+    operation = OPERATIONS.get(op)
+    if operation is None:
+        raise NeotoolsError(f'Unknown operation {op}. Available operations: {", ".join(OPERATIONS)}')
+    try:
+        inspect.signature(operation).bind(device, **params)
+    except TypeError as e:
+        raise NeotoolsError(f'Invalid parameters for {op}: {e}')
+    return operation(device, **params)
+
+
+def error_to_dict(error):
+    return {'type': type(error).__name__, 'message': str(error)}
+
+
+def parse_requests(lines):
+    requests = []
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            raise NeotoolsError(f'Invalid JSON on line {line_number}: {e}')
+        if not isinstance(request, dict) or 'op' not in request:
+            raise NeotoolsError(f'Line {line_number} must be a JSON object with the key "op"')
+        requests.append(request)
+    return requests
+
+
+def run_batch(lines, output, keep_going=False):
+    """
+    Run the operations and write a JSON result per line to output.
+    Returns True if all operations succeeded.
+    """
+    requests = parse_requests(lines)
+    succeeded = True
+    with Device.connect() as device:
+        for step, request in enumerate(requests, 1):
+            params = dict(request)
+            op = params.pop('op')
+            response = {'step': step, 'op': op}
+            try:
+                response['result'] = run_operation(device, op, params)
+            except OPERATION_ERRORS as e:
+                logger.debug('Operation failed', exc_info=True)
+                response['error'] = error_to_dict(e)
+                succeeded = False
+            output.write(json.dumps(response, default=json_default) + '\n')
+            output.flush()
+            if not succeeded and not keep_going:
+                break
+    return succeeded
@@ -0,0 +1,102 @@
+"""
+Measurements of a particular device, cable and hub: the round trip of hello,
+the throughput of file reads and writes of several sizes, and the mode flip.
+"""
+import logging
+import statistics
+from time import perf_counter
+
+from neotools import file
+from neotools.applet.constants import AppletIds
+from neotools.util import NeotoolsError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZES = [1024, 4096, 16384]
+DEFAULT_ITERATIONS = 10
+
+
+def percentiles(samples):
+    """Summary of the samples, in the same units."""
+    samples = sorted(samples)
+    if len(samples) == 1:
+        p50 = p90 = p99 = samples[0]
+    else:
+        quantiles = statistics.quantiles(samples, n=100, method='inclusive')
+        p50, p90, p99 = quantiles[49], quantiles[89], quantiles[98]
+    return {
+        'count': len(samples),
+        'min': samples[0],
+        'p50': p50,
+        'p90': p90,
+        'p99': p99,
+        'max': samples[-1],
+        'mean': statistics.fmean(samples)
+    }
+
+
+def time_calls(f, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = perf_counter()
+        f()
+        samples.append(perf_counter() - start)
+    return samples
+
+
+def bench_hello(device, iterations):
+    device.dialogue_start()
+    samples = time_calls(device.hello, iterations)
+    device.dialogue_end()
+    return {'seconds': percentiles(samples)}
+
+
+def transfer_summary(samples, size):
+    summary = {'size': size, 'seconds': percentiles(samples)}
+    summary['bytes_per_second'] = size / summary['seconds']['p50']
+    return summary
+
+
+def bench_file_transfers(device, applet_id, file_index, sizes, iterations):
+    """Write and read back the file with each size."""
+    writes = []
+    reads = []
+    for size in sizes:
+        data = (b'neotools bench\r' * (size // 15 + 1))[:size]
+        device.dialogue_start()
+        samples = time_calls(lambda: file.raw_write_file(device, data, applet_id, file_index, True), iterations)
+        device.dialogue_end()
+        writes.append(transfer_summary(samples, size))
+
+        attrs = file.get_file_attributes(device, applet_id, file_index)
+        device.dialogue_start()
+        samples = time_calls(lambda: file.raw_read_file(device, applet_id, attrs, True), iterations)
+        device.dialogue_end()
+        reads.append(transfer_summary(samples, size))
+    return writes, reads
+
+
+def restore_file(device, applet_id, attrs, data):
+    """Write back the data and the attributes of a file, as creating a file does for a new one."""
+    logger.info('Restoring the file %s', attrs.name)
+    file.apply_file_changes(device, applet_id, [('create', attrs, data)])
+
+
+def run_bench(device, file_name_or_space, iterations=DEFAULT_ITERATIONS, sizes=None, applet_id=AppletIds.ALPHAWORD):
+    """
+    The transfers use an existing file of the applet, as there is no command to delete
+    a file. Its data and attributes are saved first and restored at the end.
+    """
+    if sizes is None:
+        sizes = DEFAULT_SIZES
+    attrs = file.get_file_by_name_or_space(device, applet_id, file_name_or_space)
+    if attrs is None:
+        raise NeotoolsError('File not found')
+    result = {'hello': bench_hello(device, iterations)}
+    original = file.read_file(device, applet_id, attrs)
+    try:
+        result['write'], result['read'] = bench_file_transfers(device, applet_id, attrs.file_index, sizes, iterations)
+    finally:
+        restore_file(device, applet_id, attrs, original)
+    result['file'] = {'name': attrs.name, 'file_index': attrs.file_index, 'size': len(original)}
+    return result
@@ -1,12 +1,13 @@
 import json
 import logging
-from enum import Enum
+import os
+import sys
 from functools import partial
 
 import click
 
-from neotools import commands
 from neotools import constants
+from neotools.util import command_decorator, json_default
 
 logger = logging.getLogger(__name__)
 
@@ -43,23 +44,39 @@ charmap_path_option = partial(click.option, '--charmap_path', type=click.Path(ex
 
 @click.group()
 @click.option('--verbose', '-v', default=False, is_flag=True)
+@click.option('--metrics-file', type=click.Path(dir_okay=False, writable=True),
+              help='On exit, write counters of the device communication to a file in the OpenMetrics format')
+@click.option('--progress/--no-progress', default=None,
+              help='Show a progress bar for long transfers. By default, when the output is a terminal.')
 @click.version_option()
 @click.pass_context
-def cli(ctx, verbose):
+def cli(ctx, verbose, metrics_file, progress):
     """
-    For scripts that issue multiple commands, use the mode command to
-    avoid repeated initialization.
+    For scripts that issue multiple commands, use the batch command to run them
+    in one session, or the mode command to avoid repeated initialization.
+
+    Press Ctrl-C once during a transfer to cancel it at the next block,
+    which leaves the device in a known state.
     """
     ctx.ensure_object(dict)
     ctx.obj['verbose'] = verbose
     if verbose:
         logging.basicConfig(level=logging.DEBUG)
+    if progress is None:
+        progress = sys.stderr.isatty()
+    if progress:
+        from neotools.progress import ProgressBar
+        ProgressBar(sys.stderr).install()
+    if metrics_file:
+        from neotools import metrics
+        ctx.call_on_close(partial(metrics.REGISTRY.write, metrics_file))
 
 
 @cli.command('mode', help='Neo keyboard/comms mode. Mostly useful for scripting where the tool is called many times.')
 @click.option('--keyboard', 'target_mode', flag_value='keyboard')
 @click.option('--comms', 'target_mode', flag_value='comms')
 def mode(target_mode):
+    from neotools import commands
     if target_mode is None:
         commands.get_mode()
     if target_mode == 'comms':
@@ -68,11 +85,82 @@ def mode(target_mode):
         commands.flip_to_keyboard()
 
 
+@cli.command('batch')
+@click.argument('script', type=click.File('r'), default='-')
+@click.option('--keep-going', '-k', default=False, is_flag=True, help='Continue after a failed operation')
+def run_batch(script, keep_going):
+    """
+    Run operations from a JSON-lines SCRIPT, or stdin, over one connection.
+    Prints a JSON result per line.
+
+    Each line is an object with the key "op" and the parameters of the operation.
+    The operations are read, write, clear, write-many, clear-many, list, get-settings,
+    set-settings, info, list-applets, fetch-applet, install-applet.
+
+    \b
+    {"op": "write", "file": "1", "path": "notes.txt"}
+    {"op": "write-many", "files": {"1": {"path": "notes.txt"}, "intro": {"text": "Hello"}}}
+    {"op": "read", "file": "1"}
+    {"op": "set-settings", "applet_id": 0, "ident": 16388, "value": [5, 4, 59]}
+    """
+    from neotools import batch
+    succeeded = command_decorator(batch.run_batch)(script, click.get_text_stream('stdout'), keep_going)
+    if not succeeded:
+        sys.exit(1)
+
+
+@cli.command('serve')
+@click.option('--stdio', is_flag=True, required=True, help='Communicate over stdin and stdout')
+@click.option('--metrics-port', type=click.IntRange(min=0, max=65535),
+              help='Serve the OpenMetrics counters of the device communication at http://localhost:PORT/metrics')
+def serve(stdio, metrics_port):
+    """
+    Serve JSON-lines requests over one device session, for integration with other tools.
+
+    \b
+    --> {"id": 1, "method": "read", "params": {"file": "1"}}
+    <-- {"id": 1, "result": {"text": "..."}}
+
+    The methods are the operations of the batch command. Long transfers send
+    progress events with the id of the request before the response.
+    """
+    from neotools import server
+    if metrics_port is not None:
+        from neotools import metrics
+        metrics.serve_metrics(metrics_port)
+    command_decorator(server.serve_stdio)(click.get_text_stream('stdin'), click.get_text_stream('stdout'))
+
+
 @cli.group(help='Manage files for AlphaWord and other applets.')
 def files():
     pass
 
 
+@cli.group(help='Analyze USB captures of the device, such as the ones in usb_pcap.')
+def pcap():
+    pass
+
+
+@pcap.command('decode')
+@click.argument('paths', type=click.Path(exists=True, dir_okay=False), nargs=-1, required=True)
+@click.option('--jobs', '-j', type=click.IntRange(min=1), help='Number of parallel processes. Defaults to the CPU count.')
+def decode_pcap(paths, jobs):
+    """
+    Decode pcapng captures made with usbmon into transcripts of ASM messages.
+    Each message, command and data transfer is printed as a JSON line with its
+    time in seconds from the start of the capture, and the responses have the
+    latency from the request.
+    """
+    from neotools import pcap as pcap_decoder
+
+    def print_transcripts():
+        for records in pcap_decoder.decode_captures(paths, jobs):
+            for record in records:
+                print(json.dumps(record))
+
+    command_decorator(print_transcripts)()
+
+
 @cli.group()
 def applets():
     """ Inspect applets and manage their settings. """
@@ -82,25 +170,44 @@ def applets():
 @applets.command('list')
 def list_applets():
     """ Get a list of installed applets. """
+    from neotools import commands
     applet_list = commands.list_applets()
-    print(json.dumps(applet_list, indent=2))
+    print(json.dumps(applet_list, indent=2, default=json_default))
 
 
 @applets.command('get-settings')
 @click.argument('applet_id', type=BASED_INT)
 @click.argument('flag', type=int, nargs=-1)
-def applet_get_settings(applet_id, flag):
+@click.option('--dump', 'dump_path', type=click.Path(dir_okay=False, writable=True),
+              help='Save the raw settings to a file that can be read with show-settings')
+def applet_get_settings(applet_id, flag, dump_path):
     """
     List settings of an applet. Note that it is possible for the call to return
     different subsets of settings on multiple runs.
 
     The meaning of the flag depends on the applet and is not documented.
     The values that commonly give non-empty results are 0, 7, 15.
+
+    The labels of the settings are cached per OS version, so they are read
+    from the device only once.
     """
-    settings = commands.applet_read_settings(applet_id, flag)
+    from neotools import commands
+    settings = commands.applet_read_settings(applet_id, flag, dump_path)
     print(json.dumps(settings, indent=2, default=json_default))
 
 
+@applets.command('show-settings')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def applet_show_settings(path):
+    """
+    List settings saved with get-settings --dump. This does not need a device,
+    but the labels for the OS version of the dump must be cached.
+    """
+    from neotools.applet.settings import settings_from_dump
+    settings = command_decorator(settings_from_dump)(path)
+    print(json.dumps(settings.to_dict(), indent=2, default=json_default))
+
+
 @applets.command('set-settings',
                  short_help='Update settings. Use this at your own risk - invalid settings' +
                             ' may disrupt work of an applet or the device.')
@@ -126,19 +233,44 @@ def applet_set_settings(applet_id, ident, value):
     * Set password for an AlphaWord file: applets set-settings 40960 32790 write2
     * Delete all AlphaWord files: applets set-settings 40960 32771 4097
     """
+    from neotools import commands
     commands.applet_write_settings(applet_id, ident, value)
 
 
+@applets.command('apply-profile')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def applet_apply_profile(path):
+    """
+    Update settings of several applets to the values in a profile. Only the
+    settings that differ from the device are written. Use this at your own risk,
+    as with set-settings.
+
+    \b
+    {"applets": {"0": {"16388": [10, 4, 59], "16400": [4097]}}}
+    """
+    from neotools import commands
+    changes = commands.apply_settings_profile(path)
+    if changes:
+        print(json.dumps(changes, indent=2, default=json_default))
+    else:
+        print('The device already matches the profile')
+
+
 @applets.command('fetch')
 @click.argument('applet_id', type=BASED_INT)
 @click.argument('path', type=click.Path())
-def fetch_applet(applet_id, path):
+@click.option('--verify', default=False, is_flag=True, help='Read the applet from the device even if it is cached')
+def fetch_applet(applet_id, path, verify):
     """
     Fetch the applet file from the device and write to file.
 
     Get a list of applets to find out the ids. The id 0 would fetch the firmware ROM.
+
+    The fetched applets are cached. An applet with the same id, version and size
+    as a cached one, from this or another device, is not transferred again.
     """
-    commands.fetch_applet(applet_id, path)
+    from neotools import commands
+    commands.fetch_applet(applet_id, path, verify)
 
 
 @applets.command('remove-all')
@@ -147,6 +279,7 @@ def remove_applets(yes):
     """ Delete all applets from the device. """
     if not yes:
         click.confirm(text='Are you sure you want to remove all applets?', abort=True)
+    from neotools import commands
     commands.remove_applets()
 
 
@@ -159,32 +292,98 @@ def remove_applet(applet_id, yes):
     if not yes:
         click.confirm(text='Are you sure you want to remove applet?' +
                            'It will not free up the space and is meant only for development.', abort=True)
+    from neotools import commands
     commands.remove_applet(applet_id)
 
 
-@applets.command('inspect', short_help="Display details for an applet file")
-@click.argument('path', type=click.Path(exists=True, dir_okay=False))
-def install_applet(path):
-    applet_info = commands.inspect_applet(path)
-    print(json.dumps(applet_info, indent=2))
+@applets.command('inspect', short_help="Display details for applet files")
+@click.argument('paths', type=click.Path(exists=True), nargs=-1, required=True)
+@click.option('--jobs', '-j', type=click.IntRange(min=1), help='Number of parallel processes. Defaults to the CPU count.')
+def inspect_applet(paths, jobs):
+    """
+    Display details for an applet file. For several files or directories,
+    the directories are searched recursively, the files are inspected in parallel,
+    and a JSON result per file is printed on each line.
+    """
+    # Inspection does not need the device, so it avoids loading the USB modules.
+    from neotools.applet import inspect
+    if len(paths) == 1 and not os.path.isdir(paths[0]):
+        applet_info = command_decorator(inspect.inspect_applet_file)(paths[0])
+        print(json.dumps(applet_info, indent=2, default=json_default))
+        return
+    for applet_info in inspect.inspect_applet_files(paths, jobs):
+        print(json.dumps(applet_info, default=json_default), flush=True)
+
+
+@applets.command('extract')
+@click.argument('rom_path', type=click.Path(exists=True, dir_okay=False))
+@click.argument('output_dir', type=click.Path(file_okay=False))
+def extract_applets(rom_path, output_dir):
+    """
+    Extract the applets embedded in a ROM image, such as the one
+    fetched with the applet id 0, into a directory.
+    """
+    from neotools.applet import inspect
+    result = command_decorator(inspect.extract_applets)(rom_path, output_dir)
+    print(json.dumps(result, indent=2))
 
 
 @applets.command('install', short_help="Experimental. Install an applet. Use this at your own risk.")
-@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.argument('applets', nargs=-1, required=True)
+@click.option('--version', help='Version of the applet to look up in the index, for example 3.4')
 @click.option('--force', '-f', default=False, is_flag=True, help='Skip check if the applet exists')
 @click.option('--yes', '-y', default=False, is_flag=True, help='No confirmation prompt')
-def install_applet(path, force, yes):
+def install_applet(applets, version, force, yes):
+    """
+    Install applets from files. Each of APPLETS is a path, or an applet id or name
+    that is looked up in the index of applet files, see the index command.
+
+    Several applets are installed in one session. If they do not fit on the
+    device together, nothing is written.
+    """
     if not yes:
         click.confirm(text='Are you sure you want to install an applet? ' +
                            'This is an experimental feature.', abort=True)
-    commands.install_applet(path, force)
+    from neotools import commands
+    commands.install_applets(applets, force, version)
+
+
+@applets.command('index')
+@click.argument('directories', type=click.Path(exists=True, file_okay=False), nargs=-1)
+@click.option('--remove', default=False, is_flag=True, help='Remove the directories from the index')
+def index_applets(directories, remove):
+    """
+    Add directories with applet files to the local index and refresh it.
+    Only new and changed files are read.
+    """
+    from neotools.applet import catalog
+    result = command_decorator(catalog.index_directories)(directories, remove)
+    print(json.dumps(result, indent=2))
+
+
+@applets.command('find')
+@click.argument('applet')
+@click.option('--version', help='Version of the applet, for example 3.4')
+def find_applets(applet, version):
+    """ Find applet files in the index by applet id or name. """
+    from neotools.applet import catalog
+    result = command_decorator(catalog.find_applets)(applet, version)
+    print(json.dumps(result, indent=2))
 
 
 @files.command("list")
 @applet_id_option()
 @click.option('--verbose', '-v', default=False, is_flag=True, help='All file attributes')
-def list_all_files(applet_id, verbose):
-    files_list = commands.list_files(applet_id, verbose)
+@click.option('--all', 'all_applets', default=False, is_flag=True, help='Files of all applets')
+def list_all_files(applet_id, verbose, all_applets):
+    """
+    List files of an applet, AlphaWord by default. With --all, list the files
+    of every applet that has them, grouped by applet.
+    """
+    if all_applets and applet_id is not None:
+        raise click.UsageError('--all and --applet-id cannot be used together')
+    from neotools import commands
+    files_list = commands.list_files(applet_id, verbose, all_applets)
     print(json.dumps(files_list, indent=2, default=json_default))
 
 
@@ -196,6 +395,7 @@ def list_all_files(applet_id, verbose):
 @charmap_option()
 @charmap_path_option()
 def read_file(file_name_or_space, applet_id, path, format_, charmap, charmap_path):
+    from neotools import commands
     commands.read_file(applet_id, file_name_or_space, path, format_, charmap, charmap_path)
 
 
@@ -206,6 +406,7 @@ def read_file(file_name_or_space, applet_id, path, format_, charmap, charmap_pat
 @charmap_option()
 @charmap_path_option()
 def read_all_files(applet_id, path, format_, charmap, charmap_path):
+    from neotools import commands
     commands.read_all_files(applet_id, path, format_, charmap, charmap_path)
 
 
@@ -216,13 +417,105 @@ def read_all_files(applet_id, path, format_, charmap, charmap_path):
 @charmap_option()
 @charmap_path_option()
 def write_file(path, file_name_or_space, applet_id, charmap, charmap_path):
+    from neotools import commands
     contents = open(path).read()
     commands.write_file(applet_id, file_name_or_space, contents, charmap, charmap_path)
 
 
+@files.command('write-many')
+@applet_id_option()
+@click.argument('mappings', nargs=-1, required=True)
+@charmap_option()
+@charmap_path_option()
+def write_many_files(mappings, applet_id, charmap, charmap_path):
+    """
+    Write several files in one session. Each of MAPPINGS is FILE=PATH, where FILE
+    is a file name or space. The missing files are created. Nothing is written
+    if the files do not fit on the device together.
+
+    \b
+    neotools files write-many 1=welcome.txt 2=rubric.txt notes=notes.txt
+    """
+    texts = []
+    for mapping in mappings:
+        target, separator, path = mapping.partition('=')
+        if not separator or not target or not path:
+            raise click.BadParameter(f'{mapping!r} is not in the form FILE=PATH', param_hint='MAPPINGS')
+        try:
+            with open(path) as f:
+                texts.append((target, f.read()))
+        except OSError as e:
+            raise click.BadParameter(f'Cannot read {path}: {e.strerror}', param_hint='MAPPINGS')
+    from neotools import commands
+    commands.write_files(applet_id, texts, charmap, charmap_path)
+
+
+@files.command('clear-many')
+@applet_id_option()
+@click.argument('files_names_or_spaces', nargs=-1, required=True)
+def clear_many_files(files_names_or_spaces, applet_id):
+    """
+    Clear several files, given by names or spaces, in one session.
+    Nothing is cleared if any of the files does not exist.
+    """
+    from neotools import commands
+    commands.clear_files(applet_id, list(files_names_or_spaces))
+
+
+@cli.command('watch')
+@applet_id_option()
+@click.option('--path', '-p', type=click.Path(file_okay=False, writable=True), required=True,
+              help='Directory for the folders of the devices')
+@click.option('--jobs', '-j', type=click.IntRange(min=1), default=4, help='Number of devices processed at once')
+@format_option()
+@charmap_option()
+@charmap_path_option()
+@click.option('--metrics-port', type=click.IntRange(min=0, max=65535),
+              help='Serve the OpenMetrics counters of the device communication at http://localhost:PORT/metrics')
+def watch_devices(applet_id, path, jobs, format_, charmap, charmap_path, metrics_port):
+    """
+    Harvest the files of every device as it is plugged in. Each device is switched
+    to comms mode, its files are read into a new folder named by the time and the USB
+    ports, and it is restarted in keyboard mode. A JSON line is printed per device.
+
+    Unplug a device a few seconds after it restarts, before plugging the next one into
+    the same port. Press Ctrl-C to stop after the devices in progress.
+    """
+    from neotools import watch
+    if metrics_port is not None:
+        from neotools import metrics
+        metrics.serve_metrics(metrics_port)
+    def print_result(result):
+        print(json.dumps(result), flush=True)
+
+    command_decorator(watch.watch)(path, print_result, jobs, applet_id, format_, charmap, charmap_path)
+
+
+@cli.command('bench')
+@applet_id_option()
+@click.option('--file', '-f', 'file_name_or_space', required=True,
+              help='Name or space of an existing file for the transfers. Its data is restored at the end.')
+@click.option('--iterations', '-n', type=click.IntRange(min=1), default=10, help='Number of runs of each measurement')
+@click.option('--size', '-s', 'sizes', type=click.IntRange(min=1), multiple=True,
+              help='Size of the file transfers in bytes. Can be repeated. Defaults to 1024, 4096 and 16384.')
+def benchmark(applet_id, file_name_or_space, iterations, sizes):
+    """
+    Measure the device: hello round trip, file write and read throughput,
+    and the time to connect, including the flip to comms mode.
+    The times are in seconds with percentiles.
+
+    The transfers overwrite an existing file, which is saved first and restored
+    at the end, also when a measurement fails. No file is created.
+    """
+    from neotools import commands
+    result = commands.benchmark(file_name_or_space, iterations, list(sizes) or None, applet_id)
+    print(json.dumps(result, indent=2))
+
+
 @cli.command('info')
 def system_info():
     """ General system information """
+    from neotools import commands
     info = commands.system_info()
     print(json.dumps(info, indent=2))
 
@@ -231,15 +524,6 @@ def system_info():
 @applet_id_option()
 @file_name_or_space_arg()
 def clear_file(applet_id, file_name_or_space):
+    from neotools import commands
     commands.clear_file(applet_id, file_name_or_space)
 
-
-def json_default(val):
-    if isinstance(val, Enum):
-        return val.name
-    elif isinstance(val, bytes):
-        return str(val)[2:-1]
-    elif isinstance(val, object) and hasattr(val, '__dict__'):
-        return val.__dict__
-    else:
-        return str(val)
@@ -1,35 +1,27 @@
+import copy
+import json
 import logging
+import os
 import sys
 from datetime import datetime
 from pathlib import Path
+from time import perf_counter
 
-from neotools import file
-from neotools.applet.applet import AppletIds, read_applet_list
-from neotools.applet.settings import get_settings, AppletSettingsType, set_settings, AppletSettings
+from neotools import bench, file
+from neotools.applet.applet import AppletIds, get_applet, read_applet_list
+from neotools.applet.settings import get_settings, AppletSettings, AppletSettingsType, set_settings, get_settings_raw, \
+    get_system_settings, label_settings, os_version_key, save_settings_dump, settings_from_raw, SYSTEM_SETTINGS_FLAGS
 from neotools.applet import manager as applet_manager
+from neotools.applet.catalog import AppletCatalog
 from neotools.device import Device, HID_PRODUCT_ID, COM_PRODUCT_ID, get_version, get_available_space
-from neotools.text_file import export_text_from_neo, import_text_to_neo, read_character_map_file, character_map_name_to_filepath
-from neotools.util import NeotoolsError
+from neotools.text_file import export_text_from_neo, import_text_to_neo, read_character_map_file, \
+    character_map_name_to_filepath, NeoIncrementalDecoder
+from neotools.applet.inspect import inspect_applet_file
+from neotools.util import NeotoolsError, command_decorator
 
 logger = logging.getLogger(__name__)
 
 
-def command_decorator(f):
-    def new_func(*args, **kwargs):
-        try:
-            result = f(*args, **kwargs)
-        except NeotoolsError as e:
-            if logger.level == logging.DEBUG:
-                logger.exception(e)
-            else:
-                logger.error(e)
-            sys.exit(1)
-        return result
-
-    from functools import update_wrapper
-    return update_wrapper(new_func, f)
-
-
 @command_decorator
 def flip_to_communicator():
     with Device.connect(flip_to_comms=True, dispose=False):
@@ -81,6 +73,13 @@ def get_character_map(applet_id, character_map_name, character_map_path):
     return None
 
 
+def require_file(device, applet_id, file_name_or_space):
+    file_attrs = file.get_file_by_name_or_space(device, applet_id, file_name_or_space)
+    if file_attrs is None:
+        raise NeotoolsError('Text file with name or space %s does not exist' % file_name_or_space)
+    return file_attrs
+
+
 def write_file_with_format(file_attrs, text, path, name_format):
     name_format = name_format or '{name}.txt'
     date = datetime.now()
@@ -90,6 +89,7 @@ def write_file_with_format(file_attrs, text, path, name_format):
     with open(file_path, mode='w') as f:
         logger.info('Writing file path=%s size=%s', file_path, len(text))
         f.write(text)
+    return file_path
 
 
 @command_decorator
@@ -98,16 +98,20 @@ def read_file(applet_id, file_name_or_space, path, name_format, character_map_na
         applet_id = AppletIds.ALPHAWORD
 
     with Device.connect() as device:
-        file_attrs = file.get_file_by_name_or_space(device, applet_id, file_name_or_space)
-        if file_attrs is None:
-            raise NeotoolsError('Text file with name or space %s does not exist' % file_name_or_space)
-
+        file_attrs = require_file(device, applet_id, file_name_or_space)
         character_map = get_character_map(applet_id, character_map_name, character_map_path)
-        text = read_text(device, applet_id, file_attrs, character_map)
         if path:
+            text = read_text(device, applet_id, file_attrs, character_map)
             write_file_with_format(file_attrs, text, path, name_format)
+        elif applet_id == AppletIds.ALPHAWORD:
+            # Print the text as the blocks arrive instead of waiting for the whole file.
+            decoder = NeoIncrementalDecoder(character_map=character_map)
+            for block in file.iter_read_file(device, applet_id, file_attrs):
+                sys.stdout.write(decoder.decode(block))
+                sys.stdout.flush()
+            print(decoder.decode(b'', final=True))
         else:
-            print(text)
+            print(read_text(device, applet_id, file_attrs, character_map))
 
 
 @command_decorator
@@ -132,96 +136,272 @@ def remove_applet(applet_id):
 
 @command_decorator
 def inspect_applet(applet_path):
-    f = open(applet_path, 'rb')
-    content = f.read()
-    f.close()
-    return applet_manager.inspect_applet(content)
+    return inspect_applet_file(applet_path)
+
+
+@command_decorator
+def install_applet(applet, force, version=None):
+    install_applets([applet], force, version)
 
 
 @command_decorator
-def install_applet(applet_path, force):
+def install_applets(applets, force, version=None):
+    if version is not None and len(applets) > 1:
+        raise NeotoolsError('The version can be passed only for a single applet')
+    contents = []
+    for applet in applets:
+        with open(resolve_applet_path(applet, version), 'rb') as f:
+            contents.append(f.read())
     with Device.connect() as device:
-        f = open(applet_path, 'rb')
-        content = f.read()
-        f.close()
-        return applet_manager.install_applet(device, content, force)
+        return applet_manager.install_applets(device, contents, force)
+
+
+def resolve_applet_path(applet, version=None):
+    """The applet is either a path, or an applet id or name to look up in the applet index."""
+    if version is None and os.path.isfile(applet):
+        return applet
+    with AppletCatalog() as catalog:
+        catalog.refresh()
+        return catalog.resolve(applet, version)
 
 
 @command_decorator
-def fetch_applet(applet_id, path):
+def fetch_applet(applet_id, path, verify=False):
     with Device.connect() as device:
-        content = applet_manager.fetch_applet(device, applet_id)
+        content = applet_manager.fetch_applet(device, applet_id, verify)
         with open(path, 'wb') as f:
             f.write(content)
 
 
 @command_decorator
-def list_files(applet_id, verbose):
+def list_files(applet_id, verbose, all_applets=False):
     if applet_id is None:
         applet_id = AppletIds.ALPHAWORD
     with Device.connect() as device:
-        files = file.list_files(device, applet_id)
-        if not verbose:
-            files = [{'name': f.name, 'space': f.space, 'alloc_size': f.alloc_size} for f in files]
-        return files
+        if all_applets:
+            return list_all_file_attributes(device, verbose)
+        return list_file_attributes(device, applet_id, verbose)
+
+
+def list_file_attributes(device, applet_id, verbose):
+    files = file.list_files(device, applet_id)
+    if not verbose:
+        files = [{'name': f.name, 'space': f.space, 'alloc_size': f.alloc_size} for f in files]
+    return files
+
+
+def list_all_file_attributes(device, verbose):
+    """
+    Files of all applets, read in one session. The applets that declare
+    no files in their header are skipped.
+    """
+    snapshot = []
+    for applet in read_applet_list(device):
+        if applet['file_count'] == 0:
+            continue
+        files = list_file_attributes(device, applet['applet_id'], verbose)
+        if files:
+            snapshot.append({'applet_id': applet['applet_id'], 'name': applet['name'], 'files': files})
+    return snapshot
 
 
 @command_decorator
 def write_file(applet_id, file_name_or_space, text, character_map_name, character_map_path):
     if applet_id is None:
         applet_id = AppletIds.ALPHAWORD
+    character_map = get_character_map(applet_id, character_map_name, character_map_path)
+
+    with Device.connect() as device:
+        write_text(device, applet_id, file_name_or_space, text, character_map)
+
+
+def write_text(device, applet_id, file_name_or_space, text, character_map):
     if applet_id == AppletIds.ALPHAWORD:
-        character_map = get_character_map(applet_id, character_map_name, character_map_path)
         text = import_text_to_neo(text, character_map)
 
+    file_attrs = file.get_file_by_name_or_space(device, applet_id, file_name_or_space)
+    if file_attrs:
+        file.write_file(device, text, applet_id, file_attrs.file_index)
+    else:
+        file.create_file(device, file_name_or_space, 'write', text, applet_id)
+
+
+@command_decorator
+def write_files(applet_id, texts, character_map_name, character_map_path):
+    if applet_id is None:
+        applet_id = AppletIds.ALPHAWORD
+    character_map = get_character_map(applet_id, character_map_name, character_map_path)
+
     with Device.connect() as device:
-        device.dialogue_start()
-        file_attrs = file.get_file_by_name_or_space(device, applet_id, file_name_or_space)
+        write_texts(device, applet_id, texts, character_map)
+
+
+def write_texts(device, applet_id, texts, character_map):
+    """
+    Write several files, creating the missing ones, in one dialogue. The texts are
+    (file name or space, text) pairs. The files are listed and the free space is
+    checked once for the whole set, so nothing is written if it does not fit.
+    """
+    require_unique_targets([target for target, _ in texts])
+    files = file.list_files(device, applet_id)
+    changes = []
+    needed_size = 0
+    file_index = len(files) + 1
+    for target, text in texts:
+        if applet_id == AppletIds.ALPHAWORD:
+            text = import_text_to_neo(text, character_map)
+        file_attrs = file.select_file(files, target)
         if file_attrs:
-            file.raw_write_file(device, text, applet_id, file_attrs.file_index, True)
+            changes.append(('write', file_attrs.file_index, text))
+            needed_size = needed_size + max(0, len(text) - file_attrs.alloc_size)
         else:
-            file.create_file(device, file_name_or_space, 'write', text, applet_id)
-        device.dialogue_end()
+            changes.append(('create', file.new_file_attributes(file_index, target, 'write', text), text))
+            needed_size = needed_size + len(text)
+            file_index = file_index + 1
+    if needed_size:
+        file.require_free_ram(device, needed_size)
+    file.apply_file_changes(device, applet_id, changes)
 
 
 @command_decorator
-def applet_read_settings(applet_id, flags):
-    default_flags = [0, 7, 15]
-    if len(flags) == 0:
-        flags = default_flags
+def clear_files(applet_id, files_names_or_spaces):
+    if applet_id is None:
+        applet_id = AppletIds.ALPHAWORD
+    with Device.connect() as device:
+        clear_files_by_name_or_space(device, applet_id, files_names_or_spaces)
+
 
+def clear_files_by_name_or_space(device, applet_id, files_names_or_spaces):
+    """Clear several files in one dialogue. Nothing is cleared if any of them does not exist."""
+    require_unique_targets(files_names_or_spaces)
+    files = file.list_files(device, applet_id)
+    changes = []
+    missing = []
+    for target in files_names_or_spaces:
+        file_attrs = file.select_file(files, target)
+        if file_attrs:
+            changes.append(('clear', file_attrs))
+        else:
+            missing.append(target)
+    if missing:
+        raise NeotoolsError(f'Files not found: {", ".join(missing)}')
+    file.apply_file_changes(device, applet_id, changes)
+
+
+def require_unique_targets(files_names_or_spaces):
+    seen = set()
+    for target in files_names_or_spaces:
+        if target in seen:
+            raise NeotoolsError(f'File {target} is given more than once')
+        seen.add(target)
+
+
+@command_decorator
+def applet_read_settings(applet_id, flags, dump_path=None):
     with Device.connect() as device:
-        # Retrieve system labels for better UI.
-        system_settings = AppletSettings([])
-        for flag in default_flags:
-            system_settings.merge_settings(get_settings(device, 0, flag))
+        return read_settings(device, applet_id, flags, dump_path)
 
-        settings = AppletSettings([])
-        for flag in flags:
-            s = get_settings(device, applet_id, flag)
-            settings.merge_settings(s)
 
-        settings.labels.update(system_settings.labels)
-        settings.descriptions.update(system_settings.descriptions)
-        return settings.to_dict()
+def read_settings(device, applet_id, flags, dump_path=None):
+    if len(flags) == 0:
+        flags = SYSTEM_SETTINGS_FLAGS
+
+    # Retrieve system labels for better UI.
+    os_version = os_version_key(get_version(device))
+    system_settings = get_system_settings(device, os_version)
+
+    raw_by_flag = {flag: get_settings_raw(device, applet_id, flag) for flag in flags}
+    if dump_path:
+        save_settings_dump(dump_path, os_version, applet_id, raw_by_flag)
+    settings = settings_from_raw(raw_by_flag)
+    return label_settings(settings, system_settings).to_dict()
 
 
 @command_decorator
 def applet_write_settings(applet_id, ident, values):
     with Device.connect() as device:
+        write_settings(device, applet_id, ident, values)
+
+
+def write_settings(device, applet_id, ident, values):
+    item = find_settings_item(device, applet_id, ident)
+    change_settings_item(device, item, values)
+    set_settings(device, applet_id, item)
+    # Some settings, such as clearing all AlphaWord files, change the files.
+    file.invalidate_file_lists(device)
+
+
+def find_settings_item(device, applet_id, ident):
+    for flag in [7, 15]:
+        settings = get_settings(device, applet_id, flag)
+        item = settings.settings.get(ident)
+        if item:
+            return item
+    raise NeotoolsError(f'Settings item with id={ident} not found')
+
+
+def change_settings_item(device, item, values):
+    item.change_setting(values)
+    if item.type == AppletSettingsType.APPLET_ID:
+        if get_applet(device, item.data) is None:
+            raise NeotoolsError(f'Applet with id={item.data} not found')
+
+
+@command_decorator
+def apply_settings_profile(path):
+    profile = read_settings_profile(path)
+    with Device.connect() as device:
+        return apply_profile(device, profile)
+
+
+def read_settings_profile(path):
+    """
+    The profile has the desired values by applet id and settings ident,
+    in the same format as the values of set-settings:
+    {"applets": {"0": {"16388": [10, 4, 59], "16400": [4097]}}}
+    """
+    with open(path) as f:
+        profile = json.load(f)
+    try:
+        return {
+            int(applet_id, 0): {
+                int(ident, 0): [str(v) for v in (values if isinstance(values, list) else [values])]
+                for ident, values in settings.items()
+            }
+            for applet_id, settings in profile['applets'].items()
+        }
+    except (KeyError, AttributeError, ValueError) as e:
+        raise NeotoolsError(f'Invalid settings profile: {e}')
+
+
+def apply_profile(device, profile):
+    """
+    Reads the settings of each applet once and writes only the items that differ,
+    all the changed items of an applet in one write. Nothing is written unless all items of the profile are valid.
+    """
+    changes = []
+    for applet_id, values_by_ident in profile.items():
+        settings = AppletSettings([])
         for flag in [7, 15]:
-            settings = get_settings(device, applet_id, flag)
+            settings.merge_settings(get_settings(device, applet_id, flag))
+        for ident, values in values_by_ident.items():
             item = settings.settings.get(ident)
-            if item:
-                break
-        if item is None:
-            raise NeotoolsError(f'Settings item with id={ident} not found')
-        if item.type == AppletSettingsType.APPLET_ID:
-            applets = read_applet_list(device)
-            if not any(item.data == applet['applet_id'] for applet in applets):
-                raise NeotoolsError(f'Applet with id={item.data} not found')
-        item.change_setting(values)
-        set_settings(device, applet_id, item)
+            if item is None:
+                raise NeotoolsError(f'Settings item with id={ident} not found for applet_id={applet_id}')
+            current = copy.deepcopy(item.data)
+            change_settings_item(device, item, values)
+            if item.data != current:
+                changes.append((applet_id, item))
+
+    items_by_applet = {}
+    for applet_id, item in changes:
+        items_by_applet.setdefault(applet_id, []).append(item)
+    for applet_id, items in items_by_applet.items():
+        logger.info(f'Changing settings items {[item.ident for item in items]} of applet_id={applet_id}')
+        set_settings(device, applet_id, items)
+    if changes:
+        file.invalidate_file_lists(device)
+    return [{'applet_id': applet_id, 'ident': item.ident, 'value': item.data} for applet_id, item in changes]
 
 
 @command_decorator
@@ -229,17 +409,38 @@ def clear_file(applet_id, file_name_or_space):
     if applet_id is None:
         applet_id = AppletIds.ALPHAWORD
     with Device.connect() as device:
-        file_attrs = file.get_file_by_name_or_space(device, applet_id, file_name_or_space)
-        if file_attrs:
-            file.clear_file(device, applet_id, file_attrs.file_index)
-        else:
-            raise NeotoolsError('File not found')
+        clear_file_by_name_or_space(device, applet_id, file_name_or_space)
+
+
+def clear_file_by_name_or_space(device, applet_id, file_name_or_space):
+    file_attrs = file.get_file_by_name_or_space(device, applet_id, file_name_or_space)
+    if file_attrs:
+        file.clear_file(device, applet_id, file_attrs.file_index)
+    else:
+        raise NeotoolsError('File not found')
+
+
+@command_decorator
+def benchmark(file_name_or_space, iterations, sizes, applet_id):
+    if applet_id is None:
+        applet_id = AppletIds.ALPHAWORD
+    start = perf_counter()
+    with Device.connect() as device:
+        connect_seconds = perf_counter() - start
+        result = bench.run_bench(device, file_name_or_space, iterations, sizes, applet_id)
+        # Connecting includes the flip to comms mode when the device is in keyboard mode.
+        result['connect'] = {'seconds': connect_seconds, 'flipped': device.original_product == HID_PRODUCT_ID}
+        return result
 
 
 @command_decorator
 def system_info():
     with Device.connect() as device:
-        version = get_version(device)
-        space = get_available_space(device)
-        del version['unknown']
-        return {**version, **space}
+        return get_system_info(device)
+
+
+def get_system_info(device):
+    version = get_version(device).to_dict()
+    space = get_available_space(device)
+    del version['unknown']
+    return {**version, **space}
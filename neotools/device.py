@@ -1,15 +1,18 @@
 import errno
 import logging
+import threading
 from collections import OrderedDict
 from contextlib import contextmanager
-from time import sleep, time
+from time import perf_counter, sleep, time
 
 import usb.core
 from usb import util
 
+from neotools import metrics, progress
 from neotools.applet.constants import AppletIds
 from neotools.message import Message, MessageConst, send_message
-from neotools.util import NeotoolsError, calculate_data_checksum, data_from_buf
+from neotools.progress import TransferRate
+from neotools.util import NeotoolsError, OperationCancelled, BinaryFormat, calculate_data_checksum
 
 logger = logging.getLogger(__name__)
 
@@ -20,6 +23,20 @@ HUB_PRODUCT_ID = 0x0100
 PROTOCOL_VERSION = 0x0220  # Minimum ASM protocol version that the device must support.
 
 
+def device_location(dev):
+    """
+    The bus and the ports of a device, such as "1-2.4", which stay the same when it
+    switches modes, unlike the address. None if the backend does not report the ports.
+    """
+    try:
+        ports = dev.port_numbers
+    except (usb.core.USBError, NotImplementedError):
+        ports = None
+    if not ports:
+        return None
+    return f'{dev.bus}-{".".join(str(port) for port in ports)}'
+
+
 class Device:
     def __init__(self, dev):
         self.dev = dev
@@ -27,6 +44,13 @@ class Device:
         self.out_endpoint = None
         self.is_kernel_driver_detached = None
         self.original_product = dev.idProduct
+        # Session caches, invalidated by the operations that change the device state.
+        self.file_lists = {}  # FileAttributes lists by applet id
+        self.applets = None  # Installed applet headers by applet id
+        # Called with the TransferRate after every block of long transfers. It may raise OperationCancelled.
+        self.progress_listener = progress.default_listener
+        self.transfer = None
+        self.cancel_requested = threading.Event()
 
     @staticmethod
     @contextmanager
@@ -58,6 +82,8 @@ ACTION=="add", SUBSYSTEMS=="usb", ATTRS{idVendor}=="081e", ATTRS{idProduct}=="bd
                 )
             else:
                 logger.exception(e)
+        except OperationCancelled as e:
+            logger.warning(e)
         except Exception as e:
             logger.exception(e)
         finally:
@@ -132,20 +158,26 @@ ACTION=="add", SUBSYSTEMS=="usb", ATTRS{idVendor}=="081e", ATTRS{idProduct}=="bd
             self.dev.detach_kernel_driver(0)
             self.is_kernel_driver_detached = True
 
+        # With several devices connected, the one in comms mode must be at the same ports.
+        location = device_location(self.dev)
         # Sometimes flipping to communication mode fails on the first attempt but the second one works.
         timeout = 4  # Neo switches in roughly 2.6s. Four seconds is roughly when it is worth to try flipping to communication again.
         comms_dev = None
+        flip_start = perf_counter()
         for i in range(0, 2):
+            metrics.FLIP_ATTEMPTS.inc()
             self.flip_to_comms_mode()
             start_time = time()
             logger.debug("Connecting to Neo in communication mode")
             while comms_dev is None and time() - start_time < timeout:
                 sleep(0.1)
-                comms_dev = usb.core.find(idVendor=VENDOR_ID, idProduct=COM_PRODUCT_ID)
+                comms_dev = usb.core.find(idVendor=VENDOR_ID, idProduct=COM_PRODUCT_ID,
+                                          custom_match=lambda dev: device_location(dev) == location)
             if comms_dev is not None:
                 break
 
         if comms_dev is not None:
+            metrics.LATENCY.observe(perf_counter() - flip_start, operation='flip_to_comms')
             util.dispose_resources(self.dev)
             self.dev = comms_dev
         else:
@@ -168,25 +200,98 @@ ACTION=="add", SUBSYSTEMS=="usb", ATTRS{idVendor}=="081e", ATTRS{idProduct}=="bd
         remaining = length
         while remaining > 0:
             block_size = min(8, remaining)
-            buf = self.in_endpoint.read(block_size, timeout=timeout)
+            try:
+                buf = self.in_endpoint.read(block_size, timeout=timeout)
+            except usb.core.USBError as e:
+                count_timeout(e, 'in')
+                raise
+            metrics.READ_BYTES.inc(len(buf))
             result.extend(buf)
             remaining = remaining - len(buf)
             if len(buf) != 8:
                 break  # terminate loop on a short read
         return bytes(result)
 
-    def write(self, message, timeout=None):
+    def write(self, message, timeout=None, packet_size=8):
         if timeout is None:
             timeout = 1000
-        length = len(message)
+        if not isinstance(message, (bytes, bytearray, memoryview)):
+            message = bytes(message)
+        view = memoryview(message)
+        length = len(view)
         message_offset = 0
 
         while message_offset != length:
-            block_size = min(8, length - message_offset)
-            block = message[message_offset : message_offset + block_size]
-            self.out_endpoint.write(block, timeout=timeout)
+            block_size = min(packet_size, length - message_offset)
+            try:
+                self.out_endpoint.write(view[message_offset : message_offset + block_size], timeout=timeout)
+            except usb.core.USBError as e:
+                count_timeout(e, 'out')
+                raise
+            metrics.WRITTEN_BYTES.inc(block_size)
             message_offset = message_offset + block_size
 
+    @contextmanager
+    def track_transfer(self, operation, total, cancellable=True):
+        """
+        Report the progress of an operation inside the block. The total is None when only the time is known.
+        Waiting for a busy device is not cancellable, as it does not accept a reset.
+        A cancellation that arrives after the last block is dropped with the transfer.
+        """
+        self.transfer = TransferRate(total, operation, cancellable)
+        listener = self.progress_listener
+        try:
+            if cancellable and isinstance(listener, progress.ProgressBar):
+                with listener.cancel_on_interrupt(self):
+                    yield
+            else:
+                yield
+        finally:
+            self.transfer = None
+            self.cancel_requested.clear()
+
+    def resync(self, error=None):
+        """
+        Recover after a failed transfer: clear a stalled endpoint, discard the data
+        that the device is still sending, and reset it to a known state.
+        """
+        if isinstance(error, usb.core.USBError) and error.errno == errno.EPIPE:
+            self.in_endpoint.clear_halt()
+            self.out_endpoint.clear_halt()
+        while True:
+            try:
+                if len(self.in_endpoint.read(64, timeout=100)) == 0:
+                    break
+            except usb.core.USBError:
+                break
+        self.reset()
+
+    def report_progress(self, done, total):
+        """
+        Report a completed block. When the transfer is cancelled, the dialogue is ended
+        here, between the blocks, so that the device stays in a known state.
+        The blocks outside track_transfer, such as the file attributes, are not reported,
+        and a cancel does not interrupt them.
+        """
+        transfer = self.transfer
+        if transfer is None:
+            return
+        transfer.update(done)
+        try:
+            if self.progress_listener is not None:
+                self.progress_listener(transfer)
+            if transfer.cancellable and self.cancel_requested.is_set():
+                raise OperationCancelled(f'Cancelled {transfer.operation or "the transfer"} at {done} bytes')
+        except OperationCancelled:
+            self.cancel_requested.clear()
+            logger.info('Ending the dialogue after cancelling the transfer')
+            self.dialogue_end()
+            raise
+
+    def cancel(self):
+        """Cancel the current transfer at the next block. This can be called from another thread."""
+        self.cancel_requested.set()
+
     def dialogue_start(self, applet_id=AppletIds.SYSTEM):
         self.hello()
         self.reset()
@@ -226,12 +331,14 @@ ACTION=="add", SUBSYSTEMS=="usb", ATTRS{idVendor}=="081e", ATTRS{idProduct}=="bd
         """
         retries = 10
         buf = []
+        start = perf_counter()
         while retries > 0:
             self.write([0x01], timeout=100)  # ascCommandRequestProtocol
             buf = self.read(8, timeout=100)
             if len(buf) == 2:
                 break  # success
             logger.debug("Unexpected byte response %s", buf)
+            metrics.HELLO_RETRIES.inc()
             retries = retries - 1
             self.reset()
             sleep(0.1)  # seconds
@@ -240,11 +347,17 @@ ACTION=="add", SUBSYSTEMS=="usb", ATTRS{idVendor}=="081e", ATTRS{idProduct}=="bd
                 "This device doesn't look like it wants to talk to us - bailing out."
             )
 
+        metrics.LATENCY.observe(perf_counter() - start, operation="hello")
         version = int.from_bytes(buf[0:2], byteorder="big")
         if version < PROTOCOL_VERSION:
             raise NeotoolsError("ASM protocol version not supported: %s" % version)
 
 
+def count_timeout(error, direction):
+    if error.errno == errno.ETIMEDOUT:
+        metrics.TIMEOUTS.inc(direction=direction)
+
+
 def get_available_space(device):
     device.dialogue_start()
     message = Message(MessageConst.REQUEST_GET_AVAIL_SPACE, [])
@@ -274,6 +387,8 @@ REVISION_FORMAT = {
         ]
     ),
 }
+REVISION = BinaryFormat('Revision', REVISION_FORMAT, __name__)
+Revision = REVISION.record
 
 
 def get_version(device):
@@ -291,4 +406,4 @@ def get_version(device):
             f"Ignoring data checksum error. Wanted {expected_checksum}, got {checksum}"
         )
     device.dialogue_end()
-    return data_from_buf(REVISION_FORMAT, buf)
+    return REVISION.unpack_from(buf)
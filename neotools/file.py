@@ -1,13 +1,14 @@
+import errno
 import logging
 from collections import OrderedDict
 
-from usb import util
+from usb.core import USBError
 
+from neotools import metrics
 from neotools.applet.applet import get_applet_resource_usage
 from neotools.device import get_available_space
 from neotools.message import Message, MessageConst, send_message, receive_message, assert_success
-from neotools.util import calculate_data_checksum, NeotoolsError, data_from_buf, \
-    data_to_buf
+from neotools.util import calculate_data_checksum, ChecksumError, NeotoolsError, BinaryFormat, Record
 
 logger = logging.getLogger(__name__)
 FILE_ATTRIBUTES_FORMAT = {
@@ -25,6 +26,8 @@ FILE_ATTRIBUTES_FORMAT = {
         ('unknown2', (0x26, 2, int)),  # appears to be ignored on write and quasi-random on read
     ])
 }
+FILE_ATTRIBUTES = BinaryFormat('RawFileAttributes', FILE_ATTRIBUTES_FORMAT, __name__)
+RawFileAttributes = FILE_ATTRIBUTES.record
 
 
 class FileConst:
@@ -56,12 +59,15 @@ def get_file_attributes(device, applet_id, index):
     checksum = response.argument(5, 2)
     assert length == FILE_ATTRIBUTES_FORMAT['size']
     buf = device.read(FILE_ATTRIBUTES_FORMAT['size'])
-    assert checksum == calculate_data_checksum(buf)
+    if checksum != calculate_data_checksum(buf):
+        raise ChecksumError(f'File attributes checksum error at index {index}')
     device.dialogue_end()
     return FileAttributes.from_raw(index, buf)
 
 
-class FileAttributes:
+class FileAttributes(Record):
+    __slots__ = ('file_index', 'name', 'space', 'password', 'min_size', 'alloc_size', 'flags')
+
     def __init__(self, file_index, name, space, password, min_size, alloc_size, flags):
         self.file_index = file_index
         self.name = name
@@ -73,51 +79,151 @@ class FileAttributes:
         self.flags = flags
 
     def __str__(self):
-        return str(self.__dict__)
+        return str(self.to_dict())
 
     @staticmethod
     def from_raw(file_index: int, buf: bytes):
-        attrs = data_from_buf(FILE_ATTRIBUTES_FORMAT, buf)
-        space = FileConst.FILE_SPACE_CODES.index(attrs['space'])
-        attrs['space'] = space
-        attrs['file_index'] = file_index
-        del attrs['unknown1']
-        del attrs['unknown2']
-        return FileAttributes(**attrs)
+        attrs = FILE_ATTRIBUTES.unpack(buf)
+        space = FileConst.FILE_SPACE_CODES.index(attrs.space)
+        return FileAttributes(file_index, attrs.name, space, attrs.password, attrs.min_size, attrs.alloc_size,
+                              attrs.flags)
 
     def to_raw(self):
-        buf = [0] * FILE_ATTRIBUTES_FORMAT['size']
-        obj = self.__dict__
-        obj['space'] = FileConst.FILE_SPACE_CODES[self.space]
-        data_to_buf(FILE_ATTRIBUTES_FORMAT, buf, self.__dict__)
-        return buf
+        return FILE_ATTRIBUTES.pack(RawFileAttributes(
+            name=self.name, password=self.password, min_size=self.min_size, alloc_size=self.alloc_size,
+            flags=self.flags, unknown1=0, space=FileConst.FILE_SPACE_CODES[self.space], unknown2=0))
+
+
+# The USB errors of a flaky cable or hub, after which the transfer of a file is restarted
+TRANSIENT_ERRNOS = {errno.ETIMEDOUT, errno.EPIPE, errno.EIO, errno.EOVERFLOW}
+TRANSFER_ATTEMPTS = 3
+# The errors that restart a transfer. Corrupted data is as transient as a timeout.
+TRANSFER_ERRORS = (USBError, ChecksumError)
+
+
+def is_transient(error):
+    return isinstance(error, ChecksumError) or (isinstance(error, USBError) and error.errno in TRANSIENT_ERRNOS)
+
+
+def recover(device, operation, error, attempt):
+    """
+    Resynchronize with the device after a transient error and return the number of the next attempt.
+    The protocol cannot resume a transfer at a block, as the reset that brings the device
+    to a known state also ends the transfer. So the transfer of the file restarts.
+    """
+    if not is_transient(error) or attempt >= TRANSFER_ATTEMPTS:
+        raise error
+    metrics.TRANSFER_RETRIES.inc(operation=operation)
+    logger.warning('Restarting %s after an error, attempt %s of %s: %s', operation, attempt + 1, TRANSFER_ATTEMPTS,
+                   error)
+    device.resync(error)
+    return attempt + 1
 
 
 def read_file(device, applet_id, file_attrs):
-    device.dialogue_start()
-    result = raw_read_file(device, applet_id, file_attrs, True)
-    device.dialogue_end()
-    return result
+    return b''.join(iter_read_file(device, applet_id, file_attrs))
+
+
+def iter_read_file(device, applet_id, file_attrs):
+    """
+    Like read_file, but yields the data blocks as they arrive from the device.
+    When the transfer restarts after an error, the data that was already yielded is skipped.
+    When the iteration stops early, the dialogue is ended.
+    """
+    attempt = 1
+    yielded = 0
+    while True:
+        blocks = raw_read_file_blocks(device, applet_id, file_attrs, True)
+        try:
+            device.dialogue_start()
+            received = 0
+            for block in blocks:
+                block_start = received
+                received = received + len(block)
+                if received > yielded:
+                    yield block[max(yielded - block_start, 0):]
+                    yielded = received
+            device.dialogue_end()
+            return
+        except TRANSFER_ERRORS as e:
+            attempt = recover(device, 'read_file', e, attempt)
+        except GeneratorExit:
+            # The consumer stopped before the end of the file. The reset ends the transfer between blocks.
+            device.dialogue_end()
+            raise
+        finally:
+            blocks.close()
+
+
+def write_file(device, buf, applet_id, file_index):
+    """
+    Write the data of an existing file in a dialogue. The write takes effect
+    only when it is confirmed, so after a transient error it restarts.
+    """
+    apply_file_changes(device, applet_id, [('write', file_index, buf)])
 
 
 def clear_file(device, applet_id, file_index):
     attrs = get_file_attributes(device, applet_id, file_index)
     if attrs is None:
         return None
-    attrs.alloc_size = attrs.min_size = 0
+    apply_file_changes(device, applet_id, [('clear', attrs)])
 
-    device.dialogue_start()
-    raw_set_file_attributes(device, attrs, applet_id, file_index)
-    message = Message(MessageConst.REQUEST_COMMIT, [(file_index, 4, 1), (applet_id, 5, 2)])
-    send_message(device, message, MessageConst.RESPONSE_COMMIT)
-    raw_write_file(device, b'', applet_id, file_index, True)
-    device.dialogue_end()
+
+def apply_file_changes(device, applet_id, changes):
+    """
+    Write, create and clear files in one dialogue. The changes are tuples:
+
+        ('write', file_index, data)
+        ('create', attrs, data)
+        ('clear', attrs)
+
+    After a transient error the dialogue restarts from the change that failed.
+    A file that was created before the error is written again as an existing one.
+    """
+    pending = list(changes)
+    attempt = 1
+    while True:
+        try:
+            device.dialogue_start()
+            while pending:
+                change = pending[0]
+                if change[0] == 'create':
+                    _, attrs, data = change
+                    raw_commit_file_attributes(device, attrs, applet_id)
+                    pending[0] = change = ('write', attrs.file_index, data)
+                if change[0] == 'write':
+                    _, file_index, data = change
+                    raw_write_file(device, data, applet_id, file_index, True)
+                elif change[0] == 'clear':
+                    raw_clear_file(device, change[1], applet_id)
+                else:
+                    raise ValueError(f'Unknown file change {change[0]}')
+                pending.pop(0)
+            device.dialogue_end()
+            return
+        except TRANSFER_ERRORS as e:
+            attempt = recover(device, 'write_file', e, attempt)
+
+
+def raw_clear_file(device, attrs, applet_id):
+    cleared = FileAttributes(attrs.file_index, attrs.name, attrs.space, attrs.password, 0, 0, attrs.flags)
+    raw_commit_file_attributes(device, cleared, applet_id)
+    raw_write_file(device, b'', applet_id, attrs.file_index, True)
 
 
 def read_extended_data(device, size):
     """
     Read binary data blocks in response to some other command, handling segmentation
     and checksum validation.
+    """
+    return b''.join(read_extended_data_blocks(device, size))
+
+
+def read_extended_data_blocks(device, size):
+    """
+    Yield binary data blocks in response to some other command, handling segmentation
+    and checksum validation.
 
     The command sequence is:
 
@@ -129,7 +235,6 @@ def read_extended_data(device, size):
     logger.debug('Reading extended data')
     remaining = size
     message = Message(MessageConst.REQUEST_BLOCK_READ, [])
-    result = util.create_buffer(0)
 
     while remaining > 0:
         response = send_message(device, message)
@@ -139,16 +244,20 @@ def read_extended_data(device, size):
             block_size = response.argument(1, 4)
             checksum = response.argument(5, 2)
             buf = device.read(block_size, timeout=(block_size * 10 + 600))
-            assert calculate_data_checksum(buf) == checksum
-            result.extend(buf)
+            if calculate_data_checksum(buf) != checksum:
+                raise ChecksumError(f'Data checksum error in a block at {size - remaining} bytes')
             remaining = remaining - len(buf)
+            device.report_progress(size - remaining, size)
+            yield buf
         else:
             raise NeotoolsError('Unexpected response %s' % response)
 
-    return result.tobytes()
-
 
 def raw_read_file(device, applet_id, file_attrs, raw):
+    return b''.join(raw_read_file_blocks(device, applet_id, file_attrs, raw))
+
+
+def raw_read_file_blocks(device, applet_id, file_attrs, raw):
     """
     Transfer sequence:
       OUT:    0x12|0x1c   ASMESSAGE_REQUEST_READ_FILE | ASMESSAGE_REQUEST_READ_RAW_FILE
@@ -161,10 +270,20 @@ def raw_read_file(device, applet_id, file_attrs, raw):
     command = MessageConst.REQUEST_READ_RAW_FILE if raw else MessageConst.REQUEST_READ_FILE
     message = Message(command, [(size, 1, 3), (index, 4, 1), (applet_id, 5, 2)])
     send_message(device, message)
-    return read_extended_data(device, size)
+    with device.track_transfer('Reading file', size):
+        yield from read_extended_data_blocks(device, size)
 
 
-def list_files(device, applet_id):
+def iter_files(device, applet_id):
+    """
+    Yield the attributes of the files in the order of their index, fetching them
+    from the device one at a time, so that a search can stop at the first match.
+    The files are cached for the session when the iteration completes.
+    """
+    cached = device.file_lists.get(applet_id)
+    if cached is not None:
+        yield from list(cached)
+        return
     file_index = 1
     files = []
     while True:
@@ -173,8 +292,49 @@ def list_files(device, applet_id):
             break
         files.append(attrs)
         logger.debug('file listed file_index=%s attrs=%s', file_index, attrs)
+        yield attrs
         file_index = file_index + 1
-    return sorted(files, key=lambda f: (f.space, f.name))
+    device.file_lists[applet_id] = sorted(files, key=lambda f: (f.space, f.name))
+
+
+def list_files(device, applet_id):
+    """
+    The files sorted by space and name. The list is cached for the session
+    and invalidated when the files of the applet change.
+    """
+    return sorted(iter_files(device, applet_id), key=lambda f: (f.space, f.name))
+
+
+def select_file(files, file_name_or_space):
+    """Like get_file_by_name_or_space, for a list of files that is already fetched."""
+    if file_name_or_space.isdigit():
+        space = int(file_name_or_space)
+        if 1 <= space <= 8:
+            for attrs in files:
+                if attrs.space == space:
+                    return attrs
+    for attrs in files:
+        if attrs.name == file_name_or_space:
+            return attrs
+    return None
+
+
+def find_file(device, applet_id, name=None, space=None):
+    """Return the attributes of the first file that matches the name and the space, or None."""
+    if name is None and space is None:
+        raise ValueError('Either name or space must be given')
+    for attrs in iter_files(device, applet_id):
+        if (name is None or attrs.name == name) and (space is None or attrs.space == space):
+            return attrs
+    return None
+
+
+def invalidate_file_list(device, applet_id):
+    device.file_lists.pop(applet_id, None)
+
+
+def invalidate_file_lists(device):
+    device.file_lists.clear()
 
 
 def write_extended_data(device, buf):
@@ -193,6 +353,7 @@ def write_extended_data(device, buf):
 
         offset = offset + block_size
         remaining = remaining - block_size
+        device.report_progress(offset, len(buf))
 
 
 def raw_set_file_attributes(device, attrs, applet_id, file_index):
@@ -206,19 +367,32 @@ def raw_set_file_attributes(device, attrs, applet_id, file_index):
     """
     assert file_index < 256
     logger.debug('Setting file attributes applet_id=%s file_index=%s attrs=%s', applet_id, file_index, attrs)
+    invalidate_file_list(device, applet_id)
     message = Message(MessageConst.REQUEST_SET_FILE_ATTRIBUTES, [(file_index, 1, 4), (applet_id, 5, 2)])
     send_message(device, message, MessageConst.RESPONSE_SET_FILE_ATTRIBUTES)
     write_extended_data(device, attrs.to_raw())
 
 
+def raw_commit_file_attributes(device, attrs, applet_id):
+    """Set the attributes and bind them to the file. For a new index, that creates the file."""
+    file_index = attrs.file_index
+    raw_set_file_attributes(device, attrs, applet_id, file_index)
+    # Sending this message appears to bind the attributes to a new file -
+    # not sending it will still result in a new file, but the attributes will not be correct.
+    message = Message(MessageConst.REQUEST_COMMIT, [(file_index, 4, 1), (applet_id, 5, 2)])
+    send_message(device, message, MessageConst.RESPONSE_COMMIT)
+
+
 def raw_write_file(device, buf, applet_id, file_index, raw):
     logger.debug('Preparing to write file')
+    invalidate_file_list(device, applet_id)
     size = len(buf)
     command = MessageConst.REQUEST_WRITE_RAW_FILE if raw else MessageConst.REQUEST_WRITE_FILE
     message = Message(command, [(file_index, 1, 1), (size, 2, 3), (applet_id, 5, 2)])
     send_message(device, message, MessageConst.RESPONSE_WRITE_FILE)
     logger.debug('Writing block file data')
-    write_extended_data(device, buf)
+    with device.track_transfer('Writing file', size):
+        write_extended_data(device, buf)
     message = Message(MessageConst.REQUEST_CONFIRM_WRITE_FILE)
     send_message(device, message, MessageConst.RESPONSE_CONFIRM_WRITE_FILE)
     logger.info('Writing file complete')
@@ -254,26 +428,22 @@ def create_file(device, filename, password, data, applet_id):
     :return: The new FileAttributes.
     """
     usage = get_applet_resource_usage(device, applet_id)
-    available_space = get_available_space(device)
-
-    size = len(data)
-    if size + 1024 > available_space['free_ram']:
-        # REVIEW: arbitrarily choosing to keep at least 1k unused on the device
-        raise NeotoolsError('The device does not have enough RAM')
+    require_free_ram(device, len(data))
+    file_index = usage['file_count'] + 1
+    apply_file_changes(device, applet_id, [('create', new_file_attributes(file_index, filename, password, data), data)])
 
-    device.dialogue_start()
 
-    file_index = usage['file_count'] + 1
+def new_file_attributes(file_index, filename, password, data):
+    size = len(data)
     # The space is unbound, it is not index
-    attrs = FileAttributes(file_index, filename, 0, password, size, size, 0)
-    raw_set_file_attributes(device, attrs, applet_id, file_index)
+    return FileAttributes(file_index, filename, 0, password, size, size, 0)
 
-    # Sending this message appears to bind the attributes to a new file -
-    # not sending it will still result in a new file, but the attributes will not be correct.
-    message = Message(MessageConst.REQUEST_COMMIT, [(file_index, 4, 1), (applet_id, 5, 2)])
-    send_message(device, message, MessageConst.RESPONSE_COMMIT)
-    raw_write_file(device, data, applet_id, file_index, True)
-    device.dialogue_end()
+
+def require_free_ram(device, size):
+    free_ram = get_available_space(device)['free_ram']
+    if size + 1024 > free_ram:
+        # REVIEW: arbitrarily choosing to keep at least 1k unused on the device
+        raise NeotoolsError(f'The device does not have enough RAM: {size} bytes are needed, {free_ram} are free')
 
 
 def get_file_by_name_or_space(device, applet_id, file_name_or_space):
@@ -284,15 +454,12 @@ Otherwise the file with a given name is returned, or None if it cannot
 be found.
 
     """
-    files = list_files(device, applet_id)
     if file_name_or_space.isdigit():
         space = int(file_name_or_space)
         if 1 <= space <= 8:
-            for f in files:
-                if f.space == space:
-                    return f
-    for f in files:
-        if f.name == file_name_or_space:
-            return f
+            file_attrs = find_file(device, applet_id, space=space)
+            if file_attrs:
+                return file_attrs
+    return find_file(device, applet_id, name=file_name_or_space)
 
 
@@ -1,5 +1,7 @@
 import logging
+from time import perf_counter
 
+from neotools import metrics
 from neotools.util import NeotoolsError
 
 logger = logging.getLogger(__name__)
@@ -163,9 +165,34 @@ class Message:
         return str(self.m_data)
 
 
+def _message_names(prefixes):
+    names = {}
+    for name, value in vars(MessageConst).items():
+        if name.startswith(prefixes) and isinstance(value, int):
+            names.setdefault(value, name)
+    return names
+
+
+REQUEST_NAMES = _message_names(('REQUEST_',))
+RESPONSE_NAMES = _message_names(('RESPONSE_', 'ERROR_'))
+
+
+def request_name(code):
+    return REQUEST_NAMES.get(code, f'UNKNOWN_{code:02x}')
+
+
+def write_message(device, data, timeout=None):
+    """Write the eight bytes of a message, counting it by the request code."""
+    metrics.MESSAGES_SENT.inc(request=request_name(data[0]))
+    device.write(data, timeout=timeout)
+
+
 def send_message(device, message, success_code=None, timeout=None):
-    device.write(message.m_data, timeout=timeout)
-    return receive_message(device, success_code, timeout=timeout)
+    start = perf_counter()
+    write_message(device, message.m_data, timeout=timeout)
+    response = receive_message(device, success_code, timeout=timeout)
+    metrics.LATENCY.observe(perf_counter() - start, operation=request_name(message.command()))
+    return response
 
 
 def receive_message(device, success_code=None, timeout=None):
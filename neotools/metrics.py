@@ -0,0 +1,178 @@
+"""
+Counters and histograms of the device communication, exported in the OpenMetrics
+text format to a file, or served over HTTP for a scraper such as Prometheus.
+
+The metrics are process-wide. Charted over time, the throughput and the rates of
+retries and timeouts show degrading cables and devices before they fail.
+"""
+import logging
+import os
+import threading
+from abc import ABC, abstractmethod
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+# A message round trip takes a few milliseconds, finalizing an applet takes up to a minute.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(ABC):
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f'Metric {self.name} has labels {self.label_names}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    @abstractmethod
+    def samples(self):
+        """Yield (suffix, label values, extra labels, value)."""
+
+    def to_openmetrics(self):
+        lines = [f'# TYPE {self.name} {self.type}', f'# HELP {self.name} {_escape(self.help)}']
+        with self._lock:
+            samples = list(self.samples())
+        for suffix, values, extra, value in samples:
+            lines.append(f'{self.name}{suffix}{_format_labels(self.label_names, values, extra)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        for values, value in sorted(self._values.items()):
+            yield '_total', values, (), value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['buckets'][i] += 1
+            state['sum'] += value
+            state['count'] += 1
+
+    def count(self, **labels):
+        state = self._values.get(self._key(labels))
+        return 0 if state is None else state['count']
+
+    def samples(self):
+        for values, state in sorted(self._values.items()):
+            for bound, count in zip(self.buckets, state['buckets']):
+                yield '_bucket', values, [('le', _format_value(bound))], count
+            yield '_count', values, (), state['count']
+            yield '_sum', values, (), state['sum']
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f'Metric {metric.name} is already registered')
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def to_openmetrics(self):
+        return ''.join(metric.to_openmetrics() for metric in self.metrics.values()) + '# EOF\n'
+
+    def write(self, path):
+        """Write the metrics to a file. The file is replaced at once, so a collector never reads it half-written."""
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(self.to_openmetrics())
+        os.replace(temp_path, path)
+
+
+REGISTRY = Registry()
+
+READ_BYTES = REGISTRY.counter('neotools_read_bytes', 'Bytes read from the device')
+WRITTEN_BYTES = REGISTRY.counter('neotools_written_bytes', 'Bytes written to the device')
+MESSAGES_SENT = REGISTRY.counter('neotools_messages_sent', 'Messages sent to the device', ['request'])
+HELLO_RETRIES = REGISTRY.counter('neotools_hello_retries', 'Repeated hello requests after an unexpected response')
+FLIP_ATTEMPTS = REGISTRY.counter('neotools_flip_attempts', 'Attempts to switch the device to comms mode')
+TIMEOUTS = REGISTRY.counter('neotools_timeouts', 'USB transfers that timed out', ['direction'])
+TRANSFER_RETRIES = REGISTRY.counter('neotools_transfer_retries', 'File transfers restarted after a transient error',
+                                    ['operation'])
+LATENCY = REGISTRY.histogram('neotools_latency_seconds', 'Duration of the operations with the device', ['operation'])
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.to_openmetrics().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('Metrics request: ' + format, *args)
+
+
+def serve_metrics(port, host='127.0.0.1', registry=REGISTRY):
+    """Serve the metrics at /metrics from a background thread. Return the server, for shutdown()."""
+    handler = type('Handler', (MetricsHandler,), {'registry': registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    logger.info('Serving metrics at http://%s:%s/metrics', host, server.server_address[1])
+    return server
@@ -0,0 +1,251 @@
+"""
+Decoding of USB captures, such as the ones in usb_pcap, into transcripts of ASM messages.
+
+The captures are pcapng files made with Wireshark on Linux, where the packets have
+a usbmon header. The files are read block by block, so they are never loaded whole.
+"""
+import json
+import logging
+import os
+import struct
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from neotools.message import REQUEST_NAMES, RESPONSE_NAMES, Message, MessageConst
+from neotools.util import NeotoolsError
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SECTION_HEADER = 0x0A0D0D0A
+BLOCK_INTERFACE_DESCRIPTION = 0x00000001
+BLOCK_ENHANCED_PACKET = 0x00000006
+BYTE_ORDER_MAGIC = 0x1A2B3C4D
+
+# Link types and the size of the usbmon header in front of the data
+LINKTYPE_USB_LINUX = 189
+LINKTYPE_USB_LINUX_MMAPPED = 220
+USBMON_HEADER_SIZES = {LINKTYPE_USB_LINUX: 48, LINKTYPE_USB_LINUX_MMAPPED: 64}
+# id, event type, transfer type, endpoint, device, bus, setup flag, data flag,
+# seconds, microseconds, status, length, captured length
+USBMON_HEADER = struct.Struct('<QcBBBHccqiiII')
+USBMON_TRANSFER_BULK = 3
+USBMON_ENDPOINT_IN = 0x80
+EINPROGRESS = -115
+
+COMMAND_REQUEST_HELLO = b'\x01'
+COMMAND_REQUEST_RESET = b'?\xff\x00reset'
+COMMAND_REQUEST_SWITCH = b'?Swtch'
+COMMAND_RESPONSE_SWITCHED = b'Switched'
+
+# The messages with (len32, csum16) that are followed by the data of that length.
+# The requests send the data after the device confirms them.
+REQUESTS_WITH_DATA = {MessageConst.REQUEST_BLOCK_WRITE, MessageConst.REQUEST_SET_SETTINGS}
+RESPONSES_WITH_DATA = {MessageConst.RESPONSE_VERSION, MessageConst.RESPONSE_LIST_APPLETS,
+                       MessageConst.RESPONSE_GET_SETTINGS, MessageConst.RESPONSE_BLOCK_READ,
+                       MessageConst.RESPONSE_GET_FILE_ATTRIBUTES}
+# The records of a device are held back until it sends an ASM command. Only the latest
+# are kept, as the NEO sends one within its first few transfers.
+PENDING_RECORDS = 1000
+
+
+def iter_pcapng_packets(f):
+    """Yield (link type, packet data) for the packets of a pcapng file."""
+    endian = None
+    link_types = []
+    while True:
+        block_header = f.read(8)
+        if len(block_header) < 8:
+            return
+        block_type = struct.unpack('<I', block_header[:4])[0]
+        if block_type == BLOCK_SECTION_HEADER:
+            magic = f.read(4)
+            endian = '<' if struct.unpack('<I', magic)[0] == BYTE_ORDER_MAGIC else '>'
+            block_length = struct.unpack(endian + 'I', block_header[4:])[0]
+            f.read(block_length - 12)
+            link_types = []
+            continue
+        if endian is None:
+            raise NeotoolsError('Not a pcapng file')
+        block_type, block_length = struct.unpack(endian + 'II', block_header)
+        body = f.read(block_length - 8)
+        if len(body) < block_length - 8:
+            logger.warning('The capture is truncated')
+            return
+        if block_type == BLOCK_INTERFACE_DESCRIPTION:
+            link_types.append(struct.unpack_from(endian + 'H', body)[0])
+        elif block_type == BLOCK_ENHANCED_PACKET:
+            interface, _, _, captured_length, _ = struct.unpack_from(endian + 'IIIII', body)
+            if interface >= len(link_types):
+                raise NeotoolsError('Packet for an undefined interface')
+            yield link_types[interface], body[20:20 + captured_length]
+
+
+def iter_bulk_transfers(f):
+    """
+    Yield the bulk transfers that carry data, as (seconds, device, is_in, data, status).
+    The data of OUT transfers is captured on submission, and of IN transfers on completion.
+    """
+    for link_type, packet in iter_pcapng_packets(f):
+        header_size = USBMON_HEADER_SIZES.get(link_type)
+        if header_size is None:
+            continue
+        (_, event, transfer_type, endpoint, device, bus, _, _, seconds, microseconds, status, _,
+         captured_length) = USBMON_HEADER.unpack_from(packet)
+        if transfer_type != USBMON_TRANSFER_BULK:
+            continue
+        is_in = bool(endpoint & USBMON_ENDPOINT_IN)
+        data = packet[header_size:header_size + captured_length]
+        if (event == b'S' and not is_in) or (event == b'C' and (is_in or status not in (0, EINPROGRESS))):
+            yield seconds + microseconds / 1e6, f'{bus}.{device}', is_in, data, status
+
+
+def is_message(data):
+    return len(data) == 8 and Message.from_raw(list(data)).checksum() == data[7]
+
+
+class TranscriptDecoder:
+    """
+    Turns the bulk transfers of one device into records of the transcript.
+    The data that follows the messages announcing its length is merged into
+    a single record, tagged with the name of the message.
+    """
+
+    def __init__(self, path, device):
+        self.path = str(path)
+        self.device = device
+        self.expected = {False: 0, True: 0}  # The remaining data size by direction
+        self.tags = {False: None, True: None}
+        self.pending_size = 0  # The size announced by a request, sent after the response
+        self.pending_tag = None
+        self.request_time = None
+        self.data_record = None
+
+    def decode(self, time, is_in, data, status):
+        """Return the new record, or None when the data extends the previous record."""
+        direction = 'in' if is_in else 'out'
+        record = {'file': self.path, 'device': self.device, 'time': time, 'direction': direction}
+        if status not in (0, EINPROGRESS):
+            self.data_record = None
+            return {**record, 'kind': 'error', 'status': status}
+
+        if self.expected[is_in] > 0:
+            self.expected[is_in] -= len(data)
+            if not is_in:
+                self.request_time = time
+            if self.data_record is not None and self.data_record['direction'] == direction:
+                self.data_record['size'] += len(data)
+                self.data_record['packets'] += 1
+                self.data_record['duration'] = round(time - self.data_record['time'], 6)
+                return None
+            self.data_record = {**record, 'kind': 'data', 'tag': self.tags[is_in], 'size': len(data),
+                                'packets': 1, 'duration': 0}
+            return self.data_record
+        self.data_record = None
+
+        if not is_in:
+            self.request_time = time
+            if data == COMMAND_REQUEST_HELLO:
+                return {**record, 'kind': 'hello'}
+            if data == COMMAND_REQUEST_RESET:
+                return {**record, 'kind': 'reset'}
+            if data.startswith(COMMAND_REQUEST_SWITCH) and len(data) == 8:
+                return {**record, 'kind': 'switch', 'applet_id': int.from_bytes(data[6:8], 'big')}
+        else:
+            if self.request_time is not None:
+                # The time from the request to the first response
+                record['latency'] = round(time - self.request_time, 6)
+                self.request_time = None
+            if data == COMMAND_RESPONSE_SWITCHED:
+                return {**record, 'kind': 'switched'}
+            if len(data) == 2:
+                return {**record, 'kind': 'hello', 'version': int.from_bytes(data, 'big')}
+
+        if is_message(data):
+            message = Message.from_raw(list(data))
+            code = message.command()
+            names = RESPONSE_NAMES if is_in else REQUEST_NAMES
+            name = names.get(code, f'UNKNOWN_{code:02x}')
+            if not is_in and code in REQUESTS_WITH_DATA:
+                self.pending_size = message.argument(1, 4)
+                self.pending_tag = name
+            elif is_in and code in RESPONSES_WITH_DATA:
+                self.expected[True] = message.argument(1, 4)
+                self.tags[True] = name
+            elif is_in and code == MessageConst.RESPONSE_BLOCK_WRITE and self.pending_size:
+                self.expected[False] = self.pending_size
+                self.tags[False] = self.pending_tag
+                self.pending_size = 0
+            return {**record, 'kind': 'message', 'name': name, 'raw': data.hex()}
+        return {**record, 'kind': 'data', 'tag': None, 'size': len(data), 'packets': 1, 'duration': 0}
+
+
+def decode_capture(path):
+    """
+    Yield the transcript records of a capture as they are decoded, with the time relative
+    to its first transfer. Only the devices that exchange the ASM commands are included,
+    as the captures also have other devices of the virtual machine. The records of a device
+    are held back only until it sends an ASM command, up to PENDING_RECORDS of them.
+    """
+    decoders = {}
+    last_records = {}  # The latest record of every device, which a data transfer may still extend
+    pending = {}  # The records of the devices that are not known to be ASM devices yet
+    asm_devices = set()
+    start = None
+
+    def complete(device, record):
+        if device in asm_devices:
+            yield from pending.pop(device, ())
+            yield record
+        else:
+            pending.setdefault(device, deque(maxlen=PENDING_RECORDS)).append(record)
+
+    with open(path, 'rb') as f:
+        for time, device, is_in, data, status in iter_bulk_transfers(f):
+            if start is None:
+                start = time
+            decoder = decoders.get(device)
+            if decoder is None:
+                decoder = decoders[device] = TranscriptDecoder(path, device)
+            record = decoder.decode(round(time - start, 6), is_in, data, status)
+            if record is None:
+                continue
+            if record['kind'] in ('reset', 'switch', 'switched'):
+                asm_devices.add(device)
+            previous = last_records.get(device)
+            last_records[device] = record
+            if previous is not None:
+                yield from complete(device, previous)
+    for device, record in last_records.items():
+        yield from complete(device, record)
+
+
+def _spool_capture(path, spool_path):
+    with open(spool_path, 'w') as f:
+        for record in decode_capture(path):
+            f.write(json.dumps(record) + '\n')
+    return spool_path
+
+
+def _read_spool(spool_path):
+    with open(spool_path) as f:
+        for line in f:
+            yield json.loads(line)
+    os.remove(spool_path)
+
+
+def decode_captures(paths, jobs=None):
+    """
+    Yield an iterator of the records for each path, in the order of the paths. A single
+    capture is decoded in this process as it is read. Several are decoded in parallel, each
+    into a temporary file, and the iterator of each is yielded as soon as its turn comes.
+    """
+    if len(paths) == 1 or jobs == 1:
+        for path in paths:
+            yield decode_capture(path)
+        return
+    with tempfile.TemporaryDirectory(prefix='neotools-pcap-') as spool_dir, \
+            ProcessPoolExecutor(max_workers=jobs) as executor:
+        spool_paths = [os.path.join(spool_dir, f'{i}.jsonl') for i in range(len(paths))]
+        for spool_path in executor.map(_spool_capture, paths, spool_paths):
+            yield _read_spool(spool_path)
@@ -0,0 +1,126 @@
+import signal
+import threading
+from contextlib import contextmanager
+from time import time
+
+
+class TransferRate:
+    """
+    Throughput and the estimated time left for a transfer of a known size.
+    The progress listeners of a device receive it after every block. The total
+    is None while waiting for the device, which reports only the elapsed time.
+    """
+
+    def __init__(self, total, operation=None, cancellable=True):
+        self.operation = operation
+        self.cancellable = cancellable
+        self.total = total
+        self.done = 0
+        self.blocks = 0
+        self.start_time = time()
+
+    def update(self, done):
+        self.done = done
+        self.blocks = self.blocks + 1
+
+    @property
+    def elapsed(self):
+        return time() - self.start_time
+
+    @property
+    def rate(self):
+        """Bytes per second"""
+        elapsed = self.elapsed
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def block_rate(self):
+        """Blocks per second"""
+        elapsed = self.elapsed
+        return self.blocks / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self):
+        """Seconds left, or None until the rate is known"""
+        rate = self.rate
+        if self.total is None or rate == 0:
+            return None
+        return (self.total - self.done) / rate
+
+    @property
+    def fraction(self):
+        return self.done / self.total if self.total else None
+
+    def to_dict(self):
+        return {'operation': self.operation, 'done': self.done, 'total': self.total, 'blocks': self.blocks,
+                'elapsed': round(self.elapsed, 3), 'rate': round(self.rate, 1), 'eta': self.eta}
+
+    def __str__(self):
+        if self.total is None:
+            return f'{self.elapsed:.0f} s'
+        eta = self.eta
+        eta_text = '?' if eta is None else f'{eta:.0f} s'
+        return f'{self.done}/{self.total} bytes, {self.rate / 1024:.1f} KB/s, ETA {eta_text}'
+
+
+class ProgressBar:
+    """
+    A progress listener that draws a bar on a terminal. During a cancellable transfer,
+    the first interrupt with Ctrl-C cancels it at the next block, so that the device is
+    left in a known state. The second one interrupts right away.
+    """
+    WIDTH = 30
+
+    def __init__(self, output):
+        self.output = output
+        self.line_length = 0
+
+    def __call__(self, transfer):
+        label = transfer.operation or 'Transferring'
+        fraction = transfer.fraction
+        if fraction is None:
+            line = f'{label}: {transfer}'
+        else:
+            filled = int(fraction * self.WIDTH)
+            line = f'{label} [{"#" * filled}{"-" * (self.WIDTH - filled)}] {fraction:4.0%} {transfer}'
+        self.output.write('\r' + line.ljust(self.line_length))
+        self.line_length = len(line)
+        if fraction == 1:
+            self.output.write('\n')
+            self.line_length = 0
+        self.output.flush()
+
+    def clear(self):
+        if self.line_length:
+            self.output.write('\r' + ' ' * self.line_length + '\r')
+            self.line_length = 0
+
+    @contextmanager
+    def cancel_on_interrupt(self, device):
+        """Cancel the transfer of the device on the first interrupt, and restore the previous handler after it."""
+        if threading.current_thread() is not threading.main_thread():
+            yield
+            return
+
+        def handle_interrupt(signum, frame):
+            if device.cancel_requested.is_set():
+                raise KeyboardInterrupt
+            device.cancel()
+            self.clear()
+            self.output.write('Cancelling at the next block. Press Ctrl-C again to interrupt.\n')
+            self.output.flush()
+
+        previous_handler = signal.signal(signal.SIGINT, handle_interrupt)
+        try:
+            yield
+        finally:
+            signal.signal(signal.SIGINT, previous_handler)
+
+    def install(self):
+        """Make the new devices report to the bar."""
+        global default_listener
+        default_listener = self
+
+
+# The progress listener of the devices that connect, set by the command line to draw a bar.
+default_listener = None
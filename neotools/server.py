@@ -0,0 +1,88 @@
+"""
+JSON-lines RPC over stdio. A single device session stays open while the server runs.
+
+Requests and responses are JSON objects, one per line:
+
+    --> {"id": 1, "method": "read", "params": {"file": "1"}}
+    <-- {"id": 1, "result": {"text": "..."}}
+    --> {"id": 2, "method": "clear", "params": {"file": "9"}}
+    <-- {"id": 2, "error": {"type": "NeotoolsError", "message": "File not found"}}
+
+The methods and their params are the operations of neotools.batch. Requests are
+processed in order, so a client may send several requests without waiting for
+the responses and match them by id. Long transfers send progress events before
+the response, with the rate in bytes per second and the seconds left:
+
+    <-- {"id": 3, "event": "progress", "operation": "Reading file", "done": 4096, "total": 27412,
+         "blocks": 4, "elapsed": 0.61, "rate": 6714.8, "eta": 3.47}
+"""
+import json
+import logging
+import sys
+from contextlib import redirect_stdout
+from time import time
+
+from neotools.batch import error_to_dict, run_operation
+from neotools.device import Device
+from neotools.util import NeotoolsError, json_default
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_INTERVAL = 0.25  # seconds between progress events for a request
+
+
+class Server:
+    def __init__(self, device, output):
+        self.device = device
+        self.output = output
+
+    def send(self, message):
+        self.output.write(json.dumps(message, default=json_default) + '\n')
+        self.output.flush()
+
+    def progress_listener(self, request_id):
+        last_event = 0
+
+        def listener(transfer):
+            nonlocal last_event
+            now = time()
+            if transfer.done == transfer.total or now - last_event >= PROGRESS_INTERVAL:
+                last_event = now
+                self.send({'id': request_id, 'event': 'progress', **transfer.to_dict()})
+
+        return listener
+
+    def handle(self, line):
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            return {'id': None, 'error': error_to_dict(NeotoolsError(f'Invalid JSON: {e}'))}
+        if not isinstance(request, dict):
+            return {'id': None, 'error': error_to_dict(NeotoolsError('Request must be a JSON object'))}
+
+        request_id = request.get('id')
+        params = request.get('params', {})
+        try:
+            if 'method' not in request or not isinstance(params, dict):
+                raise NeotoolsError('Request must have a method and optional params object')
+            self.device.progress_listener = self.progress_listener(request_id)
+            # Some operations print messages, which must not mix with the protocol.
+            with redirect_stdout(sys.stderr):
+                result = run_operation(self.device, request['method'], params)
+            return {'id': request_id, 'result': result}
+        except Exception as e:
+            # A bad request must not end the session of the other requests.
+            logger.debug('Request failed', exc_info=True)
+            return {'id': request_id, 'error': error_to_dict(e)}
+        finally:
+            self.device.progress_listener = None
+
+    def serve(self, lines):
+        for line in lines:
+            if line.strip():
+                self.send(self.handle(line))
+
+
+def serve_stdio(input, output):
+    with Device.connect() as device:
+        Server(device, output).serve(input)
@@ -1,5 +1,7 @@
+import codecs
 import logging
 import importlib.resources
+from functools import lru_cache, partial
 
 from neotools import constants
 
@@ -8,122 +10,183 @@ logger = logging.getLogger(__name__)
 neo_untranslatable_character = 0
 
 
-def export_text_from_neo(text, character_map):  # from device to host
-    neo_to_unicode = character_map['neo_to_unicode']
-    index = 0
-    result = []
-    while index < len(text):
-        code = text[index]
-        index = index + 1
-        is_escaped = False
-        if code in [0xa4, 0xa7]:
-            continue  # unused codes
-        elif code == 0x0d:
-            code = 0x0a  # pass code through the character set translation
-        elif code in [0x81, 0xa1]:
-            # line-breaking space.  0xa1 is from older software versions
-            code = 0x20  # line-breaking space
-        elif code == 0x8d:
-            code = 0x09  # line-breaking tab
-        elif code == 0x8f:
-            continue  # period break in a run of contiguous characters
-        elif code == 0xa3:
-            code = 0x09  # line-breaking tab (older software versions)
-        elif code == 0xad:
-            code = 0x2d  # line-breaking hyphen
-        elif code == 0xb0:
-            if len(text) - index < 2:
-                logger.error('ASAlphaWordText: Unexpectedly truncated escape sequence')
+class NeoIncrementalDecoder(codecs.IncrementalDecoder):
+    """
+    From device to host. An escape sequence split between chunks is kept
+    until the next call to decode.
+    """
+
+    def __init__(self, errors='strict', character_map=None):
+        super().__init__(errors)
+        self.neo_to_unicode = character_map['neo_to_unicode']
+        self.pending = b''
+
+    def reset(self):
+        self.pending = b''
+
+    def getstate(self):
+        return self.pending, 0
+
+    def setstate(self, state):
+        self.pending = state[0]
+
+    def decode(self, input, final=False):
+        text = self.pending + bytes(input)
+        neo_to_unicode = self.neo_to_unicode
+        index = 0
+        result = []
+        while index < len(text):
+            code = text[index]
+            if code == 0xb0 and len(text) - index < 3 and not final:
+                break  # wait for the rest of the escape sequence
+            index = index + 1
+            is_escaped = False
+            if code in [0xa4, 0xa7]:
+                continue  # unused codes
+            elif code == 0x0d:
+                code = 0x0a  # pass code through the character set translation
+            elif code in [0x81, 0xa1]:
+                # line-breaking space.  0xa1 is from older software versions
+                code = 0x20  # line-breaking space
+            elif code == 0x8d:
+                code = 0x09  # line-breaking tab
+            elif code == 0x8f:
+                continue  # period break in a run of contiguous characters
+            elif code == 0xa3:
+                code = 0x09  # line-breaking tab (older software versions)
+            elif code == 0xad:
+                code = 0x2d  # line-breaking hyphen
+            elif code == 0xb0:
+                if len(text) - index < 2:
+                    logger.error('ASAlphaWordText: Unexpectedly truncated escape sequence')
+                else:
+                    is_escaped = True
+                    code = text[index]  # get the interpreted code directly
+                    index = index + 1
+                    if text[index] == 0xb0:
+                        index = index + 1  # skip over a following escape code (if present)
+            elif 0xa1 <= code <= 0xbf:
+                logger.error('ASAlphaWordText: possibly untrapped escape %s', code)
+                continue
+            skip_conversion = code in [0x09, 0x0a, 0x0d] and not is_escaped
+            if skip_conversion:
+                char = chr(code)
             else:
-                is_escaped = True
-                code = text[index]  # get the interpreted code directly
-                index = index + 1
-                if text[index] == 0xb0:
-                    index = index + 1  # skip over a following escape code (if present)
-        elif 0xa1 <= code <= 0xbf:
-            logger.error('ASAlphaWordText: possibly untrapped escape %s', code)
-            continue
-        skip_conversion = code in [0x09, 0x0a, 0x0d] and not is_escaped
-        if skip_conversion:
-            char = chr(code)
-        else:
-            char = neo_to_unicode[code]
-        result.append(char)
-    return ''.join(result)
+                char = neo_to_unicode[code]
+            result.append(char)
+        self.pending = text[index:]
+        return ''.join(result)
 
 
-def import_text_to_neo(text: str, character_map):
+class NeoIncrementalEncoder(codecs.IncrementalEncoder):
     """
-    From host to Neo
+    From host to Neo. The output after the last break opportunity is held back,
+    because a later soft break may replace that character.
     """
-    unicode_to_neo = character_map['unicode_to_neo']
     softbreak_interval = 40
     hardbreak_interval = 24
-    softbreak_count = 0
-    hardbreak_count = 0
-    last_break_opportunity = 0
-    neo_buffer = []
     min_file_size = 256
-    # TODO: should we handle BOM?
-    for char in text:
-        escape = False
-        code = unicode_to_neo.get(char)
-        if code is None:
-            code = neo_untranslatable_character
-        if code == 0x81:
-            # Re-map the "not" alternate character (to not clash with line-break hint)
-            code = 0xac
-        if 0xa1 <= code <= 0xbf or code in [0x09, 0x0a, 0x0d]:
-            escape = True
-        if char == '\t':
-            code = 0x09
-        elif char in ['\r', '\n']:
-            code = 0x0d
-
-        is_break = not escape and code == 0x0d
-        is_breakable = not escape and code in [0x2d, 0x20, 0x09]
-        hardbreak_count = hardbreak_count + 1
-        softbreak_count = softbreak_count + 1
-
-        if is_break:
-            # The current character is an implicit break.
-            last_break_opportunity = 0
-            softbreak_count = 0
-            hardbreak_count = 0
-        elif is_breakable:
-            last_break_opportunity = len(neo_buffer)
-            hardbreak_count = 0
-        elif hardbreak_count >= hardbreak_interval:
-            neo_buffer.append(0x8f)  # insert a hard-break character
-            softbreak_count = 0
-            hardbreak_count = 0
-            last_break_opportunity = 0
-
-        if escape:
-            neo_buffer.extend([0xb0, code, 0xb0])
-        else:
-            neo_buffer.append(code)
-
-        if softbreak_count >= softbreak_interval and last_break_opportunity:
-            # Substitute breakable characters with their breaking equivalents
-            last = neo_buffer[last_break_opportunity]
-            if last == 0x2d:
-                neo_buffer[last_break_opportunity] = 0xad
-            elif last == 0x20:
-                neo_buffer[last_break_opportunity] = 0x81
-            elif last == 0x09:
-                neo_buffer[last_break_opportunity] = 0x8d
+
+    def __init__(self, errors='strict', character_map=None):
+        super().__init__(errors)
+        self.unicode_to_neo = character_map['unicode_to_neo']
+        self.reset()
+
+    def reset(self):
+        self.softbreak_count = 0
+        self.hardbreak_count = 0
+        # Position of the last breakable character in the whole output. Zero if there is none.
+        self.last_break_opportunity = 0
+        self.pending = bytearray()
+        self.flushed = 0  # Position of the first pending byte in the whole output
+
+    def encode(self, input, final=False):
+        unicode_to_neo = self.unicode_to_neo
+        neo_buffer = self.pending
+        # TODO: should we handle BOM?
+        for char in input:
+            escape = False
+            code = unicode_to_neo.get(char)
+            if code is None:
+                code = neo_untranslatable_character
+            if code == 0x81:
+                # Re-map the "not" alternate character (to not clash with line-break hint)
+                code = 0xac
+            if 0xa1 <= code <= 0xbf or code in [0x09, 0x0a, 0x0d]:
+                escape = True
+            if char == '\t':
+                code = 0x09
+            elif char in ['\r', '\n']:
+                code = 0x0d
+
+            is_break = not escape and code == 0x0d
+            is_breakable = not escape and code in [0x2d, 0x20, 0x09]
+            self.hardbreak_count = self.hardbreak_count + 1
+            self.softbreak_count = self.softbreak_count + 1
+
+            if is_break:
+                # The current character is an implicit break.
+                self.last_break_opportunity = 0
+                self.softbreak_count = 0
+                self.hardbreak_count = 0
+            elif is_breakable:
+                self.last_break_opportunity = self.flushed + len(neo_buffer)
+                self.hardbreak_count = 0
+            elif self.hardbreak_count >= self.hardbreak_interval:
+                neo_buffer.append(0x8f)  # insert a hard-break character
+                self.softbreak_count = 0
+                self.hardbreak_count = 0
+                self.last_break_opportunity = 0
+
+            if escape:
+                neo_buffer.extend([0xb0, code, 0xb0])
             else:
-                # mismatch between this code and the assignment of isBreakable
-                raise RuntimeError('Failed to encode break character')
-            softbreak_count = 0
-            hardbreak_count = 0
-            last_break_opportunity = 0
+                neo_buffer.append(code)
+
+            if self.softbreak_count >= self.softbreak_interval and self.last_break_opportunity:
+                # Substitute breakable characters with their breaking equivalents
+                position = self.last_break_opportunity - self.flushed
+                last = neo_buffer[position]
+                if last == 0x2d:
+                    neo_buffer[position] = 0xad
+                elif last == 0x20:
+                    neo_buffer[position] = 0x81
+                elif last == 0x09:
+                    neo_buffer[position] = 0x8d
+                else:
+                    # mismatch between this code and the assignment of isBreakable
+                    raise RuntimeError('Failed to encode break character')
+                self.softbreak_count = 0
+                self.hardbreak_count = 0
+                self.last_break_opportunity = 0
+
+        if final:
+            size = self.flushed + len(neo_buffer)
+            if size < self.min_file_size:
+                # pad with 'unused space' pad byte to to minimum file size
+                neo_buffer.extend([0xa7] * (self.min_file_size - size))
+            ready = len(neo_buffer)
+        elif self.last_break_opportunity:
+            ready = self.last_break_opportunity - self.flushed
+        else:
+            ready = len(neo_buffer)
+        result = bytes(neo_buffer[:ready])
+        del neo_buffer[:ready]
+        self.flushed = self.flushed + ready
+        if final:
+            self.reset()
+        return result
 
-    if len(neo_buffer) < min_file_size:
-        # pad with 'unused space' pad byte to to minimum file size
-        neo_buffer.extend([0xa7] * (min_file_size - len(neo_buffer)))
-    return bytes(neo_buffer)
+
+def export_text_from_neo(text, character_map):  # from device to host
+    return NeoIncrementalDecoder(character_map=character_map).decode(text, final=True)
+
+
+def import_text_to_neo(text: str, character_map):
+    """
+    From host to Neo
+    """
+    return NeoIncrementalEncoder(character_map=character_map).encode(text, final=True)
 
 
 def character_map_name_to_filepath(name):
@@ -146,3 +209,46 @@ def read_character_map_file(path):
         'neo_to_unicode': lines,
         'unicode_to_neo': inverse_map
     }
+
+
+@lru_cache(maxsize=None)
+def _read_named_character_map(name):
+    return read_character_map_file(character_map_name_to_filepath(name))
+
+
+def _codec_name_to_character_map_name(codec_name):
+    """
+    Codecs are named after the character map and its resource file:
+    neo-default, neo-en, neo-en-us, neo-ua-mac, neo-ua-pc.
+    """
+    codec_name = codec_name.lower().replace('-', '_')
+    for name, file_name in constants.CHARACTER_MAP_NAME_TO_RESOURCE_FILE_NAME.items():
+        for alias in [name, file_name.rsplit('.', 1)[0]]:
+            if codec_name == 'neo_' + alias.replace('-', '_'):
+                return name
+    return None
+
+
+def _search_codec(codec_name):
+    name = _codec_name_to_character_map_name(codec_name)
+    if name is None:
+        return None
+    character_map = _read_named_character_map(name)
+    file_name = constants.CHARACTER_MAP_NAME_TO_RESOURCE_FILE_NAME[name]
+
+    def encode(input, errors='strict'):
+        return NeoIncrementalEncoder(errors, character_map).encode(input, final=True), len(input)
+
+    def decode(input, errors='strict'):
+        return NeoIncrementalDecoder(errors, character_map).decode(input, final=True), len(input)
+
+    return codecs.CodecInfo(
+        name='neo-' + file_name.rsplit('.', 1)[0],
+        encode=encode,
+        decode=decode,
+        incrementalencoder=partial(NeoIncrementalEncoder, character_map=character_map),
+        incrementaldecoder=partial(NeoIncrementalDecoder, character_map=character_map),
+    )
+
+
+codecs.register(_search_codec)
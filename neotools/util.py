@@ -1,63 +1,194 @@
-from typing import List
+import logging
+import os
+import struct
+import sys
+from enum import Enum
+from functools import update_wrapper
+from pathlib import Path
 
-
-def string_from_buf(buf, offset, width):
-    c_str = buf[offset:offset + width]
-    null_index = c_str.find(0)
-    substr = c_str if null_index == -1 else c_str[:null_index]
-    return substr.decode()
+logger = logging.getLogger(__name__)
 
 
 def int_from_buf(buf, offset, width):
     return int.from_bytes(buf[offset:offset + width], byteorder='big', signed=False)
 
 
-def string_to_buf(buf: List[int], offset, width, value: str):
-    raw = value.encode('utf-8')
-    if len(value) > width:
-        raise ValueError('String is too long %s' % raw)
-    for i in range(len(raw)):
-        buf[offset + i] = raw[i]
+def calculate_data_checksum(buf):
+    return sum(buf) & 0xFFFF
 
 
-def int_to_buf(buf, offset, width, value):
-    raw = int.to_bytes(value, length=width, byteorder='big', signed=False)
-    for i in range(len(raw)):
-        buf[offset + i] = raw[i]
+class Record:
+    """
+    Base of the record types made by BinaryFormat. The fields are slots, and they
+    can be read by key as well, like the dicts that the records replace.
+    """
+    __slots__ = ()
+
+    def __init__(self, *args, **kwargs):
+        for name, value in zip(self.__slots__, args):
+            setattr(self, name, value)
+        for name, value in kwargs.items():
+            self[name] = value
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.to_tuple() == other.to_tuple()
+
+    # The records are mutable, like the dicts they replace, so they are not hashable.
+    # Use to_tuple() for a key.
+    __hash__ = None
+
+    def __repr__(self):
+        fields = ', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)
+        return f'{type(self).__name__}({fields})'
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self.__slots__ else default
+
+    def keys(self):
+        return self.__slots__
+
+    def to_tuple(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class BinaryFormat:
+    """
+    A layout, such as APPLET_HEADER_FORMAT, compiled into a struct.Struct.
+    Decoding reads from any buffer at an offset without copying it, and returns
+    an instance of the record type of the format. The gaps between the fields
+    are skipped on decoding and zeroed on encoding.
+    """
+    _INT_CODES = {1: 'B', 2: 'H', 4: 'I'}
+
+    def __init__(self, name, buf_format, module=__name__):
+        fields = sorted(buf_format['fields'].items(), key=lambda item: item[1][0])
+        codes = ['>']
+        position = 0
+        self._strings = []  # (index, width) of the null terminated strings
+        self._wide_ints = []  # (index, width) of the ints that struct has no code for
+        for index, (field, (offset, width, typ)) in enumerate(fields):
+            if offset < position:
+                raise ValueError(f'Field {field} of {name} overlaps the previous field')
+            if offset > position:
+                codes.append(f'{offset - position}x')
+            if typ is int and width in self._INT_CODES:
+                codes.append(self._INT_CODES[width])
+            else:
+                codes.append(f'{width}s')
+                (self._strings if typ is str else self._wide_ints).append((index, width))
+            position = offset + width
+        self.size = buf_format['size']
+        if self.size is not None and self.size > position:
+            codes.append(f'{self.size - position}x')
+        self.struct = struct.Struct(''.join(codes))
+        self.fields = [field for field, _ in fields]
+        self.record = type(name, (Record,), {'__slots__': tuple(self.fields), '__module__': module})
+
+    def unpack_from(self, buf, offset=0):
+        if len(buf) - offset < self.struct.size:
+            if self.size is not None:
+                raise NeotoolsError(f'Expected buffer of size {self.struct.size}, received {len(buf) - offset}')
+            # The layouts without a fixed size may come in shorter, with the missing fields zeroed.
+            buf = bytes(buf[offset:]).ljust(self.struct.size, b'\0')
+            offset = 0
+        values = self.struct.unpack_from(buf, offset)
+        if self._strings or self._wide_ints:
+            values = list(values)
+            for index, _ in self._strings:
+                raw = values[index]
+                null_index = raw.find(0)
+                values[index] = (raw if null_index == -1 else raw[:null_index]).decode()
+            for index, _ in self._wide_ints:
+                values[index] = int.from_bytes(values[index], byteorder='big', signed=False)
+        return self.record(*values)
+
+    def unpack(self, buf):
+        if self.size is not None and self.size != len(buf):
+            raise NeotoolsError(f'Expected buffer of size {self.size}, received {len(buf)}')
+        return self.unpack_from(buf)
+
+    def pack_into(self, buf, offset, value):
+        """
+        Encode a record or a mapping into the buffer. The missing fields are zeroed.
+        """
+        values = [value.get(field, 0) for field in self.fields]
+        for index, width in self._strings:
+            raw = (values[index] or '').encode('utf-8')
+            if len(raw) > width:
+                raise ValueError('String is too long %s' % raw)
+            values[index] = raw
+        for index, width in self._wide_ints:
+            values[index] = int.to_bytes(values[index], length=width, byteorder='big', signed=False)
+        self.struct.pack_into(buf, offset, *values)
+
+    def pack(self, value):
+        buf = bytearray(self.struct.size)
+        self.pack_into(buf, 0, value)
+        return buf
 
 
-def calculate_data_checksum(buf):
-    return sum(buf) & 0xFFFF
+class NeotoolsError(RuntimeError):
+    pass
 
 
-def data_from_buf(buf_format, buf):
-    if buf_format['size'] is not None and buf_format['size'] != len(buf):
-        raise NeotoolsError(
-            'Expected buffer of size %s, received %s' %
-            (buf_format['size'], len(buf)))
-    converters = {
-        str: string_from_buf,
-        int: int_from_buf
-    }
-    return {
-        k: converters[typ](buf, offset, width)
-        for k, (offset, width, typ) in buf_format['fields'].items()
-    }
-
-
-def data_to_buf(buf_format, buf, value, buf_offset=0):
-    if buf_format['size'] is not None and buf_format['size'] + buf_offset < len(buf):
-        raise NeotoolsError(
-            'Buffer too small, required size=%s, received=%s, offset=%s' %
-            (buf_format['size'], len(buf), buf_offset))
-    converters = {
-        str: string_to_buf,
-        int: int_to_buf
-    }
-    for k, (offset, width, typ) in buf_format['fields'].items():
-        if k in value:
-            converters[typ](buf, buf_offset + offset, width, value[k])
+class OperationCancelled(NeotoolsError):
+    """A transfer was cancelled by a progress listener or Device.cancel."""
+    pass
 
 
-class NeotoolsError(RuntimeError):
+class ChecksumError(NeotoolsError):
+    """The data from the device does not match its checksum, for example on a flaky USB hub."""
     pass
+
+
+def command_decorator(f):
+    def new_func(*args, **kwargs):
+        try:
+            result = f(*args, **kwargs)
+        except NeotoolsError as e:
+            if logger.level == logging.DEBUG:
+                logger.exception(e)
+            else:
+                logger.error(e)
+            sys.exit(1)
+        return result
+
+    return update_wrapper(new_func, f)
+
+
+def json_default(val):
+    if isinstance(val, Enum):
+        return val.name
+    elif isinstance(val, bytes):
+        return str(val)[2:-1]
+    elif isinstance(val, Record):
+        return val.to_dict()
+    elif isinstance(val, object) and hasattr(val, '__dict__'):
+        return val.__dict__
+    else:
+        return str(val)
+
+
+def user_cache_dir():
+    """Directory for the caches and indexes that neotools keeps between runs."""
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    path = Path(base) / 'neotools'
+    path.mkdir(parents=True, exist_ok=True)
+    return path
@@ -0,0 +1,122 @@
+"""
+Harvest the files of every NEO as it is plugged in, for collecting the work of a class.
+
+The USB bus is polled for devices in keyboard mode. Each new device is queued to a pool
+of workers that flip it to comms mode, read its files into a folder of its own and
+restart it in keyboard mode. The devices are told apart by the ports they are plugged into.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from time import sleep, time
+
+import usb.core
+
+from neotools import commands, file
+from neotools.applet.constants import AppletIds
+from neotools.device import Device, HID_PRODUCT_ID, VENDOR_ID, device_location
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 0.5  # seconds
+DEFAULT_JOBS = 4
+# A harvested device restarts in keyboard mode and disappears from the bus for a few seconds.
+# Until then its absence does not mean that it was unplugged.
+RESTART_TIME = 10  # seconds
+
+
+def find_keyboard_devices():
+    """Return the devices in keyboard mode by their location."""
+    devices = {}
+    for dev in usb.core.find(find_all=True, idVendor=VENDOR_ID, idProduct=HID_PRODUCT_ID):
+        location = device_location(dev) or f'{dev.bus}-addr{dev.address}'
+        devices[location] = dev
+    return devices
+
+
+def harvest_device(dev, location, path, applet_id, name_format, character_map):
+    """Read the files of a device in keyboard mode into a new folder, and restart it in keyboard mode."""
+    folder = Path(path) / f'{datetime.now():%Y%m%d-%H%M%S}-{location}'
+    device = Device(dev)
+    device.progress_listener = None  # The devices are processed in parallel
+    saved = []
+    try:
+        device.init()
+        files = file.list_files(device, applet_id)
+        folder.mkdir(parents=True, exist_ok=True)
+        for file_attrs in files:
+            text = commands.read_text(device, applet_id, file_attrs, character_map)
+            if len(text):
+                saved.append(str(commands.write_file_with_format(file_attrs, text, folder, name_format)))
+    finally:
+        device.dispose()
+    return {'location': location, 'path': str(folder), 'files': saved}
+
+
+class Watcher:
+    """
+    Tracks the devices by location and queues the new ones to the workers.
+    The harvest function is called with the device and its location.
+    """
+
+    def __init__(self, harvest, jobs=DEFAULT_JOBS):
+        self.harvest = harvest
+        self.executor = ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='harvest')
+        self.busy = {}  # The futures of the devices being harvested by location
+        self.harvested = {}  # The time until which the absence of a harvested device is ignored
+
+    def poll(self, devices, now):
+        """Queue the new devices and return the results of the finished ones."""
+        results = []
+        for location, future in list(self.busy.items()):
+            if not future.done():
+                continue
+            del self.busy[location]
+            self.harvested[location] = now + RESTART_TIME
+            error = future.exception()
+            if error is None:
+                results.append(future.result())
+            else:
+                logger.debug('Harvest failed', exc_info=error)
+                results.append({'location': location, 'error': {'type': type(error).__name__, 'message': str(error)}})
+
+        for location, ignore_until in list(self.harvested.items()):
+            if location not in devices and now >= ignore_until:
+                logger.info('Device at %s was unplugged', location)
+                del self.harvested[location]
+
+        for location, dev in devices.items():
+            if location not in self.busy and location not in self.harvested:
+                logger.info('Device at %s was plugged in', location)
+                self.busy[location] = self.executor.submit(self.harvest, dev, location)
+        return results
+
+    def shutdown(self):
+        """Wait for the devices that are being harvested."""
+        self.executor.shutdown(wait=True)
+        return self.poll({}, time())
+
+
+def watch(path, on_result, jobs=DEFAULT_JOBS, applet_id=None, name_format=None, character_map_name=None,
+          character_map_path=None):
+    """Harvest the devices until interrupted, calling on_result with the result for each device."""
+    if applet_id is None:
+        applet_id = AppletIds.ALPHAWORD
+    character_map = commands.get_character_map(applet_id, character_map_name, character_map_path)
+    Path(path).mkdir(parents=True, exist_ok=True)
+
+    def harvest(dev, location):
+        return harvest_device(dev, location, path, applet_id, name_format, character_map)
+
+    watcher = Watcher(harvest, jobs)
+    logger.info('Waiting for devices')
+    try:
+        while True:
+            for result in watcher.poll(find_keyboard_devices(), time()):
+                on_result(result)
+            sleep(POLL_INTERVAL)
+    except KeyboardInterrupt:
+        logger.info('Stopping after the devices in progress')
+        for result in watcher.shutdown():
+            on_result(result)
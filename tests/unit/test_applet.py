@@ -0,0 +1,39 @@
+from unittest import mock
+
+import pytest
+
+import neotools.applet.applet
+from neotools.applet.applet import get_applet, invalidate_applet_list, read_applet_list
+from neotools.applet.constants import APPLET_HEADER, SIGNATURE_START
+from neotools.device import Device
+
+
+def raw_header(applet_id, name):
+    return bytes(APPLET_HEADER.pack({'signature': SIGNATURE_START, 'applet_id': applet_id, 'name': name}))
+
+
+@pytest.fixture
+def device():
+    device = mock.create_autospec(Device, instance=True)
+    device.applets = None
+    return device
+
+
+@pytest.fixture
+def raw_read_applet_headers(monkeypatch):
+    headers = [raw_header(0, 'System'), raw_header(0xa000, 'AlphaWord Plus')]
+    mock_read = mock.Mock(side_effect=lambda device, index: b''.join(headers[index:]))
+    monkeypatch.setattr(neotools.applet.applet, 'raw_read_applet_headers', mock_read)
+    return mock_read
+
+
+def test_read_applet_list_is_cached(device, raw_read_applet_headers):
+    assert [applet['name'] for applet in read_applet_list(device)] == ['System', 'AlphaWord Plus']
+    assert get_applet(device, 0xa000)['name'] == 'AlphaWord Plus'
+    assert get_applet(device, 0xa001) is None
+    assert len(read_applet_list(device)) == 2
+    assert raw_read_applet_headers.call_count == 1
+
+    invalidate_applet_list(device)
+    assert get_applet(device, 0)['name'] == 'System'
+    assert raw_read_applet_headers.call_count == 2
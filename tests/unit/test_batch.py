@@ -0,0 +1,63 @@
+import io
+import json
+from contextlib import contextmanager
+from unittest import mock
+
+import pytest
+
+import neotools.batch
+from neotools.device import Device
+from neotools.util import NeotoolsError
+
+
+@pytest.fixture
+def device(monkeypatch):
+    device = mock.create_autospec(Device)
+    connections = []
+
+    @contextmanager
+    def connect():
+        connections.append(device)
+        yield device
+
+    monkeypatch.setattr(Device, 'connect', connect)
+    device.connections = connections
+    return device
+
+
+def test_run_operation_rejects_unknown_parameters(device):
+    with pytest.raises(NeotoolsError, match='Invalid parameters'):
+        neotools.batch.run_operation(device, 'info', {'verbose': True})
+    with pytest.raises(NeotoolsError, match='Unknown operation'):
+        neotools.batch.run_operation(device, 'format', {})
+    with pytest.raises(NeotoolsError, match='files must be an object'):
+        neotools.batch.run_operation(device, 'write-many', {'files': ['a']})
+
+
+def test_run_batch_uses_one_connection(device, monkeypatch):
+    monkeypatch.setattr(neotools.commands, 'get_system_info', lambda device: {'free_ram': 1024})
+    monkeypatch.setattr(neotools.commands, 'clear_file_by_name_or_space', mock.Mock())
+    script = ['{"op": "info"}', '# comment', '', '{"op": "clear", "file": 2}', '{"op": "info"}']
+    output = io.StringIO()
+
+    assert neotools.batch.run_batch(script, output)
+    assert len(device.connections) == 1
+    results = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert results == [
+        {'step': 1, 'op': 'info', 'result': {'free_ram': 1024}},
+        {'step': 2, 'op': 'clear', 'result': None},
+        {'step': 3, 'op': 'info', 'result': {'free_ram': 1024}},
+    ]
+    neotools.commands.clear_file_by_name_or_space.assert_called_once_with(device, 0xa000, '2')
+
+
+def test_run_batch_stops_on_error(device, monkeypatch):
+    def clear_file(device, applet_id, file_name_or_space):
+        raise NeotoolsError('File not found')
+
+    monkeypatch.setattr(neotools.commands, 'clear_file_by_name_or_space', clear_file)
+    output = io.StringIO()
+
+    assert not neotools.batch.run_batch(['{"op": "clear", "file": "x"}', '{"op": "info"}'], output)
+    assert [json.loads(line) for line in output.getvalue().splitlines()] == [
+        {'step': 1, 'op': 'clear', 'error': {'type': 'NeotoolsError', 'message': 'File not found'}}]
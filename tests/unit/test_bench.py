@@ -0,0 +1,65 @@
+from unittest import mock
+
+import pytest
+
+import neotools.bench
+from neotools.bench import percentiles, run_bench
+from neotools.device import Device
+from neotools.file import FileAttributes
+from neotools.util import NeotoolsError
+
+
+@pytest.fixture
+def device():
+    device = mock.create_autospec(Device, instance=True)
+    device.file_lists = {}
+    return device
+
+
+@pytest.fixture
+def files(monkeypatch):
+    files = mock.Mock()
+    attrs = FileAttributes(3, 'notes', 8, 'write', 0, 1000, 0)
+    files.get_file_by_name_or_space.return_value = attrs
+    files.get_file_attributes.return_value = attrs
+    files.read_file.return_value = b'original'
+    monkeypatch.setattr(neotools.bench, 'file', files)
+    return files
+
+
+def test_percentiles():
+    summary = percentiles([float(i) for i in range(1, 101)])
+    assert (summary['min'], summary['max'], summary['count']) == (1, 100, 100)
+    assert summary['p50'] == pytest.approx(50.5)
+    assert summary['p99'] == pytest.approx(99.01)
+    assert percentiles([2.0])['p90'] == 2.0
+
+
+def test_run_bench(device, files):
+    result = run_bench(device, '8', iterations=3, sizes=[100, 2000])
+
+    assert result['hello']['seconds']['count'] == 3
+    assert device.hello.call_count == 3
+    assert [summary['size'] for summary in result['write']] == [100, 2000]
+    written = [call.args[1] for call in files.raw_write_file.call_args_list]
+    assert [len(data) for data in written] == [100] * 3 + [2000] * 3
+    assert files.raw_read_file.call_count == 6
+    assert result['file'] == {'name': 'notes', 'file_index': 3, 'size': 8}
+    files.apply_file_changes.assert_called_once_with(
+        device, 0xa000, [('create', files.get_file_by_name_or_space.return_value, b'original')])
+    files.create_file.assert_not_called()
+    files.clear_file.assert_not_called()
+
+
+def test_run_bench_restores_the_file_on_failure(device, files):
+    files.raw_write_file.side_effect = OSError('Disconnected')
+    with pytest.raises(OSError):
+        run_bench(device, '8', iterations=1, sizes=[100])
+    files.apply_file_changes.assert_called_once()
+
+
+def test_run_bench_requires_an_existing_file(device, files):
+    files.get_file_by_name_or_space.return_value = None
+    with pytest.raises(NeotoolsError, match='File not found'):
+        run_bench(device, 'missing', iterations=1, sizes=[100])
+    files.raw_write_file.assert_not_called()
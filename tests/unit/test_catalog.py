@@ -0,0 +1,52 @@
+import os
+from unittest import mock
+
+import pytest
+
+import neotools.applet.catalog
+from neotools.applet.catalog import AppletCatalog
+from neotools.applet.constants import APPLET_HEADER, SIGNATURE_END, SIGNATURE_START
+from neotools.util import NeotoolsError
+
+
+def write_applet(path, applet_id, name, version_major, version_minor):
+    buf = APPLET_HEADER.pack({
+        'signature': SIGNATURE_START, 'applet_id': applet_id, 'name': name, 'rom_size': APPLET_HEADER.size + 4,
+        'version_major': version_major, 'version_minor': version_minor, 'version_revision': 0x37})
+    path.write_bytes(bytes(buf) + SIGNATURE_END.to_bytes(4, 'big'))
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    with AppletCatalog(tmp_path / 'applets.sqlite') as catalog:
+        yield catalog
+
+
+def test_catalog_refresh_and_resolve(tmp_path, catalog, monkeypatch):
+    library = tmp_path / 'library'
+    (library / 'old').mkdir(parents=True)
+    write_applet(library / 'old' / 'AlphaWord.OS3KApp', 0xa000, 'AlphaWord Plus', 3, 2)
+    write_applet(library / 'AlphaWord.OS3KApp', 0xa000, 'AlphaWord Plus', 3, 4)
+    (library / 'notes.txt').write_text('not an applet')
+
+    catalog.add_directories([str(library)])
+    assert catalog.refresh() == {'added': 2, 'updated': 0, 'unchanged': 0, 'removed': 0, 'skipped': 1}
+    inspect_applet_file = mock.Mock(wraps=neotools.applet.catalog.inspect_applet_file)
+    monkeypatch.setattr(neotools.applet.catalog, 'inspect_applet_file', inspect_applet_file)
+    assert catalog.refresh() == {'added': 0, 'updated': 0, 'unchanged': 2, 'removed': 0, 'skipped': 1}
+    inspect_applet_file.assert_not_called()
+
+    assert catalog.resolve('0xa000') == str(library / 'AlphaWord.OS3KApp')
+    assert catalog.resolve('alphaword plus', '3.2') == str(library / 'old' / 'AlphaWord.OS3KApp')
+    assert catalog.find(applet_id=0xa000)[0]['version'] == '3.4'
+    with pytest.raises(NeotoolsError):
+        catalog.resolve('40960', '9.9')
+
+    os.remove(library / 'old' / 'AlphaWord.OS3KApp')
+    write_applet(library / 'AlphaWord.OS3KApp', 0xa000, 'AlphaWord Plus', 3, 5)
+    os.utime(library / 'AlphaWord.OS3KApp', ns=(1, 1))
+    (library / 'notes.txt').write_text('still not an applet')
+    stats = catalog.refresh()
+    assert (stats['updated'], stats['removed'], stats['skipped']) == (1, 1, 1)
+    inspect_applet_file.assert_has_calls([mock.call(str(library / 'notes.txt'))], any_order=True)
+    assert [entry['version'] for entry in catalog.find(name='AlphaWord Plus')] == ['3.5']
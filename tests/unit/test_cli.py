@@ -0,0 +1,38 @@
+import subprocess
+import sys
+
+# Generous enough for slow CI machines, but far below the cost of loading pyusb and the protocol modules.
+IMPORT_TIME_BUDGET_US = 250000
+
+DEVICE_MODULES = ['usb', 'neotools.commands', 'neotools.device', 'neotools.file', 'neotools.applet.manager']
+
+
+def import_times(code):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        times[module.strip()] = int(cumulative)
+    return times
+
+
+def test_cli_import_does_not_load_device_modules():
+    times = import_times('import neotools.cli')
+    assert not [module for module in DEVICE_MODULES if module in times]
+    assert times['neotools.cli'] < IMPORT_TIME_BUDGET_US
+
+
+def test_inspect_does_not_load_device_modules(tmp_path):
+    applet_path = tmp_path / 'Test.OS3KApp'
+    applet_path.write_bytes(bytes.fromhex('c0ffeead') + bytes(0x100) + bytes.fromhex('cafefeed'))
+    code = ('from neotools.cli import cli\n'
+            'try:\n'
+            f'    cli(["applets", "inspect", {str(applet_path)!r}])\n'
+            'except SystemExit:\n'
+            '    pass\n')
+    times = import_times(code)
+    assert 'neotools.applet.inspect' in times
+    assert not [module for module in DEVICE_MODULES if module in times]
@@ -1,10 +1,15 @@
+import errno
 from unittest import mock
 
 import neotools.commands
 import pytest
+from neotools import metrics
 from neotools.applet.constants import AppletIds
 from neotools.device import Device
 from neotools.file import FileAttributes, FileConst
+from neotools.message import Message, MessageConst
+from neotools.util import calculate_data_checksum, ChecksumError, NeotoolsError
+from usb.core import USBError
 
 
 # fmt: off
@@ -81,9 +86,9 @@ def file_list():
 @pytest.fixture
 def patch_list_files(monkeypatch, file_list):
     def mockreturn(device, applet_id):
-        return file_list
+        return iter(file_list)
 
-    monkeypatch.setattr(neotools.file, "list_files", mockreturn)
+    monkeypatch.setattr(neotools.file, "iter_files", mockreturn)
 
 
 def test_get_file_attributes_from_raw(file_attributes, raw_attributes):
@@ -100,9 +105,9 @@ def test_get_file_attributes_from_raw(file_attributes, raw_attributes):
 
 def test_get_file_by_name_or_space_no_files(device, monkeypatch):
     def mockreturn(device, applet_id):
-        return []
+        return iter([])
 
-    monkeypatch.setattr(neotools.file, "list_files", mockreturn)
+    monkeypatch.setattr(neotools.file, "iter_files", mockreturn)
     assert (
         neotools.file.get_file_by_name_or_space(device, AppletIds.ALPHAWORD, "test")
         is None
@@ -120,3 +125,156 @@ def test_get_file_by_name_or_space(device, patch_list_files, file_list):
         )
         is file_list[2]
     )
+
+
+def test_file_attributes_to_raw(file_attributes, raw_attributes):
+    raw = file_attributes.to_raw()
+    assert raw[0x18:0x26] == raw_attributes[0x18:0x26]
+    assert file_attributes.space == 5
+    assert FileAttributes.from_raw(5, raw) == file_attributes
+
+
+def test_find_file_stops_at_first_match(monkeypatch, file_list):
+    device = mock.create_autospec(Device, instance=True)
+    device.file_lists = {}
+    mock_get = mock.Mock(side_effect=lambda device, applet_id, index: (file_list + [None])[index - 1])
+    monkeypatch.setattr(neotools.file, "get_file_attributes", mock_get)
+
+    assert neotools.file.get_file_by_name_or_space(device, AppletIds.ALPHAWORD, "1") is file_list[0]
+    assert mock_get.call_count == 1
+    assert AppletIds.ALPHAWORD not in device.file_lists
+
+    assert neotools.file.list_files(device, AppletIds.ALPHAWORD)[0] is file_list[2]
+    assert mock_get.call_count == 6
+    assert neotools.file.find_file(device, AppletIds.ALPHAWORD, name="world", space=5) is file_list[3]
+    assert mock_get.call_count == 6
+
+
+def test_list_all_file_attributes(monkeypatch, file_list):
+    applets = [
+        {'applet_id': 0, 'name': 'System', 'file_count': 0},
+        {'applet_id': AppletIds.ALPHAWORD, 'name': 'AlphaWord Plus', 'file_count': 8},
+        {'applet_id': 0xa001, 'name': 'KAZ', 'file_count': 1},
+    ]
+    monkeypatch.setattr(neotools.commands, 'read_applet_list', lambda device: applets)
+    list_files = mock.Mock(side_effect=lambda device, applet_id: file_list if applet_id == AppletIds.ALPHAWORD else [])
+    monkeypatch.setattr(neotools.file, 'list_files', list_files)
+
+    [snapshot] = neotools.commands.list_all_file_attributes(mock.create_autospec(Device), False)
+    assert snapshot['applet_id'] == AppletIds.ALPHAWORD
+    assert [f['name'] for f in snapshot['files']] == ['foo', 'bar', 'hello', 'world']
+    assert [call.args[1] for call in list_files.call_args_list] == [AppletIds.ALPHAWORD, 0xa001]
+
+
+def test_read_file_restarts_after_transient_error(device, file_attributes, monkeypatch):
+    blocks = [b'a' * 1024, b'b' * 1024, b'c' * 10]
+    attempts = []
+
+    def raw_read_file_blocks(device, applet_id, file_attrs, raw):
+        attempts.append(applet_id)
+        yield blocks[0]
+        if len(attempts) == 1:
+            raise USBError('Operation timed out', errno=errno.ETIMEDOUT)
+        yield from blocks[1:]
+
+    monkeypatch.setattr(neotools.file, 'raw_read_file_blocks', raw_read_file_blocks)
+    retries = metrics.TRANSFER_RETRIES.value(operation='read_file')
+
+    read = list(neotools.file.iter_read_file(device, AppletIds.ALPHAWORD, file_attributes))
+
+    assert b''.join(read) == b''.join(blocks)
+    assert len(read) == 3 and read[1] == blocks[1]
+    assert len(attempts) == 2
+    device.resync.assert_called_once()
+    assert metrics.TRANSFER_RETRIES.value(operation='read_file') - retries == 1
+
+    attempts.clear()
+    monkeypatch.setattr(neotools.file, 'TRANSFER_ATTEMPTS', 1)
+    with pytest.raises(USBError):
+        neotools.file.read_file(device, AppletIds.ALPHAWORD, file_attributes)
+
+
+def test_read_file_ends_dialogue_when_stopped_early(device, file_attributes, monkeypatch):
+    closed = []
+
+    def raw_read_file_blocks(device, applet_id, file_attrs, raw):
+        try:
+            yield b'a' * 1024
+            yield b'b' * 1024
+        finally:
+            closed.append(True)
+
+    monkeypatch.setattr(neotools.file, 'raw_read_file_blocks', raw_read_file_blocks)
+    blocks = neotools.file.iter_read_file(device, AppletIds.ALPHAWORD, file_attributes)
+    assert next(blocks) == b'a' * 1024
+    blocks.close()
+
+    device.dialogue_end.assert_called_once()
+    assert closed == [True]
+
+
+def test_read_file_restarts_after_bad_checksum(device, file_attributes, monkeypatch):
+    data = bytes(range(256)) * 4
+    checksum = calculate_data_checksum(data)
+    block_response = Message(MessageConst.RESPONSE_BLOCK_READ, [(len(data), 1, 4), (checksum, 5, 2)])
+
+    def send_message(device, message, success_code=None, **kwargs):
+        return block_response if message.command() == MessageConst.REQUEST_BLOCK_READ else message
+
+    monkeypatch.setattr(neotools.file, 'send_message', send_message)
+    device.read.side_effect = [b'\xff' + data[1:], data]
+    file_attributes.alloc_size = len(data)
+
+    assert neotools.file.read_file(device, AppletIds.ALPHAWORD, file_attributes) == data
+    device.resync.assert_called_once()
+
+    device.read.side_effect = [b'\xff' + data[1:]]
+    monkeypatch.setattr(neotools.file, 'TRANSFER_ATTEMPTS', 1)
+    with pytest.raises(ChecksumError):
+        neotools.file.read_file(device, AppletIds.ALPHAWORD, file_attributes)
+
+
+def test_write_texts_in_one_dialogue(device, file_list, monkeypatch):
+    device.file_lists = {}
+    list_files = mock.Mock(return_value=file_list)
+    free_space = mock.Mock(return_value={'free_ram': 3000, 'free_rom': 0})
+    raw_commit = mock.Mock()
+    raw_write = mock.Mock()
+    monkeypatch.setattr(neotools.file, 'list_files', list_files)
+    monkeypatch.setattr(neotools.file, 'get_available_space', free_space)
+    monkeypatch.setattr(neotools.file, 'raw_commit_file_attributes', raw_commit)
+    monkeypatch.setattr(neotools.file, 'raw_write_file', raw_write)
+
+    texts = [('1', b'a' * 100), ('new', b'b' * 500), ('hello', b'c' * 10)]
+    neotools.commands.write_texts(device, 0xa001, texts, None)
+
+    list_files.assert_called_once()
+    free_space.assert_called_once()
+    assert device.dialogue_start.call_count == 1
+    [(_, attrs, _)] = [call.args for call in raw_commit.call_args_list]
+    assert (attrs.file_index, attrs.name, attrs.alloc_size) == (len(file_list) + 1, 'new', 500)
+    writes = [(call.args[3], len(call.args[1])) for call in raw_write.call_args_list]
+    assert writes == [(0, 100), (len(file_list) + 1, 500), (2, 10)]
+
+
+def test_write_texts_checks_free_ram_first(device, file_list, monkeypatch):
+    device.file_lists = {}
+    raw_write = mock.Mock()
+    monkeypatch.setattr(neotools.file, 'list_files', mock.Mock(return_value=file_list))
+    monkeypatch.setattr(neotools.file, 'get_available_space', mock.Mock(return_value={'free_ram': 3000, 'free_rom': 0}))
+    monkeypatch.setattr(neotools.file, 'raw_write_file', raw_write)
+
+    with pytest.raises(NeotoolsError, match='enough RAM'):
+        neotools.commands.write_texts(device, 0xa001, [('new', b'b' * 2000), ('other', b'b' * 1000)], None)
+    raw_write.assert_not_called()
+
+
+def test_clear_files_reports_missing_files_first(device, file_list, monkeypatch):
+    device.file_lists = {}
+    raw_write = mock.Mock()
+    monkeypatch.setattr(neotools.file, 'list_files', mock.Mock(return_value=file_list))
+    monkeypatch.setattr(neotools.file, 'raw_write_file', raw_write)
+
+    with pytest.raises(NeotoolsError, match='Files not found: 7, missing'):
+        neotools.commands.clear_files_by_name_or_space(device, 0xa001, ['1', '7', 'missing'])
+    raw_write.assert_not_called()
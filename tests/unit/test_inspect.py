@@ -0,0 +1,39 @@
+from neotools.applet.constants import APPLET_HEADER, SIGNATURE_END, SIGNATURE_START
+from neotools.applet.inspect import extract_applets, inspect_applet_files
+
+
+def test_inspect_applet_files(tmp_path):
+    (tmp_path / 'roms').mkdir()
+    (tmp_path / 'Calculator.OS3KApp').write_bytes(bytes.fromhex('c0ffeead') + bytes(0x100) + bytes.fromhex('cafefeed'))
+    (tmp_path / 'roms' / 'neo.os3kos').write_bytes(bytes(0x400) + b'System 3 Neo      ' + bytes(0x1000))
+    (tmp_path / 'roms' / 'empty.bin').write_bytes(b'')
+
+    results = list(inspect_applet_files([str(tmp_path)], jobs=2))
+
+    assert [r['path'] for r in results] == [str(tmp_path / 'Calculator.OS3KApp'),
+                                            str(tmp_path / 'roms' / 'empty.bin'),
+                                            str(tmp_path / 'roms' / 'neo.os3kos')]
+    assert results[0]['applet_type'] == 'Applet program'
+    assert results[1]['error'] == 'Empty file'
+    assert results[2]['applet_type'] == 'System 3 Neo'
+
+
+def test_extract_applets(tmp_path):
+    def applet(applet_id, name, size):
+        header = APPLET_HEADER.pack({'signature': SIGNATURE_START, 'applet_id': applet_id, 'name': name,
+                                     'rom_size': size, 'version_major': 3, 'version_minor': 4})
+        return bytes(header) + bytes(size - len(header) - 4) + SIGNATURE_END.to_bytes(4, 'big')
+
+    kaz = applet(0xa002, 'KAZ', 0x200)
+    # A signature without a valid end signature, and a header cut off by the end of the image
+    broken = SIGNATURE_START.to_bytes(4, 'big') + bytes(0x200)
+    rom = bytes(0x400) + b'System 3 Neo      ' + applet(0xa000, 'AlphaWord Plus', 0x300) + broken + kaz + broken[:0x10]
+    (tmp_path / 'neo.os3kos').write_bytes(rom)
+
+    result = extract_applets(tmp_path / 'neo.os3kos', tmp_path / 'out')
+
+    assert [(r['applet_id'], r['name'], r['version']) for r in result] == \
+        [(0xa000, 'AlphaWord Plus', '3.4'), (0xa002, 'KAZ', '3.4')]
+    assert result[1]['offset'] == rom.index(kaz)
+    assert (tmp_path / 'out' / 'a002-KAZ.OS3KApp').read_bytes() == kaz
+    assert (tmp_path / 'out' / 'a000-AlphaWord_Plus.OS3KApp').exists()
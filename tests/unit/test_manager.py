@@ -0,0 +1,123 @@
+from unittest import mock
+
+import pytest
+from usb.core import USBError
+
+import neotools.applet.manager
+from neotools.applet.constants import APPLET_HEADER, SIGNATURE_END, SIGNATURE_START
+from neotools.applet.manager import plan_applet_installs
+from neotools.device import Device
+from neotools.util import NeotoolsError
+
+
+def applet_content(applet_id, rom_size, ram_size):
+    buf = APPLET_HEADER.pack({
+        'signature': SIGNATURE_START, 'applet_id': applet_id, 'name': f'Applet {applet_id}',
+        'rom_size': rom_size, 'ram_size': ram_size})
+    return bytes(buf) + SIGNATURE_END.to_bytes(4, 'big')
+
+
+@pytest.fixture
+def device(monkeypatch):
+    device = mock.create_autospec(Device, instance=True)
+    device.applets = {0xa000: {'applet_id': 0xa000, 'name': 'AlphaWord Plus'}}
+    monkeypatch.setattr(neotools.applet.manager, 'get_available_space',
+                        lambda device: {'free_rom': 3000, 'free_ram': 300})
+    return device
+
+
+def test_plan_orders_by_applet_id(device):
+    plan = plan_applet_installs(device, [applet_content(0xa007, 1000, 100), applet_content(0xa002, 1000, 100)])
+    assert [header['applet_id'] for header, _, _ in plan] == [0xa002, 0xa007]
+
+
+def test_install_reads_the_applet_list_once(device, monkeypatch):
+    get_applet = mock.Mock(side_effect=lambda device, applet_id: device.applets.get(applet_id))
+    remove_applet = mock.Mock()
+    write_applet = mock.Mock()
+    monkeypatch.setattr(neotools.applet.manager, 'get_applet', get_applet)
+    monkeypatch.setattr(neotools.applet.manager, 'remove_applet', remove_applet)
+    monkeypatch.setattr(neotools.applet.manager, 'write_applet', write_applet)
+
+    neotools.applet.manager.install_applets(
+        device, [applet_content(0xa007, 1000, 100), applet_content(0xa000, 1000, 100)], force=True)
+
+    assert get_applet.call_count == 2
+    remove_applet.assert_called_once_with(device, 0xa000)
+    assert [call.args[1]['applet_id'] for call in write_applet.call_args_list] == [0xa000, 0xa007]
+
+
+def test_plan_checks_the_whole_set(device):
+    contents = [applet_content(0xa002, 1000, 100), applet_content(0xa007, 1000, 100)]
+    with pytest.raises(NeotoolsError, match='ROM'):
+        plan_applet_installs(device, contents + [applet_content(0xa008, 1001, 0)])
+    with pytest.raises(NeotoolsError, match='RAM'):
+        plan_applet_installs(device, contents + [applet_content(0xa008, 0, 101)])
+    with pytest.raises(NeotoolsError, match='already installed'):
+        plan_applet_installs(device, contents + [applet_content(0xa000, 0, 0)])
+    assert len(plan_applet_installs(device, contents + [applet_content(0xa000, 0, 0)], force=True)) == 3
+    device.write.assert_not_called()
+
+
+def test_write_applet_content_frames(device, monkeypatch):
+    received = []
+    monkeypatch.setattr(neotools.applet.manager, 'receive_message',
+                        lambda device, code, timeout: received.append(code))
+    content = bytes(range(256)) * 5
+
+    neotools.applet.manager._write_applet_content(device, content)
+
+    writes = device.write.call_args_list
+    assert len(writes) == 6
+    assert bytes(writes[0].args[0]) == bytes([0x02, 0, 0, 0x04, 0, 0xfe, 0x00, 0x04])
+    assert bytes(writes[1].args[0]) == content[:0x400]
+    assert writes[1].kwargs['packet_size'] == 64
+    assert bytes(writes[4].args[0]) == content[0x400:]
+    assert received == [0x42, 0x43, 0x47] * 2
+    device.report_progress.assert_called_with(len(content), len(content))
+
+
+def test_wait_for_finalization_backs_off(device, monkeypatch):
+    polls = []
+
+    def receive_message(device, code, timeout):
+        polls.append(timeout)
+        if len(polls) < 3:
+            raise USBError('Operation timed out')
+
+    monkeypatch.setattr(neotools.applet.manager, 'receive_message', receive_message)
+    assert neotools.applet.manager.wait_for_finalization(device) >= 0
+    assert polls == [250, 500, 1000]
+
+
+def test_wait_for_finalization_gives_up(device, monkeypatch):
+    def receive_message(device, code, timeout):
+        raise USBError('Operation timed out')
+
+    monkeypatch.setattr(neotools.applet.manager, 'receive_message', receive_message)
+    with pytest.raises(NeotoolsError, match='did not finalize'):
+        neotools.applet.manager.wait_for_finalization(device, timeout=0)
+
+
+def test_fetch_applet_uses_cache(device, monkeypatch, tmp_path):
+    from neotools.applet.cache import AppletCache
+    from neotools.applet.constants import AppletHeader
+    content = applet_content(0xa007, 0x40, 0) + bytes(range(0x40))
+    header = APPLET_HEADER.unpack_from(content)
+    device.applets = {0xa007: header, 0xa008: AppletHeader(**{**header.to_dict(), 'applet_id': 0xa008})}
+    read_content = mock.Mock(return_value=content)
+    monkeypatch.setattr(neotools.applet.manager, 'read_applet_content', read_content)
+    cache = AppletCache(tmp_path)
+
+    fetch = neotools.applet.manager.fetch_applet
+    assert fetch(device, 0xa007, cache=cache) == content
+    assert fetch(device, 0xa007, cache=AppletCache(tmp_path)) == content
+    assert read_content.call_count == 1
+    assert fetch(device, 0xa007, verify=True, cache=cache) == content
+    assert read_content.call_count == 2
+
+    # The content of another applet is not cached under its header
+    assert fetch(device, 0xa008, cache=cache) == content
+    assert fetch(device, 0xa008, cache=cache) == content
+    assert read_content.call_count == 4
+    assert len(list((tmp_path / 'blobs').iterdir())) == 1
@@ -0,0 +1,69 @@
+import urllib.request
+from unittest import mock
+
+import pytest
+
+from neotools import metrics
+from neotools.device import Device
+from neotools.message import Message, MessageConst, send_message
+from neotools.metrics import Registry, serve_metrics
+
+
+@pytest.fixture
+def registry():
+    registry = Registry()
+    registry.counter('neo_messages', 'Messages "sent"', ['request']).inc(2, request='REQUEST_VERSION')
+    registry.histogram('neo_latency_seconds', 'Latency', ['operation'], buckets=[0.01, 0.1]).observe(0.05, operation='hello')
+    return registry
+
+
+def test_openmetrics_text(registry):
+    assert registry.to_openmetrics().splitlines() == [
+        '# TYPE neo_messages counter',
+        '# HELP neo_messages Messages \\"sent\\"',
+        'neo_messages_total{request="REQUEST_VERSION"} 2',
+        '# TYPE neo_latency_seconds histogram',
+        '# HELP neo_latency_seconds Latency',
+        'neo_latency_seconds_bucket{operation="hello",le="0.01"} 0',
+        'neo_latency_seconds_bucket{operation="hello",le="0.1"} 1',
+        'neo_latency_seconds_bucket{operation="hello",le="+Inf"} 1',
+        'neo_latency_seconds_count{operation="hello"} 1',
+        'neo_latency_seconds_sum{operation="hello"} 0.05',
+        '# EOF',
+    ]
+    with pytest.raises(ValueError):
+        registry.metrics['neo_messages'].inc(request='REQUEST_VERSION', applet_id=0)
+
+
+def test_write_and_serve(registry, tmp_path):
+    path = tmp_path / 'neo.prom'
+    registry.write(path)
+    assert path.read_text() == registry.to_openmetrics()
+
+    server = serve_metrics(0, registry=registry)
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{server.server_address[1]}/metrics') as response:
+            assert response.headers['Content-Type'].startswith('application/openmetrics-text')
+            assert response.read().decode() == registry.to_openmetrics()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_device_counts_bytes_and_messages():
+    dev = mock.Mock()
+    device = Device(dev)
+    device.in_endpoint = mock.Mock()
+    device.out_endpoint = mock.Mock()
+    device.in_endpoint.read.return_value = bytes(Message(MessageConst.RESPONSE_GET_AVAIL_SPACE, []).m_data)
+    written = metrics.WRITTEN_BYTES.value()
+    read = metrics.READ_BYTES.value()
+    sent = metrics.MESSAGES_SENT.value(request='REQUEST_GET_AVAIL_SPACE')
+    observed = metrics.LATENCY.count(operation='REQUEST_GET_AVAIL_SPACE')
+
+    send_message(device, Message(MessageConst.REQUEST_GET_AVAIL_SPACE, []), MessageConst.RESPONSE_GET_AVAIL_SPACE)
+
+    assert metrics.WRITTEN_BYTES.value() - written == 8
+    assert metrics.READ_BYTES.value() - read == 8
+    assert metrics.MESSAGES_SENT.value(request='REQUEST_GET_AVAIL_SPACE') - sent == 1
+    assert metrics.LATENCY.count(operation='REQUEST_GET_AVAIL_SPACE') - observed == 1
@@ -0,0 +1,66 @@
+import struct
+
+from neotools.message import Message, MessageConst
+import neotools.pcap
+from neotools.pcap import USBMON_HEADER, decode_capture, decode_captures
+
+
+def block(block_type, body):
+    body = body + bytes(-len(body) % 4)
+    length = len(body) + 12
+    return struct.pack('<II', block_type, length) + body + struct.pack('<I', length)
+
+
+def packet(seconds, device, endpoint, event, data):
+    header = USBMON_HEADER.pack(0, event, 3, endpoint, device, 1, b'-', b'=', int(seconds),
+                                int(seconds % 1 * 1e6), 0, len(data), len(data))
+    captured = header.ljust(64, b'\0') + data
+    return block(6, struct.pack('<IIIII', 0, 0, 0, len(captured), len(captured)) + captured)
+
+
+def test_decode_capture(tmp_path):
+    get_settings = bytes(Message(MessageConst.REQUEST_GET_SETTINGS, [(15, 1, 4), (0xa000, 5, 2)]).m_data)
+    settings = bytes(Message(MessageConst.RESPONSE_GET_SETTINGS, [(10, 1, 4), (0, 5, 2)]).m_data)
+    capture = b''.join([
+        block(0x0A0D0D0A, struct.pack('<IHHq', 0x1A2B3C4D, 1, 0, -1)),
+        block(1, struct.pack('<HHI', 220, 0, 0)),
+        packet(10.0, 2, 0x02, b'S', b'\x12' * 8),  # Another device of the virtual machine
+        packet(10.5, 5, 0x02, b'S', b'?\xff\x00reset'),
+        packet(11.0, 5, 0x02, b'S', get_settings),
+        packet(11.04, 5, 0x82, b'C', settings),
+        packet(11.08, 5, 0x82, b'C', bytes(8)),
+        packet(11.12, 5, 0x82, b'C', bytes(2)),
+    ])
+    path = tmp_path / 'capture.pcapng'
+    path.write_bytes(capture)
+
+    records = list(decode_capture(path))
+
+    assert {record['device'] for record in records} == {'1.5'}
+    assert [record['kind'] for record in records] == ['reset', 'message', 'message', 'data']
+    assert records[1]['name'] == 'REQUEST_GET_SETTINGS'
+    assert records[2]['name'] == 'RESPONSE_GET_SETTINGS'
+    assert abs(records[2]['latency'] - 0.04) < 1e-5
+    assert records[3]['tag'] == 'RESPONSE_GET_SETTINGS'
+    assert (records[3]['size'], records[3]['packets']) == (10, 2)
+
+    assert [list(transcript) for transcript in decode_captures([path, path], jobs=2)] == [records, records]
+
+
+def test_decode_capture_streams_records(monkeypatch):
+    reset = b'?\xff\x00reset'
+    transfers = [(0.0, '1.2', False, b'\x01', 0), (0.1, '1.2', True, b'\x00\x01', 0), (0.2, '1.2', False, reset, 0)]
+    transfers += [(1.0 + i, '1.2', False, reset, 0) for i in range(100)]
+    consumed = []
+
+    def iter_bulk_transfers(f):
+        for transfer in transfers:
+            consumed.append(transfer)
+            yield transfer
+
+    monkeypatch.setattr(neotools.pcap, 'iter_bulk_transfers', iter_bulk_transfers)
+    records = decode_capture(__file__)
+    # The records that were held back until the device sent an ASM command come first
+    assert [next(records)['kind'] for _ in range(3)] == ['hello', 'hello', 'reset']
+    assert len(consumed) < len(transfers)
+    assert len(list(records)) == len(transfers) - 3
@@ -0,0 +1,82 @@
+import io
+import signal
+from unittest import mock
+
+import pytest
+
+from neotools.device import Device
+from neotools.file import write_extended_data
+from neotools.message import Message, MessageConst
+from neotools.progress import ProgressBar, TransferRate
+from neotools.util import OperationCancelled
+
+RESET = b'?\xff\x00reset'
+
+
+@pytest.fixture
+def device():
+    device = Device(mock.Mock())
+    device.in_endpoint = mock.Mock()
+    device.out_endpoint = mock.Mock()
+    responses = [MessageConst.RESPONSE_BLOCK_WRITE, MessageConst.RESPONSE_BLOCK_WRITE_DONE] * 3
+    device.in_endpoint.read.side_effect = [bytes(Message(code, []).m_data) for code in responses]
+    return device
+
+
+def written(device):
+    return [bytes(call.args[0]) for call in device.out_endpoint.write.call_args_list]
+
+
+def test_cancel_ends_dialogue_between_blocks(device):
+    events = []
+
+    def listener(transfer):
+        events.append((transfer.operation, transfer.done, transfer.total, transfer.blocks))
+        device.cancel()
+
+    device.progress_listener = listener
+    with pytest.raises(OperationCancelled):
+        with device.track_transfer('Writing file', 3000):
+            write_extended_data(device, bytes(3000))
+
+    assert events == [('Writing file', 1024, 3000, 1)]
+    assert written(device)[-1] == RESET
+    assert written(device).count(RESET) == 1
+    assert not device.cancel_requested.is_set()
+
+
+def test_progress_bar():
+    output = io.StringIO()
+    bar = ProgressBar(output)
+    transfer = TransferRate(2048, 'Reading file')
+    transfer.update(1024)
+    bar(transfer)
+    assert 'Reading file [###############---------------]  50%' in output.getvalue()
+
+
+def test_interrupt_cancels_only_during_transfer(device):
+    bar = ProgressBar(io.StringIO())
+    device.progress_listener = bar
+    handler = signal.getsignal(signal.SIGINT)
+
+    with device.track_transfer('Removing applets', None, cancellable=False):
+        assert signal.getsignal(signal.SIGINT) is handler
+    with device.track_transfer('Writing file', 3000):
+        interrupt = signal.getsignal(signal.SIGINT)
+        interrupt(signal.SIGINT, None)
+        assert device.cancel_requested.is_set()
+        with pytest.raises(KeyboardInterrupt):
+            interrupt(signal.SIGINT, None)
+    assert signal.getsignal(signal.SIGINT) is handler
+    # A cancellation that arrives after the last block does not cancel the next transfer
+    assert not device.cancel_requested.is_set()
+
+
+def test_untracked_blocks_are_not_reported_or_cancelled(device):
+    listener = mock.Mock()
+    device.progress_listener = listener
+    device.cancel()
+    write_extended_data(device, bytes(2000))
+    listener.assert_not_called()
+    assert device.transfer is None
+    assert RESET not in written(device)
@@ -0,0 +1,49 @@
+import io
+import json
+from unittest import mock
+
+import neotools.commands
+from neotools.device import Device
+from neotools.progress import TransferRate
+from neotools.server import Server
+
+
+def test_server_responds_by_id_with_progress(monkeypatch):
+    device = mock.create_autospec(Device, instance=True)
+    device.progress_listener = None
+
+    def get_system_info(device):
+        transfer = TransferRate(2, 'Reading file')
+        for done in (1, 2):
+            transfer.update(done)
+            device.progress_listener(transfer)
+        return {'free_ram': 1024}
+
+    monkeypatch.setattr(neotools.commands, 'get_system_info', get_system_info)
+    output = io.StringIO()
+    requests = ['{"id": 1, "method": "info"}', 'not json', '{"id": "b", "method": "nope", "params": {}}']
+    Server(device, output).serve(requests)
+
+    messages = [json.loads(line) for line in output.getvalue().splitlines()]
+    progress = [{key: message[key] for key in ('id', 'event', 'operation', 'done', 'total', 'blocks')}
+                for message in messages[:2]]
+    assert progress == [{'id': 1, 'event': 'progress', 'operation': 'Reading file', 'done': done, 'total': 2,
+                         'blocks': done} for done in (1, 2)]
+    assert messages[2] == {'id': 1, 'result': {'free_ram': 1024}}
+    assert messages[3]['id'] is None and messages[3]['error']['type'] == 'NeotoolsError'
+    assert messages[4]['id'] == 'b' and 'Unknown operation' in messages[4]['error']['message']
+    assert device.progress_listener is None
+
+
+def test_server_survives_unexpected_errors(monkeypatch):
+    device = mock.create_autospec(Device, instance=True)
+    device.progress_listener = None
+
+    get_system_info = mock.Mock(side_effect=[KeyError('free_ram'), {'free_ram': 1024}])
+    monkeypatch.setattr(neotools.commands, 'get_system_info', get_system_info)
+    output = io.StringIO()
+    Server(device, output).serve(['{"id": 1, "method": "info"}', '{"id": 2, "method": "info"}'])
+
+    messages = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert messages == [{'id': 1, 'error': {'type': 'KeyError', 'message': "'free_ram'"}},
+                        {'id': 2, 'result': {'free_ram': 1024}}]
@@ -0,0 +1,130 @@
+import json
+from unittest import mock
+
+import pytest
+
+import neotools.applet.settings
+import neotools.commands
+from neotools.applet.constants import AppletSettingsRange32, AppletSettingsType
+from neotools.applet.settings import (AppletSettings, AppletSettingsItem, get_system_settings, save_settings_dump,
+                                      settings_from_dump)
+from neotools.commands import apply_profile
+from neotools.device import Device
+from neotools.util import NeotoolsError
+
+OS_VERSION = '3.6 Jun 13 2006'
+
+
+def raw_item(item_type, ident, data):
+    padding = b'\0' * (len(data) & 1)
+    return (item_type.value.to_bytes(2, 'big') + ident.to_bytes(2, 'big') +
+            len(data).to_bytes(2, 'big') + data + padding)
+
+
+SYSTEM_RAW = {
+    0: raw_item(AppletSettingsType.LABEL, 0x4001, b'Auto Repeat\0') + raw_item(AppletSettingsType.LABEL, 0x1001, b'On\0'),
+    7: b'',
+    15: b'',
+}
+APPLET_RAW = raw_item(AppletSettingsType.OPTION, 0x4001, bytes([0x10, 0x01, 0x10, 0x01, 0x10, 0x02]))
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(neotools.applet.settings, 'user_cache_dir', lambda: tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def get_settings_raw(monkeypatch):
+    mock_get = mock.Mock(side_effect=lambda device, applet_id, flags: SYSTEM_RAW[flags])
+    monkeypatch.setattr(neotools.applet.settings, 'get_settings_raw', mock_get)
+    return mock_get
+
+
+def test_system_settings_are_cached_by_os_version(get_settings_raw):
+    device = mock.create_autospec(Device, instance=True)
+    assert get_system_settings(device, OS_VERSION).labels[0x4001].data == 'Auto Repeat'
+    assert get_settings_raw.call_count == 3
+
+    assert get_system_settings(device, OS_VERSION).labels[0x1001].data == 'On'
+    assert get_settings_raw.call_count == 3
+
+    get_system_settings(device, '3.9 Jan 1 2010')
+    assert get_settings_raw.call_count == 6
+
+
+def test_settings_from_dump(tmp_path, get_settings_raw):
+    dump_path = tmp_path / 'dump.json'
+    save_settings_dump(dump_path, OS_VERSION, 0xa000, {7: APPLET_RAW})
+    with pytest.raises(NeotoolsError):
+        settings_from_dump(dump_path)
+
+    get_system_settings(mock.create_autospec(Device, instance=True), OS_VERSION)
+    [item] = settings_from_dump(dump_path).to_dict()
+    assert item['label'] == 'Auto Repeat (16385)'
+    assert item['value']['selected'] == 'On (4097)'
+    assert json.loads(dump_path.read_text())['os_version'] == OS_VERSION
+
+
+def test_apply_profile_writes_only_changes(monkeypatch):
+    def get_settings(device, applet_id, flags):
+        if flags != 7:
+            return AppletSettings([])
+        return AppletSettings([
+            AppletSettingsItem(AppletSettingsType.OPTION, 0x4010, [0x1002, 0x1001, 0x1002]),
+            AppletSettingsItem(AppletSettingsType.RANGE_32, 0x4004, AppletSettingsRange32(5, 4, 59)),
+        ])
+
+    set_settings = mock.Mock()
+    monkeypatch.setattr(neotools.commands, 'get_settings', get_settings)
+    monkeypatch.setattr(neotools.commands, 'set_settings', set_settings)
+    device = mock.create_autospec(Device, instance=True)
+    device.file_lists = {}
+
+    assert apply_profile(device, {0: {0x4004: ['5', '4', '59'], 0x4010: ['4098']}}) == []
+    set_settings.assert_not_called()
+
+    changes = apply_profile(device, {0: {0x4004: ['10', '4', '59'], 0x4010: ['4098']}})
+    assert changes == [{'applet_id': 0, 'ident': 0x4004, 'value': AppletSettingsRange32(10, 4, 59)}]
+    assert set_settings.call_count == 1
+
+    changes = apply_profile(device, {0: {0x4004: ['10', '4', '59'], 0x4010: ['4097']}})
+    assert [change['ident'] for change in changes] == [0x4004, 0x4010]
+    assert set_settings.call_count == 2
+    assert [item.ident for item in set_settings.call_args.args[2]] == [0x4004, 0x4010]
+
+    with pytest.raises(NeotoolsError):
+        apply_profile(device, {0: {0x4004: ['10', '4', '59'], 0x4999: ['1']}})
+    assert set_settings.call_count == 2
+
+
+def test_settings_round_trip():
+    items = [
+        AppletSettingsItem(AppletSettingsType.LABEL, 0x4001, 'Auto Repeat'),
+        AppletSettingsItem(AppletSettingsType.OPTION, 0x4001, [0x1001, 0x1001, 0x1002]),
+        AppletSettingsItem(AppletSettingsType.RANGE_32, 0x4004, AppletSettingsRange32(5, 4, 59)),
+        AppletSettingsItem(AppletSettingsType.PASSWORD_6, 0x400b, 'secret'),
+        AppletSettingsItem(AppletSettingsType.APPLET_ID, 0x8002, 0xa000),
+    ]
+    raw = AppletSettingsItem.list_to_raw(items)
+    assert raw.startswith(raw_item(AppletSettingsType.LABEL, 0x4001, b'Auto Repeat\0'))
+    parsed = AppletSettingsItem.list_from_raw(raw + bytes(6) + raw)
+    assert [(item.type, item.ident, item.data) for item in parsed] == \
+        [(item.type, item.ident, item.data) for item in items]
+
+
+def test_settings_parsing_does_not_copy_the_buffer(monkeypatch):
+    raw = APPLET_RAW * 100
+    views = []
+    item_from_raw = AppletSettingsItem.item_from_raw
+
+    def record_item_from_raw(header, buf, offset=0):
+        views.append((buf, offset))
+        return item_from_raw(header, buf, offset)
+
+    monkeypatch.setattr(AppletSettingsItem, 'item_from_raw', staticmethod(record_item_from_raw))
+    assert len(AppletSettingsItem.list_from_raw(raw)) == 100
+    # Every item is decoded at its offset in a view of the whole buffer, not in a copy of the rest of it
+    assert all(buf.obj is raw and len(buf) == len(raw) for buf, _ in views)
+    assert [offset for _, offset in views] == list(range(0, len(raw), len(APPLET_RAW)))
@@ -0,0 +1,29 @@
+import pickle
+
+import pytest
+
+from neotools.device import REVISION, Revision
+from neotools.util import NeotoolsError, BinaryFormat
+
+
+def test_binary_format_round_trip():
+    revision = Revision(unknown=0x010203, revision_major=3, revision_minor=15, name='System 3 Neo',
+                        build_date='Jun 13 2006, 10:08:04')
+    buf = REVISION.pack(revision)
+    assert len(buf) == 0x40
+    assert buf[:6] == bytes([1, 2, 3, 0, 3, 15])
+    assert REVISION.unpack_from(memoryview(buf)) == revision
+    assert REVISION.unpack_from(b'\0' + buf, 1)['name'] == 'System 3 Neo'
+    assert pickle.loads(pickle.dumps(revision)) == revision
+    with pytest.raises(TypeError):
+        hash(revision)
+    assert {revision.to_tuple()} == {REVISION.unpack(buf).to_tuple()}
+
+
+def test_binary_format_sizes():
+    buf_format = BinaryFormat('Pair', {'size': 4, 'fields': {'a': (0, 1, int), 'b': (2, 2, int)}})
+    assert buf_format.unpack(bytes([1, 0xff, 0, 2])).to_dict() == {'a': 1, 'b': 2}
+    with pytest.raises(NeotoolsError):
+        buf_format.unpack(bytes(5))
+    with pytest.raises(ValueError):
+        REVISION.pack({'name': 'x' * 20})
@@ -0,0 +1,37 @@
+from unittest import mock
+
+from neotools.device import device_location
+from neotools.watch import RESTART_TIME, Watcher
+
+
+def test_device_location():
+    assert device_location(mock.Mock(bus=1, port_numbers=(2, 4))) == '1-2.4'
+    assert device_location(mock.Mock(bus=1, port_numbers=None)) is None
+
+
+def test_watcher_harvests_each_device_once():
+    harvested = []
+
+    def harvest(dev, location):
+        harvested.append(location)
+        if location == '1-3':
+            raise OSError('Disconnected')
+        return {'location': location}
+
+    watcher = Watcher(harvest, jobs=2)
+    devices = {'1-2': object(), '1-3': object()}
+    assert watcher.poll(devices, 0) == []
+    watcher.executor.shutdown(wait=True)
+
+    # The devices restart and disappear for a while after the harvest
+    results = watcher.poll({}, 1)
+    assert results[0] == {'location': '1-2'}
+    assert results[1]['error'] == {'type': 'OSError', 'message': 'Disconnected'}
+    assert watcher.poll(devices, 2) == []
+    assert sorted(harvested) == ['1-2', '1-3']
+
+    # A device is harvested again after it is unplugged and plugged in
+    watcher.poll({'1-3': devices['1-3']}, 1 + RESTART_TIME)
+    watcher.executor = mock.Mock()
+    watcher.poll(devices, 2 + RESTART_TIME)
+    watcher.executor.submit.assert_called_once_with(harvest, devices['1-2'], '1-2')
@@ -1,5 +1,7 @@
+import codecs
+
 from hypothesis import given, example, settings
-from hypothesis.strategies import text
+from hypothesis.strategies import integers, text
 
 from neotools.text_file import import_text_to_neo, export_text_from_neo, read_character_map_file, character_map_name_to_filepath
 
@@ -32,3 +34,26 @@ def test_import_export_idempotency(s):
     doubly_exported = export_text_from_neo(doubly_imported, character_map)
     assert imported == doubly_imported
     assert exported == doubly_exported
+
+
+@given(text(), integers(min_value=1, max_value=16))
+@example('↵' * 30, 1)
+@example('word ' * 30, 7)
+@settings(max_examples=300)
+def test_incremental_codec_matches_whole_buffer(s, chunk_size):
+    encoder = codecs.getincrementalencoder('neo-en-us')()
+    chunks = [s[i:i + chunk_size] for i in range(0, len(s), chunk_size)]
+    encoded = b''.join(encoder.encode(chunk) for chunk in chunks) + encoder.encode('', final=True)
+    assert encoded == import_text_to_neo(s, character_map)
+
+    decoder = codecs.getincrementaldecoder('neo-en-us')()
+    blocks = [encoded[i:i + chunk_size] for i in range(0, len(encoded), chunk_size)]
+    decoded = ''.join(decoder.decode(block) for block in blocks) + decoder.decode(b'', final=True)
+    assert decoded == export_text_from_neo(encoded, character_map)
+
+
+def test_codec_names():
+    assert codecs.lookup('neo-en-us').name == 'neo-en-us'
+    assert codecs.lookup('neo-ua-mac').name == 'neo-ua-mac'
+    assert codecs.lookup('neo-default').name == 'neo-en-us'
+    assert 'hello'.encode('neo-en-us').decode('neo-en-us') == 'hello'